@@ -0,0 +1,148 @@
+"""
+Canonicalização de CNPJ e deduplicação de notas antes da gravação.
+
+Forma canônica:
+- service_notes.cnpj_tomador / cnpj_prestador: formatado (00.000.000/0001-91),
+  como gravam todos os scripts de sync e o portal.
+- companies.cnpj: somente dígitos (coluna VARCHAR(14)).
+
+Com os dados canônicos, as consultas usam `.eq()` direto em vez de
+`or_(cnpj.eq.fmt,cnpj.eq.raw)`.
+
+Uso (merge único dos duplicados já gravados, via função SQL da migration):
+    python cnpj_canon.py --merge-duplicados
+"""
+import os
+import re
+import sys
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Mesmo formato de ID que os scripts já verificam (len == 24, hex do PlugNotas)
+_ID_PLUGNOTAS = re.compile(r"^[0-9a-f]{24}$")
+
+
+def limpar_cnpj(cnpj) -> str:
+    """Somente dígitos (forma canônica de companies.cnpj)."""
+    return re.sub(r"\D", "", str(cnpj or ""))
+
+
+def canonical_cnpj(cnpj) -> Optional[str]:
+    """Forma canônica de service_notes: CNPJ formatado; CPF e valores inválidos ficam só com dígitos."""
+    if cnpj is None:
+        return None
+    c = limpar_cnpj(cnpj)
+    if len(c) != 14:
+        return c or None
+    return f"{c[:2]}.{c[2:5]}.{c[5:8]}/{c[8:12]}-{c[12:]}"
+
+
+def e_id_plugnotas(nota_id) -> bool:
+    return bool(nota_id) and bool(_ID_PLUGNOTAS.match(str(nota_id)))
+
+
+def identidade_nota(record: Dict) -> Tuple:
+    """Identidade da nota independente do nota_id: tomador + número + prestador."""
+    return (
+        canonical_cnpj(record.get("cnpj_tomador")),
+        str(record.get("numero_nfse") or ""),
+        canonical_cnpj(record.get("cnpj_prestador")),
+    )
+
+
+def canonicalizar_registro(record: Dict) -> Dict:
+    for campo in ("cnpj_tomador", "cnpj_prestador"):
+        if campo in record:
+            record[campo] = canonical_cnpj(record[campo])
+    return record
+
+
+def deduplicar_registros(records: Iterable[Dict]) -> List[Dict]:
+    """
+    Canonicaliza os CNPJs e junta registros da mesma nota no lote.
+
+    Quando há um ID do PlugNotas e um fallback (`{numero}_{cnpj}`), fica o ID do
+    PlugNotas. Campos vazios do registro escolhido são completados pelos demais
+    (ex.: caminhos do S3 que só o registro do bucket tinha). A ordem de primeira
+    ocorrência é mantida.
+    """
+    por_identidade: Dict[Tuple, Dict] = {}
+    for record in records:
+        record = canonicalizar_registro(dict(record))
+        chave = identidade_nota(record)
+        atual = por_identidade.get(chave)
+        if atual is None:
+            por_identidade[chave] = record
+            continue
+
+        # O registro mais recente vence, exceto se trocaria um ID PlugNotas por fallback
+        if e_id_plugnotas(atual.get("nota_id")) and not e_id_plugnotas(record.get("nota_id")):
+            principal, complemento = atual, record
+        else:
+            principal, complemento = record, atual
+        for campo, valor in complemento.items():
+            if principal.get(campo) is None and valor is not None:
+                principal[campo] = valor
+        por_identidade[chave] = principal
+
+    return list(por_identidade.values())
+
+
+def adotar_ids_plugnotas(supabase, records: Iterable[Dict]) -> int:
+    """
+    Caminhos nota a nota (upsert por nota_id, sem lote em memória para
+    deduplicar_registros): antes de gravar as notas da API, o registro de fallback
+    da mesma nota passa a usar o ID do PlugNotas (função adopt_plugnotas_ids, ver
+    migration 20261019_adopt_plugnotas_ids.sql). Retorna quantos registros foram adotados.
+    """
+    itens = [
+        {campo: record.get(campo) for campo in ("nota_id", "numero_nfse", "cnpj_tomador", "cnpj_prestador")}
+        for record in map(canonicalizar_registro, map(dict, records))
+        if e_id_plugnotas(record.get("nota_id"))
+    ]
+    if not itens:
+        return 0
+    return supabase.rpc("adopt_plugnotas_ids", {"itens": itens}).execute().data or 0
+
+
+def merge_duplicados(supabase) -> Dict:
+    """
+    Colapsa duplicados já gravados em service_notes numa operação set-based
+    (função merge_service_notes_duplicates, ver migration 20261019_canonical_cnpj.sql).
+    """
+    response = supabase.rpc("merge_service_notes_duplicates", {}).execute()
+    return response.data[0] if isinstance(response.data, list) else response.data
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Canonicalização de CNPJs e merge de notas duplicadas.")
+    parser.add_argument("--merge-duplicados", action="store_true",
+                        help="Normaliza os CNPJs e colapsa os duplicados já gravados em service_notes")
+    args = parser.parse_args()
+    if not args.merge_duplicados:
+        parser.print_help()
+        return
+
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    if current_dir in sys.path:
+        sys.path.remove(current_dir)
+    from supabase import create_client
+    from dotenv import load_dotenv
+
+    load_dotenv(os.path.join(current_dir, "scripts", ".env"))
+    supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE_KEY"))
+
+    print("🔀 Colapsando notas duplicadas em service_notes...")
+    resultado = merge_duplicados(supabase)
+    print(f"✅ CNPJs normalizados: {resultado.get('cnpjs_normalizados')}")
+    print(f"✅ Registros mantidos com dados mesclados: {resultado.get('registros_mesclados')}")
+    print(f"🗑️  Duplicados removidos: {resultado.get('duplicados_removidos')}")
+
+    # O merge move e remove notas entre meses: o resumo mensal é refeito do zero
+    from monthly_summary import reconstruir
+    print(f"♻️  Resumo mensal reconstruído: {reconstruir(supabase)} meses.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Resumo mensal de notas por empresa (tabela service_notes_monthly).
+
+Os scripts de sync registram aqui os meses (company_id, ano, mes) dos registros
+que gravaram e, ao final da execução, só esses meses são recalculados no banco
+(função refresh_service_notes_monthly, via índice company_id/ano/mes). O portal
+lê contagens e totais da tabela em vez de carregar as notas.
+
+Verificação (recalcula tudo do zero e compara com a tabela mantida):
+    python monthly_summary.py --verificar
+    python monthly_summary.py --reconstruir
+"""
+import os
+import sys
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+CHAVES_POR_CHAMADA = 500
+
+ChaveMensal = Tuple[str, int, int]
+
+
+def chave_mensal(record: Dict) -> Optional[ChaveMensal]:
+    """(company_id, ano, mes) de um registro de service_notes, se ele tiver empresa."""
+    if not record.get("company_id") or not record.get("ano") or not record.get("mes"):
+        return None
+    return str(record["company_id"]), int(record["ano"]), int(record["mes"])
+
+
+class MesesAlterados:
+    """Meses tocados pelos registros gravados numa execução (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._chaves: Set[ChaveMensal] = set()
+
+    def registrar(self, record: Dict):
+        chave = chave_mensal(record)
+        if chave:
+            with self._lock:
+                self._chaves.add(chave)
+
+    def registrar_varios(self, records: Iterable[Dict]):
+        for record in records:
+            self.registrar(record)
+
+    def extrair(self) -> List[ChaveMensal]:
+        with self._lock:
+            chaves, self._chaves = sorted(self._chaves), set()
+        return chaves
+
+    def __len__(self):
+        return len(self._chaves)
+
+
+def atualizar_resumo_mensal(supabase, meses: MesesAlterados) -> int:
+    """Recalcula no banco os meses registrados e limpa o acumulado. Retorna as linhas gravadas."""
+    chaves = meses.extrair()
+    gravadas = 0
+    try:
+        for i in range(0, len(chaves), CHAVES_POR_CHAMADA):
+            lote = [{"company_id": c, "ano": a, "mes": m} for c, a, m in chaves[i:i + CHAVES_POR_CHAMADA]]
+            response = supabase.rpc("refresh_service_notes_monthly", {"chaves": lote}).execute()
+            gravadas += response.data or 0
+    except Exception as e:
+        # O resumo se corrige na próxima execução que tocar o mês (ou com --reconstruir)
+        print(f"⚠️ Erro ao atualizar service_notes_monthly: {e}")
+    return gravadas
+
+
+def verificar(supabase) -> List[Dict]:
+    """Diferenças entre service_notes_monthly e o agregado recalculado do zero."""
+    return supabase.rpc("verify_service_notes_monthly", {}).execute().data or []
+
+
+def reconstruir(supabase) -> int:
+    return supabase.rpc("rebuild_service_notes_monthly", {}).execute().data or 0
+
+
+def imprimir_diferencas(diferencas: List[Dict]):
+    if not diferencas:
+        print("✅ service_notes_monthly confere com o recálculo completo.")
+        return
+    print(f"❌ {len(diferencas)} meses divergentes:")
+    print(f"  {'empresa':<36} {'mês':<8} {'notas':>13} {'valor':>27} {'prestadores':>11} {'última emissão':>23}")
+    for d in diferencas[:50]:
+        print(f"  {d['company_id']:<36} {d['ano']}/{d['mes']:02d}  "
+              f"{d['total_notas_mantido']!s:>6}/{d['total_notas_calculado']!s:<6} "
+              f"{d['valor_total_mantido']!s:>13}/{d['valor_total_calculado']!s:<13} "
+              f"{d['prestadores_mantido']!s:>5}/{d['prestadores_calculado']!s:<5} "
+              f"{d['ultima_emissao_mantida']!s:>11}/{d['ultima_emissao_calculada']!s:<11}")
+    if len(diferencas) > 50:
+        print(f"  ... e mais {len(diferencas) - 50}")
+    print("  (mantido/recalculado) — use --reconstruir para corrigir")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Resumo mensal de notas por empresa (service_notes_monthly).")
+    parser.add_argument("--verificar", action="store_true",
+                        help="Recalcula do zero e mostra as diferenças para a tabela mantida")
+    parser.add_argument("--reconstruir", action="store_true", help="Recria a tabela a partir de service_notes")
+    args = parser.parse_args()
+    if not (args.verificar or args.reconstruir):
+        parser.print_help()
+        return
+
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    if current_dir in sys.path:
+        sys.path.remove(current_dir)
+    from supabase import create_client
+    from dotenv import load_dotenv
+
+    load_dotenv(os.path.join(current_dir, "scripts", ".env"))
+    supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE_KEY"))
+
+    if args.verificar:
+        print("🔎 Comparando service_notes_monthly com o recálculo completo...")
+        diferencas = verificar(supabase)
+        imprimir_diferencas(diferencas)
+        if diferencas and not args.reconstruir:
+            sys.exit(1)
+    if args.reconstruir:
+        print(f"♻️  Tabela reconstruída: {reconstruir(supabase)} meses.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Agrupamento dos arquivos do bucket (notas/...) por nota, em forma compacta.
+
+A listagem completa do bucket pode ter milhões de notas. Em vez de um dict de
+strings por nota, cada nota agrupada é um NotaS3 com __slots__: CNPJs internados
+(uma cópia por CNPJ, não por nota), datas como inteiros e caminhos remontados a
+partir dos campos. O dict com os dados consolidados (formato de parse_s3_key +
+caminhos) só é montado na hora de gravar, com como_dict().
+"""
+import re
+import sys
+from typing import Dict, Iterable, Optional, Tuple
+
+PADRAO_S3_KEY = re.compile(r'notas/(\d{14})/(\d{4})/(\d{2})/NFSe_(\d{2})-(\d{2})-(\d{4})_(\d+)_(\d{14})\.(pdf|xml)')
+
+# (cnpj_tomador, número, emissão AAAAMMDD)
+ChaveNota = Tuple[str, str, int]
+
+
+class NotaS3:
+    """
+    Nota agrupada do bucket. Datas como inteiros (emissão AAAAMMDD; pasta AAAAMM,
+    ou None quando é o próprio mês da emissão); `pdf`/`xml` valem None (sem arquivo), True (caminho padrão, remontado a partir
+    dos campos) ou o próprio caminho, quando foge do padrão.
+    """
+    __slots__ = ("cnpj_tomador", "cnpj_prestador", "numero_nfse", "emissao", "pasta", "pdf", "xml")
+
+    def __init__(self, cnpj_tomador: str, cnpj_prestador: str, numero_nfse: str, emissao: int, pasta: int):
+        self.cnpj_tomador = sys.intern(cnpj_tomador)
+        self.cnpj_prestador = sys.intern(cnpj_prestador)
+        self.numero_nfse = numero_nfse
+        self.emissao = emissao
+        self.pasta = None if pasta == emissao // 100 else pasta
+        self.pdf = None
+        self.xml = None
+
+    @property
+    def ano(self) -> int:
+        return self.emissao // 10000
+
+    @property
+    def mes(self) -> int:
+        return self.emissao // 100 % 100
+
+    @property
+    def dia(self) -> int:
+        return self.emissao % 100
+
+    @property
+    def data_emissao(self) -> str:
+        return f"{self.ano:04d}-{self.mes:02d}-{self.dia:02d}"
+
+    def caminho_padrao(self, tipo: str) -> str:
+        pasta = self.pasta or self.emissao // 100
+        return (f"notas/{self.cnpj_tomador}/{pasta // 100:04d}/{pasta % 100:02d}/"
+                f"NFSe_{self.dia:02d}-{self.mes:02d}-{self.ano:04d}_{self.numero_nfse}_{self.cnpj_prestador}.{tipo}")
+
+    def definir_caminho(self, tipo: str, caminho: str, padrao: Optional[bool] = None):
+        """`padrao`: se o caminho é o caminho_padrao (quem já conferiu evita remontar a string)."""
+        if padrao is None:
+            padrao = caminho == self.caminho_padrao(tipo)
+        setattr(self, tipo, True if padrao else caminho)
+
+    def caminho(self, tipo: str) -> Optional[str]:
+        valor = getattr(self, tipo)
+        return self.caminho_padrao(tipo) if valor is True else valor
+
+    @property
+    def s3_path_pdf(self) -> Optional[str]:
+        return self.caminho("pdf")
+
+    @property
+    def s3_path_xml(self) -> Optional[str]:
+        return self.caminho("xml")
+
+    def como_dict(self) -> Dict:
+        """Mesmo formato de antes (parse_s3_key + caminhos), para gravar no Supabase."""
+        return {
+            'cnpj_tomador': self.cnpj_tomador,
+            'cnpj_prestador': self.cnpj_prestador,
+            'numero_nfse': self.numero_nfse,
+            'data_emissao': self.data_emissao,
+            'ano': self.ano,
+            'mes': self.mes,
+            'dia': self.dia,
+            's3_path_pdf': self.s3_path_pdf,
+            's3_path_xml': self.s3_path_xml,
+        }
+
+
+def group_files_by_nota(files: Iterable[str]) -> Dict[ChaveNota, NotaS3]:
+    """
+    Agrupa arquivos PDF e XML da mesma nota.
+    Retorna dict com chave única (cnpj_tomador, numero, emissão AAAAMMDD) e a nota
+    compacta (NotaS3; como_dict() dá os dados consolidados). `files` pode ser um
+    iterador (ex.: iter_s3_files), sem precisar da listagem inteira em memória.
+    """
+    notas = {}
+    
+    for file_path in files:
+        match = PADRAO_S3_KEY.match(file_path)
+        if not match:
+            print(f"  ⚠️  Formato inválido: {file_path}")
+            continue
+        
+        cnpj_tomador, ano_path, mes_path, dia, mes_emissao, ano_emissao, numero, cnpj_prestador, tipo = match.groups()
+        emissao = int(ano_emissao) * 10000 + int(mes_emissao) * 100 + int(dia)
+        
+        # Chave única: cnpj_tomador + numero + data_emissao
+        cnpj_tomador = sys.intern(cnpj_tomador)
+        nota_key = (cnpj_tomador, numero, emissao)
+        
+        pasta = int(ano_path) * 100 + int(mes_path)
+        nota = notas.get(nota_key)
+        if nota is None:
+            nota = notas[nota_key] = NotaS3(cnpj_tomador, cnpj_prestador, numero, emissao, pasta)
+        
+        # Adicionar o caminho do arquivo (pdf ou xml). Todos os campos do padrão têm
+        # largura fixa, então o caminho é o padrão se o padrão casou até o fim e a
+        # pasta e o prestador são os da nota.
+        padrao = (match.end() == len(file_path) and pasta == (nota.pasta or emissao // 100)
+                  and cnpj_prestador == nota.cnpj_prestador)
+        nota.definir_caminho(tipo, file_path, padrao)
+    
+    return notas
@@ -0,0 +1,206 @@
+"""
+Pacote ZIP com os PDFs e XMLs de um tomador num período.
+
+As chaves seguem o layout do bucket (notas/{CNPJ}/{ANO}/{MES}/NFSe_...), então
+basta listar os prefixos dos meses pedidos. Os objetos são baixados em paralelo
+e gravados no ZIP em streaming, na ordem da listagem: só uma janela de objetos
+fica em memória por vez, qualquer que seja o tamanho do pacote. XMLs gravados
+com gzip (s3_xml_gzip) entram no ZIP já descomprimidos.
+
+A saída vai para um arquivo local ou, com --s3, para um multipart upload no
+próprio bucket (prefixo exports/), com link pré-assinado ao final.
+
+Uso:
+    python notas_zip.py 25249058000102 --inicio 2026-03
+    python notas_zip.py 25249058000102 --inicio 2026-01 --fim 2026-03 --saida notas_t1.zip
+    python notas_zip.py 25249058000102 --inicio 2026-03 --s3
+"""
+import argparse
+import os
+import sys
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Tuple
+
+from cnpj_canon import limpar_cnpj
+from s3_xml_gzip import ler_objeto_s3
+
+ZIP_WORKERS = int(os.getenv("NOTAS_ZIP_WORKERS", "8"))
+TAMANHO_PARTE = int(os.getenv("NOTAS_ZIP_PART_MB", "8")) * 1024 * 1024  # mínimo do S3: 5 MB
+PREFIXO_EXPORTS = os.getenv("NOTAS_ZIP_PREFIX", "exports/")
+EXPIRACAO_LINK = 86400  # 24 horas, como os links das notas
+
+
+def meses_do_periodo(inicio: Tuple[int, int], fim: Tuple[int, int]) -> List[Tuple[int, int]]:
+    ano, mes = inicio
+    meses = []
+    while (ano, mes) <= fim:
+        meses.append((ano, mes))
+        ano, mes = (ano + 1, 1) if mes == 12 else (ano, mes + 1)
+    return meses
+
+
+def listar_chaves(s3_client, bucket: str, cnpj: str, meses: List[Tuple[int, int]]) -> Iterator[str]:
+    """PDFs e XMLs das pastas notas/{cnpj}/{ano}/{mes}/ (a listagem é paginada, não acumulada)."""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for ano, mes in meses:
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"notas/{cnpj}/{ano}/{mes:02d}/"):
+            for obj in page.get("Contents", []):
+                if obj["Key"].endswith((".pdf", ".xml")):
+                    yield obj["Key"]
+
+
+def baixar_em_ordem(s3_client, bucket: str, chaves: Iterator[str], workers: int) -> Iterator[Tuple[str, bytes]]:
+    """
+    Download paralelo com janela limitada: no máximo 2 × workers objetos em
+    memória, entregues na mesma ordem das chaves.
+    """
+    janela = deque()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for key in chaves:
+            janela.append((key, pool.submit(ler_objeto_s3, s3_client, bucket, key)))
+            if len(janela) >= 2 * workers:
+                key_pronta, futuro = janela.popleft()
+                yield key_pronta, futuro.result()
+        while janela:
+            key_pronta, futuro = janela.popleft()
+            yield key_pronta, futuro.result()
+
+
+class UploadMultipartS3:
+    """
+    Arquivo só de escrita que envia o conteúdo ao S3 em partes de TAMANHO_PARTE.
+    Sem tell()/seek(): o zipfile passa a gravar os tamanhos depois de cada arquivo.
+    """
+
+    def __init__(self, s3_client, bucket: str, key: str, tamanho_parte: int = TAMANHO_PARTE):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.tamanho_parte = tamanho_parte
+        self._buffer = bytearray()
+        self._partes = []
+        self._upload_id = s3_client.create_multipart_upload(
+            Bucket=bucket, Key=key, ContentType="application/zip"
+        )["UploadId"]
+
+    def write(self, dados) -> int:
+        self._buffer += dados
+        while len(self._buffer) >= self.tamanho_parte:
+            self._enviar_parte(bytes(self._buffer[:self.tamanho_parte]))
+            del self._buffer[:self.tamanho_parte]
+        return len(dados)
+
+    def flush(self):
+        pass
+
+    def _enviar_parte(self, dados: bytes):
+        numero = len(self._partes) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id, PartNumber=numero, Body=dados
+        )
+        self._partes.append({"PartNumber": numero, "ETag": response["ETag"]})
+
+    def concluir(self):
+        if self._buffer or not self._partes:
+            self._enviar_parte(bytes(self._buffer))
+            self._buffer.clear()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            MultipartUpload={"Parts": self._partes},
+        )
+
+    def abortar(self):
+        self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+
+def gravar_zip(destino, s3_client, bucket: str, cnpj: str, meses: List[Tuple[int, int]],
+               workers: int = ZIP_WORKERS) -> dict:
+    """Escreve o ZIP em `destino` (arquivo aberto em modo binário ou UploadMultipartS3)."""
+    resultado = {"arquivos": 0, "bytes": 0}
+    prefixo = f"notas/{cnpj}/"
+    with zipfile.ZipFile(destino, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+        for key, conteudo in baixar_em_ordem(s3_client, bucket, listar_chaves(s3_client, bucket, cnpj, meses), workers):
+            # Dentro do ZIP: {ANO}/{MES}/NFSe_....pdf
+            with zf.open(key[len(prefixo):], "w", force_zip64=True) as entrada:
+                entrada.write(conteudo)
+            resultado["arquivos"] += 1
+            resultado["bytes"] += len(conteudo)
+            if resultado["arquivos"] % 500 == 0:
+                print(f"  📦 {resultado['arquivos']} arquivos | {resultado['bytes'] / (1024 * 1024):.1f} MB")
+    return resultado
+
+
+def _ano_mes(valor: str) -> Tuple[int, int]:
+    ano, _, mes = valor.partition("-")
+    if not (ano.isdigit() and mes.isdigit() and 1 <= int(mes) <= 12):
+        raise argparse.ArgumentTypeError(f"período inválido: {valor} (use AAAA-MM)")
+    return int(ano), int(mes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gera um ZIP com os PDFs e XMLs de um tomador num período.")
+    parser.add_argument("cnpj", help="CNPJ do tomador (com ou sem formatação)")
+    parser.add_argument("--inicio", type=_ano_mes, required=True, help="Primeiro mês (AAAA-MM)")
+    parser.add_argument("--fim", type=_ano_mes, help="Último mês (AAAA-MM); padrão: o mesmo de --inicio")
+    parser.add_argument("--saida", help="Arquivo ZIP local (padrão: notas_{cnpj}_{periodo}.zip)")
+    parser.add_argument("--s3", action="store_true", help="Envia o ZIP ao bucket e imprime o link pré-assinado")
+    parser.add_argument("--workers", type=int, default=ZIP_WORKERS, help="Downloads em paralelo")
+    args = parser.parse_args()
+
+    cnpj = limpar_cnpj(args.cnpj)
+    if len(cnpj) != 14:
+        parser.error(f"CNPJ inválido: {args.cnpj}")
+    fim = args.fim or args.inicio
+    meses = meses_do_periodo(args.inicio, fim)
+    if not meses:
+        parser.error("--fim é anterior a --inicio")
+
+    import boto3
+    from botocore.config import Config
+    from dotenv import load_dotenv
+
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    load_dotenv(os.path.join(current_dir, "scripts", ".env"))
+    bucket = os.getenv("AWS_BUCKET", "plug-notas")
+    s3_client = boto3.client(
+        "s3",
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_KEY"),
+        region_name=os.getenv("AWS_REGION", "sa-east-1"),
+        config=Config(signature_version="s3v4", max_pool_connections=max(10, args.workers)),
+    )
+
+    periodo = f"{args.inicio[0]}-{args.inicio[1]:02d}" + (f"_{fim[0]}-{fim[1]:02d}" if fim != args.inicio else "")
+    nome = f"notas_{cnpj}_{periodo}.zip"
+    print(f"🗜️  Montando {nome} ({len(meses)} mês(es), {args.workers} downloads em paralelo)...")
+
+    if args.s3:
+        key = f"{PREFIXO_EXPORTS}{cnpj}/{nome}"
+        upload = UploadMultipartS3(s3_client, bucket, key)
+        try:
+            resultado = gravar_zip(upload, s3_client, bucket, cnpj, meses, args.workers)
+            upload.concluir()
+        except BaseException:
+            upload.abortar()
+            raise
+        link = s3_client.generate_presigned_url(
+            "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=EXPIRACAO_LINK
+        )
+        print(f"✅ {resultado['arquivos']} arquivos enviados para s3://{bucket}/{key}")
+        print(f"🔗 Link (24h): {link}")
+    else:
+        saida = args.saida or nome
+        with open(saida, "wb") as f:
+            resultado = gravar_zip(f, s3_client, bucket, cnpj, meses, args.workers)
+        print(f"✅ {resultado['arquivos']} arquivos gravados em {saida} "
+              f"({os.path.getsize(saida) / (1024 * 1024):.1f} MB)")
+
+    if not resultado["arquivos"]:
+        print("⚠️  Nenhuma nota encontrada para o período.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
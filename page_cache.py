@@ -0,0 +1,145 @@
+"""
+Cache das páginas da consulta por período da PlugNotas (SQLite local).
+
+A sincronização reconsulta o mês atual e o anterior de cada empresa a cada
+execução, e quase todas as páginas voltam iguais. Cada página é guardada com o
+hash do conteúdo, pela chave (CNPJ, janela, cursor); se a página volta com o
+mesmo hash, as notas dela não são reprocessadas.
+
+O hash só é confirmado quando todas as notas da página foram gravadas com
+sucesso (uma página com falha é reprocessada na próxima execução), e cada
+página é revalidada por completo a cada PAGE_CACHE_REVALIDATE_HOURS.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import date
+from typing import Dict, Iterable, List, Optional
+
+PAGE_CACHE_PATH = os.getenv(
+    "PAGE_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "page_cache.sqlite3"),
+)
+PAGE_CACHE_REVALIDATE_HOURS = float(os.getenv("PAGE_CACHE_REVALIDATE_HOURS", "24"))
+PAGE_CACHE_RETENTION_DAYS = int(os.getenv("PAGE_CACHE_RETENTION_DAYS", "60"))
+
+
+def chave_pagina(cnpj: str, inicio: date, fim: date, cursor: Optional[str]) -> str:
+    return f"{cnpj}|{inicio.isoformat()}|{fim.isoformat()}|{cursor or ''}"
+
+
+def hash_conteudo(notas: List[Dict]) -> str:
+    """Hash estável das notas da página (independe da ordem das chaves no JSON)."""
+    return hashlib.sha256(
+        json.dumps(notas, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class Pagina(list):
+    """Notas de uma página (a própria lista), com a chave, o hash e se veio igual à última vez."""
+
+    def __init__(self, notas: Iterable[Dict], chave: str, hash_pagina: str, inalterada: bool):
+        super().__init__(notas)
+        self.chave = chave
+        self.hash = hash_pagina
+        self.inalterada = inalterada
+
+
+class CachePaginas:
+    """Hash da última versão processada de cada página (thread-safe)."""
+
+    def __init__(self, path: str = PAGE_CACHE_PATH, revalidar_horas: float = PAGE_CACHE_REVALIDATE_HOURS):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.revalidar_segundos = revalidar_horas * 3600
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS paginas (chave TEXT PRIMARY KEY, hash TEXT NOT NULL, verificada_em REAL NOT NULL)"
+        )
+        self._contadores = {"paginas_puladas": 0, "notas_puladas": 0}
+
+    def pagina(self, chave: str, notas: List[Dict]) -> Pagina:
+        """Embrulha as notas da página; `inalterada` só se o hash bate e a revalidação não venceu."""
+        hash_pagina = hash_conteudo(notas)
+        with self._lock:
+            row = self._conn.execute("SELECT hash, verificada_em FROM paginas WHERE chave = ?", (chave,)).fetchone()
+        inalterada = bool(row) and row[0] == hash_pagina and time.time() - row[1] < self.revalidar_segundos
+        return Pagina(notas, chave, hash_pagina, inalterada)
+
+    def confirmar(self, paginas: Iterable[Pagina]) -> int:
+        agora = time.time()
+        itens = [(p.chave, p.hash, agora) for p in paginas]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO paginas (chave, hash, verificada_em) VALUES (?, ?, ?) "
+                "ON CONFLICT(chave) DO UPDATE SET hash = excluded.hash, verificada_em = excluded.verificada_em",
+                itens,
+            )
+        return len(itens)
+
+    def registrar_pulo(self, pagina: Pagina):
+        with self._lock:
+            self._contadores["paginas_puladas"] += 1
+            self._contadores["notas_puladas"] += len(pagina)
+
+    def extrair_contadores(self) -> Dict[str, int]:
+        """Páginas/notas puladas desde a última chamada (para o metadata do sync_logs)."""
+        with self._lock:
+            contadores = dict(self._contadores)
+            self._contadores = {"paginas_puladas": 0, "notas_puladas": 0}
+        return contadores
+
+    def limpar_antigas(self, dias: int = PAGE_CACHE_RETENTION_DAYS) -> int:
+        """Remove páginas não confirmadas há `dias` (janelas e cursores que não voltam mais)."""
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM paginas WHERE verificada_em < ?", (time.time() - dias * 86400,)
+            ).rowcount
+
+
+class ConfirmacaoPaginas:
+    """
+    Páginas processadas numa sincronização de empresa. Cada página espera o
+    resultado das suas notas (chave do job) e só entra no cache se todas deram certo.
+    """
+
+    def __init__(self, cache: CachePaginas, pular: bool = True):
+        self.cache = cache
+        self.pular = pular
+        self._lock = threading.Lock()
+        self._pendentes: Dict[str, set] = {}      # chave da página -> chaves das notas sem resultado
+        self._paginas: Dict[str, Pagina] = {}
+        self._pagina_da_nota: Dict[str, str] = {}
+        self._com_falha: set = set()
+
+    def deve_pular(self, pagina) -> bool:
+        return self.pular and isinstance(pagina, Pagina) and pagina.inalterada and len(pagina) > 0
+
+    def adicionar(self, pagina: Pagina, chaves_notas: List[str]):
+        with self._lock:
+            self._paginas[pagina.chave] = pagina
+            self._pendentes[pagina.chave] = set(chaves_notas)
+            for chave in chaves_notas:
+                self._pagina_da_nota[chave] = pagina.chave
+
+    def nota_concluida(self, chave_nota: str, ok: bool):
+        with self._lock:
+            chave_pagina = self._pagina_da_nota.get(chave_nota)
+            if chave_pagina is None:
+                return
+            self._pendentes[chave_pagina].discard(chave_nota)
+            if not ok:
+                self._com_falha.add(chave_pagina)
+
+    def confirmar(self) -> int:
+        """Grava no cache as páginas com todas as notas concluídas com sucesso."""
+        with self._lock:
+            prontas = [p for chave, p in self._paginas.items()
+                       if not self._pendentes[chave] and chave not in self._com_falha]
+            self._paginas, self._pendentes, self._pagina_da_nota, self._com_falha = {}, {}, {}, set()
+        return self.cache.confirmar(prontas)
@@ -0,0 +1,400 @@
+"""
+Exportação de service_notes para Parquet particionado (análises entre tenants).
+
+Layout (estilo Hive, lido direto por DuckDB, Spark, Athena, pyarrow.dataset):
+    <destino>/cnpj_tomador=<só dígitos>/ano=<AAAA>/mes=<MM>/part-0.parquet
+
+- As notas são lidas do PostgREST com paginação por chave (keyset), nunca por offset.
+- CNPJs com dictionary encoding: o do tomador fica no caminho da partição e o do
+  prestador vai como coluna de dicionário (poucos valores distintos por arquivo).
+- Incremental: a partir do `updated_at` da última exportação, só as partições
+  com notas alteradas são regravadas (cada partição é reescrita inteira).
+  A partição anterior de uma nota que mudou de tomador/mês, ou que foi removida,
+  vem de service_notes_partition_changes (mantida por trigger) e também é
+  regravada; partições que ficaram vazias são apagadas.
+- --completo regrava tudo e apaga do destino as partições que não existem mais.
+- Destino: diretório local ou o bucket, num prefixo separado (s3://bucket/prefixo).
+
+Requer pyarrow: pip install pyarrow
+
+Uso:
+    python parquet_export.py --destino ./export/service_notes
+    python parquet_export.py --destino s3://plug-notas/analytics/service_notes
+    python parquet_export.py --destino ./export/service_notes --completo
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # dependência opcional, só necessária na exportação
+    pa = None
+
+from cnpj_canon import canonical_cnpj, limpar_cnpj
+
+PAGE_SIZE = int(os.getenv("PARQUET_EXPORT_PAGE_SIZE", "1000"))
+ARQUIVO_ESTADO = "_export_state.json"
+
+# Colunas exportadas (URLs pré-assinadas e JSONs de tomador/prestador ficam de fora)
+COLUNAS = [
+    ("id", "string"),
+    ("nota_id", "string"),
+    ("numero_nfse", "string"),
+    ("company_id", "string"),
+    ("cnpj_tomador", "cnpj"),
+    ("cnpj_prestador", "cnpj"),
+    ("data_emissao", "date"),
+    ("ano", "int16"),
+    ("mes", "int8"),
+    ("dia", "int8"),
+    ("valor_total", "decimal"),
+    ("descricao_servico", "string"),
+    ("codigo_servico", "string"),
+    ("status", "string"),
+    ("s3_path_pdf", "string"),
+    ("s3_path_xml", "string"),
+    ("created_at", "timestamp"),
+    ("updated_at", "timestamp"),
+]
+# Ficam no caminho (cnpj_tomador=/ano=/mes=), não dentro dos arquivos
+COLUNAS_PARTICAO = ("cnpj_tomador", "ano", "mes")
+
+Particao = Tuple[str, int, int]  # (cnpj_tomador só dígitos, ano, mes)
+
+
+def _exigir_pyarrow():
+    if pa is None:
+        raise RuntimeError("pyarrow não instalado: pip install pyarrow")
+
+
+def _tipo_arrow(tipo: str):
+    return {
+        "string": pa.string(),
+        "cnpj": pa.dictionary(pa.int32(), pa.string()),
+        "date": pa.date32(),
+        "int16": pa.int16(),
+        "int8": pa.int8(),
+        "decimal": pa.decimal128(15, 2),
+        "timestamp": pa.timestamp("us", tz="UTC"),
+    }[tipo]
+
+
+def schema_parquet():
+    """Schema dos arquivos (sem as colunas de partição)."""
+    _exigir_pyarrow()
+    return pa.schema([(nome, _tipo_arrow(tipo)) for nome, tipo in COLUNAS if nome not in COLUNAS_PARTICAO])
+
+
+def particionamento():
+    """
+    Particionamento para pyarrow.dataset. Sem ele o CNPJ do caminho seria lido como
+    inteiro (perdendo zeros à esquerda):
+        ds.dataset(destino, format="parquet", partitioning=particionamento())
+    """
+    _exigir_pyarrow()
+    import pyarrow.dataset as ds
+
+    tipos = dict(COLUNAS)
+    schema = pa.schema([(nome, _tipo_arrow(tipos[nome])) for nome in COLUNAS_PARTICAO])
+    return ds.HivePartitioning.discover(schema=schema)
+
+
+def caminho_particao(particao: Particao) -> str:
+    cnpj, ano, mes = particao
+    return f"cnpj_tomador={cnpj}/ano={ano}/mes={mes:02d}/part-0.parquet"
+
+
+# ---------- Origem ----------
+
+class FontePostgrest:
+    """Lê service_notes pelo PostgREST com paginação por chave."""
+
+    def __init__(self, supabase, tamanho_pagina: int = PAGE_SIZE):
+        self.supabase = supabase
+        self.tamanho_pagina = tamanho_pagina
+
+    def alteracoes(self, desde: Optional[Dict]) -> Iterator[Dict]:
+        """Notas com (updated_at, id) depois do cursor, em ordem; só as colunas da partição."""
+        cursor = desde
+        while True:
+            query = self.supabase.table("service_notes").select("id, cnpj_tomador, ano, mes, updated_at")
+            if cursor:
+                query = query.or_(
+                    f'updated_at.gt."{cursor["updated_at"]}",'
+                    f'and(updated_at.eq."{cursor["updated_at"]}",id.gt.{cursor["id"]})'
+                )
+            pagina = query.order("updated_at").order("id").limit(self.tamanho_pagina).execute().data or []
+            yield from pagina
+            if len(pagina) < self.tamanho_pagina:
+                return
+            cursor = {"updated_at": pagina[-1]["updated_at"], "id": pagina[-1]["id"]}
+
+    def mudancas(self, desde_id: Optional[int]) -> Iterator[Dict]:
+        """Partições de origem de notas movidas ou removidas (service_notes_partition_changes), por id."""
+        ultimo_id = desde_id
+        while True:
+            query = self.supabase.table("service_notes_partition_changes").select("id, cnpj_tomador, ano, mes")
+            if ultimo_id:
+                query = query.gt("id", ultimo_id)
+            pagina = query.order("id").limit(self.tamanho_pagina).execute().data or []
+            yield from pagina
+            if len(pagina) < self.tamanho_pagina:
+                return
+            ultimo_id = pagina[-1]["id"]
+
+    def linhas_da_particao(self, particao: Particao) -> Iterator[Dict]:
+        cnpj, ano, mes = particao
+        # A coluna guarda o CNPJ formatado (canônico), mas legados podem estar sem formatação
+        formas = sorted({canonical_cnpj(cnpj), cnpj})
+        ultimo_id = None
+        colunas = ", ".join(nome for nome, _ in COLUNAS)
+        while True:
+            query = self.supabase.table("service_notes").select(colunas)\
+                .in_("cnpj_tomador", formas).eq("ano", ano).eq("mes", mes)
+            if ultimo_id:
+                query = query.gt("id", ultimo_id)
+            pagina = query.order("id").limit(self.tamanho_pagina).execute().data or []
+            yield from pagina
+            if len(pagina) < self.tamanho_pagina:
+                return
+            ultimo_id = pagina[-1]["id"]
+
+
+# ---------- Destino ----------
+
+class DestinoLocal:
+    def __init__(self, raiz: str):
+        self.raiz = raiz
+
+    def gravar(self, caminho: str, dados: bytes):
+        destino = os.path.join(self.raiz, *caminho.split("/"))
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        # Prefixo "." para leitores do dataset ignorarem um arquivo parcial
+        tmp = os.path.join(os.path.dirname(destino), "." + os.path.basename(destino) + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(dados)
+        os.replace(tmp, destino)
+
+    def ler(self, caminho: str) -> Optional[bytes]:
+        origem = os.path.join(self.raiz, *caminho.split("/"))
+        if not os.path.exists(origem):
+            return None
+        with open(origem, "rb") as f:
+            return f.read()
+
+    def remover(self, caminho: str) -> bool:
+        alvo = os.path.join(self.raiz, *caminho.split("/"))
+        if not os.path.exists(alvo):
+            return False
+        os.remove(alvo)
+        return True
+
+    def listar(self) -> Iterator[str]:
+        """Caminhos relativos (com '/') dos arquivos de partição no destino."""
+        for pasta, _, arquivos in os.walk(self.raiz):
+            for nome in arquivos:
+                if nome.endswith(".parquet") and not nome.startswith("."):
+                    yield os.path.relpath(os.path.join(pasta, nome), self.raiz).replace(os.sep, "/")
+
+    def __str__(self):
+        return self.raiz
+
+
+class DestinoS3:
+    """Prefixo separado no bucket (ex.: s3://plug-notas/analytics/service_notes)."""
+
+    def __init__(self, s3_client, bucket: str, prefixo: str):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefixo = prefixo.strip("/")
+
+    def _key(self, caminho: str) -> str:
+        return f"{self.prefixo}/{caminho}" if self.prefixo else caminho
+
+    def gravar(self, caminho: str, dados: bytes):
+        self.s3_client.put_object(Bucket=self.bucket, Key=self._key(caminho), Body=dados)
+
+    def ler(self, caminho: str) -> Optional[bytes]:
+        try:
+            return self.s3_client.get_object(Bucket=self.bucket, Key=self._key(caminho))["Body"].read()
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+
+    def remover(self, caminho: str) -> bool:
+        # delete_object não acusa chave inexistente: confere antes para a contagem
+        try:
+            self.s3_client.head_object(Bucket=self.bucket, Key=self._key(caminho))
+        except self.s3_client.exceptions.ClientError:
+            return False
+        self.s3_client.delete_object(Bucket=self.bucket, Key=self._key(caminho))
+        return True
+
+    def listar(self) -> Iterator[str]:
+        inicio = len(self.prefixo) + 1 if self.prefixo else 0
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for pagina in paginator.paginate(Bucket=self.bucket, Prefix=self._key("")):
+            for obj in pagina.get("Contents", []):
+                if obj["Key"].endswith(".parquet"):
+                    yield obj["Key"][inicio:]
+
+    def __str__(self):
+        return f"s3://{self.bucket}/{self.prefixo}"
+
+
+# ---------- Exportação ----------
+
+def _converter_linha(linha: Dict) -> Dict:
+    from datetime import date, datetime
+    from decimal import Decimal
+
+    convertida = dict(linha)
+    for campo in ("cnpj_tomador", "cnpj_prestador"):
+        convertida[campo] = limpar_cnpj(linha.get(campo)) or None
+    if isinstance(linha.get("data_emissao"), str):
+        convertida["data_emissao"] = date.fromisoformat(linha["data_emissao"][:10])
+    for campo in ("created_at", "updated_at"):
+        if isinstance(linha.get(campo), str):
+            convertida[campo] = datetime.fromisoformat(linha[campo].replace("Z", "+00:00"))
+    if linha.get("valor_total") is not None:
+        convertida["valor_total"] = Decimal(str(linha["valor_total"])).quantize(Decimal("0.01"))
+    return convertida
+
+
+def montar_parquet(linhas: List[Dict]) -> bytes:
+    """Serializa as linhas de uma partição (CNPJ do prestador com dictionary encoding, zstd)."""
+    schema = schema_parquet()
+    colunas = {nome: [linha.get(nome) for linha in linhas] for nome in schema.names}
+    arrays = []
+    for campo in schema:
+        if pa.types.is_dictionary(campo.type):
+            arrays.append(pa.array(colunas[campo.name], type=pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(colunas[campo.name], type=campo.type))
+    tabela = pa.Table.from_arrays(arrays, schema=schema)
+    buffer = io.BytesIO()
+    pq.write_table(tabela, buffer, compression="zstd", use_dictionary=["cnpj_prestador", "status", "codigo_servico"])
+    return buffer.getvalue()
+
+
+def _particao_da_nota(nota: Dict) -> Optional[Particao]:
+    cnpj = limpar_cnpj(nota.get("cnpj_tomador"))
+    if cnpj and nota.get("ano") and nota.get("mes"):
+        return cnpj, int(nota["ano"]), int(nota["mes"])
+    return None
+
+
+def particoes_alteradas(fonte, desde: Optional[Dict],
+                        desde_mudanca: Optional[int] = None) -> Tuple[List[Particao], Optional[Dict], Optional[int]]:
+    """
+    Partições a regravar desde os cursores: as atuais das notas alteradas (maior
+    updated_at, id) e as anteriores das notas movidas ou removidas (id da mudança).
+    Retorna as partições e os novos cursores.
+    """
+    particoes = set()
+    cursor = desde
+    for nota in fonte.alteracoes(desde):
+        particao = _particao_da_nota(nota)
+        if particao:
+            particoes.add(particao)
+        cursor = {"updated_at": nota["updated_at"], "id": nota["id"]}
+    cursor_mudanca = desde_mudanca
+    for mudanca in fonte.mudancas(desde_mudanca):
+        particao = _particao_da_nota(mudanca)
+        if particao:
+            particoes.add(particao)
+        cursor_mudanca = mudanca["id"]
+    return sorted(particoes), cursor, cursor_mudanca
+
+
+def exportar(fonte, destino, completo: bool = False) -> Dict:
+    """Regrava as partições alteradas desde a última exportação e avança o cursor."""
+    _exigir_pyarrow()
+    estado_bruto = None if completo else destino.ler(ARQUIVO_ESTADO)
+    estado = json.loads(estado_bruto) if estado_bruto else {}
+    desde = estado.get("cursor")
+
+    inicio = time.perf_counter()
+    particoes, cursor, cursor_mudanca = particoes_alteradas(fonte, desde, estado.get("cursor_mudancas"))
+    print(f"🔎 {len(particoes)} partições alteradas desde {desde['updated_at'] if desde else 'o início'}")
+
+    resultado = {"particoes": 0, "linhas": 0, "bytes": 0, "removidas": 0}
+    for particao in particoes:
+        linhas = [_converter_linha(linha) for linha in fonte.linhas_da_particao(particao)]
+        if not linhas:
+            # Todas as notas saíram da partição (movidas ou removidas)
+            resultado["removidas"] += int(destino.remover(caminho_particao(particao)))
+            continue
+        dados = montar_parquet(linhas)
+        destino.gravar(caminho_particao(particao), dados)
+        resultado["particoes"] += 1
+        resultado["linhas"] += len(linhas)
+        resultado["bytes"] += len(dados)
+        if resultado["particoes"] % 100 == 0:
+            print(f"  📦 {resultado['particoes']}/{len(particoes)} partições | {resultado['linhas']} linhas")
+
+    if completo:
+        # Partições no destino que não existem mais na tabela
+        atuais = {caminho_particao(particao) for particao in particoes}
+        for caminho in list(destino.listar()):
+            if caminho not in atuais:
+                resultado["removidas"] += int(destino.remover(caminho))
+
+    # Os cursores só avançam depois de todas as partições gravadas
+    if cursor:
+        estado["cursor"] = cursor
+    if cursor_mudanca:
+        estado["cursor_mudancas"] = cursor_mudanca
+    estado["ultima_exportacao"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    destino.gravar(ARQUIVO_ESTADO, json.dumps(estado).encode("utf-8"))
+    resultado["segundos"] = time.perf_counter() - inicio
+    return resultado
+
+
+def criar_destino(destino: str):
+    if not destino.startswith("s3://"):
+        return DestinoLocal(destino)
+    import boto3
+    from botocore.config import Config
+
+    bucket, _, prefixo = destino[len("s3://"):].partition("/")
+    s3_client = boto3.client(
+        "s3",
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_KEY"),
+        region_name=os.getenv("AWS_REGION", "sa-east-1"),
+        config=Config(signature_version="s3v4"),
+    )
+    return DestinoS3(s3_client, bucket, prefixo)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exporta service_notes para Parquet particionado por tomador/ano/mês.")
+    parser.add_argument("--destino", required=True, help="Diretório local ou s3://bucket/prefixo")
+    parser.add_argument("--completo", action="store_true", help="Ignora o estado e regrava todas as partições")
+    args = parser.parse_args()
+
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    if current_dir in sys.path:
+        sys.path.remove(current_dir)
+    from supabase import create_client
+    from dotenv import load_dotenv
+    sys.path.insert(0, current_dir)
+
+    load_dotenv(os.path.join(current_dir, "scripts", ".env"))
+    supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE_KEY"))
+    destino = criar_destino(args.destino)
+
+    print(f"📤 Exportando service_notes para {destino}...")
+    resultado = exportar(FontePostgrest(supabase), destino, completo=args.completo)
+    print(f"✅ Partições: {resultado['particoes']} | Removidas: {resultado['removidas']} | Linhas: {resultado['linhas']} | "
+          f"{resultado['bytes'] / (1024 * 1024):.1f} MB | {resultado['segundos']:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
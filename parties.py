@@ -0,0 +1,207 @@
+"""
+Tomadores e prestadores normalizados na tabela parties (um JSON por CNPJ).
+
+Antes, cada linha de service_notes guardava os objetos `tomador` e `prestador`
+inteiros da PlugNotas; o mesmo endereço de um prestador se repetia em milhares
+de notas. Agora a nota só guarda os CNPJs (cnpj_tomador / cnpj_prestador) e o
+JSON fica em parties, com o hash do JSON canônico:
+
+- CacheParties carrega (cnpj, hash) da tabela uma vez por execução e só grava
+  uma parte quando o hash muda (em regime, quase nenhuma gravação);
+- para ler as notas com os JSONs, use a view service_notes_com_partes.
+
+Migração das notas já gravadas (copia para parties e limpa as colunas, em lotes):
+    python parties.py --migrar
+    python parties.py --migrar --lote 200
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from cnpj_canon import canonical_cnpj
+
+PARTIES_BATCH_SIZE = int(os.getenv("PARTIES_BATCH_SIZE", "500"))
+PAGE_SIZE = int(os.getenv("PARTIES_PAGE_SIZE", "1000"))
+
+
+def hash_parte(dados: Dict) -> str:
+    """md5 do JSON canônico (chaves ordenadas, sem espaços): independe da ordem dos campos na API."""
+    canonico = json.dumps(dados, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.md5(canonico.encode("utf-8")).hexdigest()
+
+
+def item_parte(cnpj, dados, data_referencia=None) -> Optional[Dict]:
+    """Item para upsert_parties; None se não há CNPJ ou o JSON não é um objeto (ex.: só o CNPJ em texto)."""
+    cnpj = canonical_cnpj(cnpj)
+    if not cnpj or not isinstance(dados, dict) or not dados:
+        return None
+    return {"cnpj": cnpj, "dados": dados, "hash": hash_parte(dados),
+            "data_referencia": str(data_referencia)[:10] if data_referencia else None}
+
+
+class CacheParties:
+    """
+    Hash da última versão gravada de cada parte, carregado da tabela na primeira
+    consulta. Compartilhado pelas threads da sincronização.
+    """
+
+    def __init__(self, supabase, tamanho_pagina: int = PAGE_SIZE):
+        self.supabase = supabase
+        self.tamanho_pagina = tamanho_pagina
+        self._hashes: Optional[Dict[str, str]] = None
+        self._lock = threading.Lock()
+        self._contadores = {"partes_gravadas": 0, "partes_iguais": 0}
+
+    def _carregar(self):
+        hashes, ultimo = {}, None
+        while True:
+            query = self.supabase.table("parties").select("cnpj, hash")
+            if ultimo:
+                query = query.gt("cnpj", ultimo)
+            pagina = query.order("cnpj").limit(self.tamanho_pagina).execute().data or []
+            hashes.update((linha["cnpj"], linha["hash"]) for linha in pagina)
+            if len(pagina) < self.tamanho_pagina:
+                return hashes
+            ultimo = pagina[-1]["cnpj"]
+
+    def _garantir_carregado(self):
+        if self._hashes is None:
+            hashes = self._carregar()
+            with self._lock:
+                if self._hashes is None:
+                    self._hashes = hashes
+                    print(f"  [Parties] {len(hashes)} partes em cache.")
+
+    def conhece(self, cnpj) -> bool:
+        """A parte já existe na tabela (com qualquer versão do JSON)."""
+        self._garantir_carregado()
+        with self._lock:
+            return canonical_cnpj(cnpj) in self._hashes
+
+    def alteradas(self, itens: Iterable[Optional[Dict]]) -> List[Dict]:
+        """Itens cujo hash difere do gravado (um por CNPJ)."""
+        self._garantir_carregado()
+        novos = {}
+        with self._lock:
+            for item in itens:
+                if not item:
+                    continue
+                if self._hashes.get(item["cnpj"]) == item["hash"]:
+                    self._contadores["partes_iguais"] += 1
+                else:
+                    # Mais de uma versão no lote: fica a da nota mais recente
+                    atual = novos.get(item["cnpj"])
+                    if not atual or (item["data_referencia"] or "") >= (atual["data_referencia"] or ""):
+                        novos[item["cnpj"]] = item
+        return list(novos.values())
+
+    def gravar(self, itens: List[Dict]) -> int:
+        """Grava os itens alterados numa chamada e atualiza o cache."""
+        if not itens:
+            return 0
+        gravadas = self.supabase.rpc("upsert_parties", {"itens": itens}).execute().data or 0
+        with self._lock:
+            for item in itens:
+                self._hashes[item["cnpj"]] = item["hash"]
+            self._contadores["partes_gravadas"] += gravadas
+        return gravadas
+
+    def registrar(self, *itens: Optional[Dict]) -> int:
+        """Grava as partes (itens de item_parte) que mudaram desde a última versão conhecida."""
+        return self.gravar(self.alteradas(itens))
+
+    def extrair_contadores(self) -> Dict[str, int]:
+        with self._lock:
+            contadores = dict(self._contadores)
+            for chave in self._contadores:
+                self._contadores[chave] = 0
+        return contadores
+
+
+# ---------- Migração das notas já gravadas ----------
+
+def notas_com_partes(supabase, tamanho_lote: int) -> Iterator[List[Dict]]:
+    """Lotes de notas que ainda guardam tomador/prestador, paginados por id."""
+    ultimo_id = None
+    while True:
+        query = supabase.table("service_notes")\
+            .select("id, cnpj_tomador, cnpj_prestador, data_emissao, tomador, prestador")\
+            .or_("tomador.not.is.null,prestador.not.is.null")
+        if ultimo_id:
+            query = query.gt("id", ultimo_id)
+        lote = query.order("id").limit(tamanho_lote).execute().data or []
+        if lote:
+            yield lote
+        if len(lote) < tamanho_lote:
+            return
+        ultimo_id = lote[-1]["id"]
+
+
+def migrar(supabase, tamanho_lote: int = PARTIES_BATCH_SIZE) -> Dict[str, int]:
+    """
+    Copia tomador/prestador das notas para parties e limpa as colunas, lote a lote.
+    Uma coluna só é limpa depois que a parte foi gravada; JSON sem CNPJ fica na nota.
+    """
+    cache = CacheParties(supabase)
+    resultado = {"notas": 0, "limpas": 0, "partes_gravadas": 0, "mantidas": 0}
+    for lote in notas_com_partes(supabase, tamanho_lote):
+        itens, limpar = [], []
+        for nota in lote:
+            colunas = {}
+            for papel in ("tomador", "prestador"):
+                dados = nota.get(papel)
+                if dados is None:
+                    continue
+                item = item_parte(nota.get(f"cnpj_{papel}"), dados, nota.get("data_emissao"))
+                if item:
+                    itens.append(item)
+                    colunas[papel] = True
+                elif not isinstance(dados, dict) or not dados:
+                    # Texto solto (só o CNPJ) ou objeto vazio: não há o que guardar
+                    colunas[papel] = True
+            if colunas:
+                limpar.append({"id": nota["id"], "tomador": colunas.get("tomador", False),
+                               "prestador": colunas.get("prestador", False)})
+            else:
+                resultado["mantidas"] += 1
+        resultado["partes_gravadas"] += cache.registrar(*itens)
+        if limpar:
+            resultado["limpas"] += supabase.rpc("clear_service_note_parties", {"itens": limpar}).execute().data or 0
+        resultado["notas"] += len(lote)
+        print(f"  📦 {resultado['notas']} notas | {resultado['partes_gravadas']} partes gravadas | "
+              f"{resultado['limpas']} notas limpas")
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tabela parties: tomadores/prestadores normalizados por CNPJ.")
+    parser.add_argument("--migrar", action="store_true",
+                        help="Copia tomador/prestador das notas já gravadas para parties e limpa as colunas")
+    parser.add_argument("--lote", type=int, default=PARTIES_BATCH_SIZE, help="Notas por lote na migração")
+    args = parser.parse_args()
+    if not args.migrar:
+        parser.print_help()
+        return
+
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    if current_dir in sys.path:
+        sys.path.remove(current_dir)
+    from supabase import create_client
+    from dotenv import load_dotenv
+    sys.path.insert(0, current_dir)
+
+    load_dotenv(os.path.join(current_dir, "scripts", ".env"))
+    supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE_KEY"))
+
+    print("🧹 Migrando tomador/prestador de service_notes para parties...")
+    resultado = migrar(supabase, args.lote)
+    print(f"✅ Notas lidas: {resultado['notas']} | Limpas: {resultado['limpas']} | "
+          f"Partes gravadas: {resultado['partes_gravadas']} | Mantidas (JSON sem CNPJ): {resultado['mantidas']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+"""
+Escritor assíncrono para o PostgREST do Supabase (insert/update/upsert).
+
+O supabase-py é síncrono: enquanto uma gravação está em voo, a thread fica
+parada esperando a resposta. Este escritor roda num event loop próprio (numa
+thread em segundo plano) com um cliente HTTP assíncrono com pool de conexões:
+
+- inserts/upserts enviados por qualquer thread são agrupados em lotes
+  (mesma tabela, operação e colunas) de até POSTGREST_ASYNC_CHUNK linhas;
+- até POSTGREST_ASYNC_IN_FLIGHT requisições ficam em voo ao mesmo tempo;
+- gravações com a mesma `chave` (ex.: nota_id) são aplicadas na ordem em que
+  foram enviadas: uma gravação só sai depois da anterior da mesma chave terminar,
+  e a mesma chave nunca aparece duas vezes no mesmo lote (a repetição vai para
+  um lote seguinte, enviado depois do anterior).
+
+Cada chamada retorna um concurrent.futures.Future, resolvido quando as suas
+linhas foram gravadas (ou com a exceção da requisição).
+"""
+import asyncio
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+try:
+    import httpx
+except ImportError:  # dependência opcional, só necessária com a escrita assíncrona
+    httpx = None
+
+POSTGREST_ASYNC_IN_FLIGHT = int(os.getenv("POSTGREST_ASYNC_IN_FLIGHT", "8"))    # requisições em voo
+POSTGREST_ASYNC_CHUNK = int(os.getenv("POSTGREST_ASYNC_CHUNK", "200"))          # linhas por requisição
+POSTGREST_ASYNC_FLUSH_MS = float(os.getenv("POSTGREST_ASYNC_FLUSH_MS", "20"))   # espera para completar o lote
+POSTGREST_ASYNC_TIMEOUT = float(os.getenv("POSTGREST_ASYNC_TIMEOUT", "60"))
+
+# Chave de ordenação: string (um registro) ou função registro -> chave (lista de registros)
+Chave = Union[str, Callable[[Dict], Optional[str]], None]
+
+
+class ErroPostgrest(Exception):
+    """Resposta de erro do PostgREST (status HTTP e corpo)."""
+
+    def __init__(self, status: int, corpo: str):
+        super().__init__(f"PostgREST {status}: {corpo[:500]}")
+        self.status = status
+        self.corpo = corpo
+
+
+def _exigir_httpx():
+    if httpx is None:
+        raise RuntimeError("httpx não instalado. Rode: pip install httpx")
+
+
+def executar_agora(funcao: Callable[[], Any]) -> Future:
+    """Executa `funcao` na hora e devolve o resultado (ou a exceção) num Future já resolvido."""
+    futuro = Future()
+    try:
+        futuro.set_result(funcao())
+    except Exception as e:
+        futuro.set_exception(e)
+    return futuro
+
+
+def encadear(futuro: Future, funcao: Callable[[Optional[BaseException]], Any]) -> Future:
+    """Future com `funcao(erro)` aplicada quando `futuro` termina (erro é None em caso de sucesso)."""
+    seguinte = Future()
+
+    def concluir(f: Future):
+        try:
+            seguinte.set_result(funcao(f.exception()))
+        except Exception as e:
+            seguinte.set_exception(e)
+
+    futuro.add_done_callback(concluir)
+    return seguinte
+
+
+def em_ordem(itens: Iterable, enviar: Callable[[Any], Future], limite: int) -> Iterator[Tuple[Any, Any]]:
+    """
+    Envia os itens com `enviar(item)` mantendo no máximo `limite` sem resultado, e
+    produz (item, resultado) na ordem de envio. O próximo item só é enviado quando
+    há espaço, então a memória fica limitada mesmo para milhões de itens.
+    """
+    pendentes = deque()
+    for item in itens:
+        pendentes.append((item, enviar(item)))
+        if len(pendentes) >= limite:
+            item_antigo, futuro = pendentes.popleft()
+            yield item_antigo, futuro.result()
+    while pendentes:
+        item_antigo, futuro = pendentes.popleft()
+        yield item_antigo, futuro.result()
+
+
+class BuscaEGravaPorChave:
+    """
+    Serializa busca + gravação da mesma chave entre threads. O escritor ordena as
+    gravações de uma chave, mas a busca do registro existente (síncrona) acontece
+    antes: duas notas iguais buscariam antes de a primeira gravação chegar ao banco
+    e as duas seriam inseridas. `aguardar(chave)` espera a gravação anterior da
+    chave terminar e devolve a vez; `liberar(chave, vez, futuro)` passa a vez
+    adiante quando `futuro` termina (ou na hora, sem futuro).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ultima: Dict[str, Future] = {}
+
+    def aguardar(self, chave: str) -> Future:
+        vez = Future()
+        with self._lock:
+            anterior = self._ultima.get(chave)
+            self._ultima[chave] = vez
+        if anterior is not None:
+            anterior.result()
+        return vez
+
+    def liberar(self, chave: str, vez: Future, futuro: Optional[Future] = None):
+        def soltar(_f=None):
+            with self._lock:
+                if self._ultima.get(chave) is vez:
+                    del self._ultima[chave]
+            vez.set_result(None)
+
+        if futuro is None:
+            soltar()
+        else:
+            futuro.add_done_callback(soltar)
+
+
+class _Lote:
+    """Linhas acumuladas de uma mesma (tabela, operação, on_conflict, colunas)."""
+
+    def __init__(self, identificacao: Tuple, seq: int, concluido: asyncio.Future):
+        self.identificacao = identificacao
+        self.seq = seq                      # lotes só esperam lotes de seq menor
+        self.concluido = concluido
+        self.linhas: List[Dict] = []
+        self.futuros: List[asyncio.Future] = []
+        self.depende: List[asyncio.Future] = []
+        self.temporizador = None
+
+
+class EscritorPostgrest:
+    """
+    Escritor assíncrono (uso dentro de um event loop). Para chamar de código
+    síncrono/threads, use EscritorEmSegundoPlano.
+    """
+
+    def __init__(self, url: str, chave_api: str, em_voo: int = POSTGREST_ASYNC_IN_FLIGHT,
+                 tamanho_lote: int = POSTGREST_ASYNC_CHUNK, espera_ms: float = POSTGREST_ASYNC_FLUSH_MS,
+                 timeout: float = POSTGREST_ASYNC_TIMEOUT):
+        _exigir_httpx()
+        self.base = f"{url.rstrip('/')}/rest/v1"
+        self.tamanho_lote = max(1, tamanho_lote)
+        self.espera = espera_ms / 1000
+        self._headers = {
+            "apikey": chave_api,
+            "Authorization": f"Bearer {chave_api}",
+            "Content-Type": "application/json",
+        }
+        self._cliente = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=em_voo, max_keepalive_connections=em_voo),
+        )
+        self._em_voo = asyncio.Semaphore(max(1, em_voo))
+        self._lotes: Dict[Tuple, List[_Lote]] = {}   # lotes abertos por identificação, do mais antigo
+        self._ultima: Dict[str, Tuple[int, asyncio.Future]] = {}   # chave -> (seq, conclusão) da última gravação
+        self._seq = 0
+        self._tarefas: set = set()
+
+    # ---------- superfície usada pelos scripts de sync ----------
+
+    def insert(self, tabela: str, registros, chave: Chave = None) -> asyncio.Future:
+        return self._acumular(tabela, "insert", None, registros, chave)
+
+    def upsert(self, tabela: str, registros, on_conflict: str, chave: Chave = None) -> asyncio.Future:
+        return self._acumular(tabela, "upsert", on_conflict, registros, chave)
+
+    def update(self, tabela: str, valores: Dict, filtros: Dict[str, Any],
+               chave: Optional[str] = None) -> asyncio.Future:
+        """PATCH com filtros de igualdade (ex.: {'id': record_id}); não entra em lote."""
+        loop = asyncio.get_running_loop()
+        concluido = loop.create_future()
+        depende = self._encadear_chaves([chave] if chave else [], self._proximo_seq(), concluido)
+        params = {coluna: f"eq.{valor}" for coluna, valor in filtros.items()}
+
+        async def enviar():
+            await self._aguardar(depende)
+            try:
+                await self._requisicao("PATCH", tabela, valores, params, "return=minimal")
+            finally:
+                self._resolver(concluido)
+
+        return self._agendar(enviar())
+
+    async def fechar(self):
+        """Envia os lotes pendentes, espera tudo que está em voo e fecha o cliente."""
+        for abertos in list(self._lotes.values()):
+            for lote in list(abertos):
+                self._despachar(lote)
+        while self._tarefas:
+            await asyncio.gather(*list(self._tarefas), return_exceptions=True)
+        await self._cliente.aclose()
+
+    # ---------- lotes ----------
+
+    def _acumular(self, tabela: str, operacao: str, on_conflict: Optional[str], registros,
+                  chave: Chave) -> asyncio.Future:
+        linhas = [registros] if isinstance(registros, dict) else list(registros)
+        chave_de = chave if callable(chave) else (lambda _linha: chave)
+        loop = asyncio.get_running_loop()
+        futuros = []
+        for linha in linhas:
+            chave_linha = chave_de(linha)
+            identificacao = (tabela, operacao, on_conflict, tuple(sorted(linha)))
+            anterior = self._ultima.get(chave_linha) if chave_linha is not None else None
+            seq_anterior = anterior[0] if anterior is not None else 0
+            # Primeiro lote aberto mais novo que a última gravação da chave. Se a chave já está
+            # num lote aberto, a linha vai para um lote seguinte, que espera aquele terminar;
+            # um lote só espera lotes mais antigos, então a ordem nunca trava.
+            abertos = self._lotes.setdefault(identificacao, [])
+            lote = next((aberto for aberto in abertos if aberto.seq > seq_anterior), None)
+            if lote is None:
+                lote = _Lote(identificacao, self._proximo_seq(), loop.create_future())
+                lote.temporizador = loop.call_later(self.espera, self._despachar, lote)
+                abertos.append(lote)
+            if chave_linha is not None:
+                lote.depende.extend(self._encadear_chaves([chave_linha], lote.seq, lote.concluido))
+            futuro = loop.create_future()
+            lote.linhas.append(linha)
+            lote.futuros.append(futuro)
+            futuros.append(futuro)
+            if len(lote.linhas) >= self.tamanho_lote:
+                self._despachar(lote)
+        if len(futuros) == 1:
+            return futuros[0]
+        return asyncio.ensure_future(asyncio.gather(*futuros))
+
+    def _despachar(self, lote: "_Lote"):
+        """Tira o lote da acumulação e agenda o envio (idempotente)."""
+        abertos = self._lotes.get(lote.identificacao, [])
+        if lote not in abertos:
+            return
+        abertos.remove(lote)
+        if not abertos:
+            del self._lotes[lote.identificacao]
+        lote.temporizador.cancel()
+        self._agendar(self._enviar_lote(lote))
+
+    async def _enviar_lote(self, lote: "_Lote"):
+        await self._aguardar(lote.depende)
+        tabela, operacao, on_conflict, _ = lote.identificacao
+        params, prefer = {}, "return=minimal"
+        if operacao == "upsert":
+            params["on_conflict"] = on_conflict
+            prefer += ",resolution=merge-duplicates"
+        try:
+            try:
+                await self._requisicao("POST", tabela, lote.linhas, params, prefer)
+                resultados = [None] * len(lote.linhas)
+            except ErroPostgrest as e:
+                if len(lote.linhas) == 1 or e.status >= 500:
+                    raise
+                # Uma linha inválida derruba o lote inteiro: reenvia uma a uma para isolar o erro
+                resultados = []
+                for linha in lote.linhas:
+                    try:
+                        await self._requisicao("POST", tabela, [linha], params, prefer)
+                        resultados.append(None)
+                    except ErroPostgrest as erro_linha:
+                        resultados.append(erro_linha)
+        except Exception as e:
+            resultados = [e] * len(lote.linhas)
+        finally:
+            self._resolver(lote.concluido)
+        for futuro, erro in zip(lote.futuros, resultados):
+            if futuro.done():
+                continue
+            if erro is None:
+                futuro.set_result(None)
+            else:
+                futuro.set_exception(erro)
+
+    # ---------- ordem por chave ----------
+
+    def _proximo_seq(self) -> int:
+        self._seq += 1
+        return self._seq
+
+    def _encadear_chaves(self, chaves: List[str], seq: int, concluido: asyncio.Future) -> List[asyncio.Future]:
+        """Registra `concluido` como a última gravação das chaves; retorna as anteriores a esperar."""
+        anteriores = []
+        for chave in chaves:
+            anterior = self._ultima.get(chave)
+            if anterior is not None and anterior[1] is not concluido and not anterior[1].done():
+                anteriores.append(anterior[1])
+            self._ultima[chave] = (seq, concluido)
+            concluido.add_done_callback(lambda _f, c=chave: self._esquecer(c, concluido))
+        return anteriores
+
+    def _esquecer(self, chave: str, concluido: asyncio.Future):
+        ultima = self._ultima.get(chave)
+        if ultima is not None and ultima[1] is concluido:
+            del self._ultima[chave]
+
+    @staticmethod
+    async def _aguardar(futuros: List[asyncio.Future]):
+        # Falha de uma gravação anterior não impede a seguinte (mesma semântica do sync)
+        if futuros:
+            await asyncio.gather(*futuros, return_exceptions=True)
+
+    @staticmethod
+    def _resolver(futuro: asyncio.Future):
+        if not futuro.done():
+            futuro.set_result(None)
+
+    # ---------- HTTP ----------
+
+    def _agendar(self, corrotina) -> asyncio.Task:
+        tarefa = asyncio.ensure_future(corrotina)
+        self._tarefas.add(tarefa)
+        tarefa.add_done_callback(self._tarefas.discard)
+        return tarefa
+
+    async def _requisicao(self, metodo: str, tabela: str, corpo, params: Dict, prefer: str):
+        async with self._em_voo:
+            resposta = await self._cliente.request(
+                metodo, f"{self.base}/{tabela}", json=corpo, params=params,
+                headers={**self._headers, "Prefer": prefer},
+            )
+        if resposta.status_code >= 300:
+            raise ErroPostgrest(resposta.status_code, resposta.text)
+
+
+class EscritorEmSegundoPlano:
+    """
+    EscritorPostgrest num event loop em thread própria, para os scripts síncronos.
+    Os métodos podem ser chamados de qualquer thread e retornam concurrent.futures.Future.
+    """
+
+    def __init__(self, url: str, chave_api: str, **opcoes):
+        _exigir_httpx()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True, name="postgrest-async")
+        self._thread.start()
+        self.em_voo = opcoes.get("em_voo", POSTGREST_ASYNC_IN_FLIGHT)
+        self.tamanho_lote = opcoes.get("tamanho_lote", POSTGREST_ASYNC_CHUNK)
+
+        async def criar():
+            return EscritorPostgrest(url, chave_api, **opcoes)
+
+        self._escritor = asyncio.run_coroutine_threadsafe(criar(), self._loop).result()
+
+    @classmethod
+    def do_ambiente(cls, **opcoes) -> "EscritorEmSegundoPlano":
+        return cls(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE_KEY"), **opcoes)
+
+    @property
+    def limite_pendentes(self) -> int:
+        """Quantas gravações vale manter sem resultado para ocupar todos os lotes em voo."""
+        return self.em_voo * self.tamanho_lote * 2
+
+    def insert(self, tabela: str, registros, chave: Chave = None) -> Future:
+        return self._chamar(self._escritor.insert, tabela, registros, chave=chave)
+
+    def upsert(self, tabela: str, registros, on_conflict: str, chave: Chave = None) -> Future:
+        return self._chamar(self._escritor.upsert, tabela, registros, on_conflict, chave=chave)
+
+    def update(self, tabela: str, valores: Dict, filtros: Dict[str, Any], chave: Optional[str] = None) -> Future:
+        return self._chamar(self._escritor.update, tabela, valores, filtros, chave=chave)
+
+    def fechar(self):
+        if not self._loop.is_running():
+            return
+        asyncio.run_coroutine_threadsafe(self._escritor.fechar(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, valor, tb):
+        self.fechar()
+        return False
+
+    def _chamar(self, metodo, *args, **kwargs) -> Future:
+        async def chamar():
+            return await metodo(*args, **kwargs)
+
+        return asyncio.run_coroutine_threadsafe(chamar(), self._loop)
@@ -0,0 +1,358 @@
+"""
+Conciliação entre o bucket (notas/) e os caminhos gravados em service_notes.
+
+Lista o S3 e lê as colunas s3_path_pdf/s3_path_xml, as duas em ordem de chave
+(a listagem do S3 já vem em ordem binária; o banco é lido com COLLATE "C", ver
+supabase/migrations/20261019_reconcile_paths.sql), e faz um merge-join numa
+única passada, sem HEAD por nota e com memória constante. Encontra:
+
+  objeto_sem_registro   arquivo no bucket que nenhuma nota referencia;
+  caminho_inexistente   nota apontando para um arquivo que não existe mais;
+  caminho_repetido      mais de uma nota apontando para o mesmo arquivo;
+  sem_xml / sem_pdf     nota com só um dos arquivos; `encontrado` traz o irmão
+                        (mesmo nome, outra extensão) quando ele está órfão no bucket.
+
+O relatório é um JSONL (um achado por linha, resumo na última) e serve de fila
+de correções: --corrigir aplica em lote as correções de caminho e
+--importar-orfaos cria as notas dos arquivos órfãos, na mesma execução ou depois
+com --aplicar <relatorio>.
+
+Uso:
+    python reconcile.py                                   # só o relatório
+    python reconcile.py --prefix notas/11222333000181/ --corrigir
+    python reconcile.py --aplicar .cache/reconcile/relatorio.jsonl --corrigir --importar-orfaos
+"""
+import argparse
+import heapq
+import json
+import os
+import sys
+import time
+from collections import Counter, OrderedDict, deque
+from itertools import chain
+from operator import itemgetter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from table_scan import antecipar
+
+PAGE_SIZE = int(os.getenv("RECONCILE_PAGE_SIZE", "1000"))
+TAMANHO_LOTE = int(os.getenv("RECONCILE_BATCH_SIZE", "500"))
+COLUNAS = ("s3_path_pdf", "s3_path_xml")
+RELATORIO_PADRAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "reconcile", "relatorio.jsonl")
+
+# Órfãos ficam retidos por algumas posições antes de ir ao relatório: o PDF vem
+# logo antes do XML na listagem, e uma nota só com o XML pode reivindicá-lo
+JANELA_ORFAOS = 64
+
+# (caminho, coluna, id, nota_id, caminho da outra coluna)
+Registro = Tuple[str, str, str, str, Optional[str]]
+
+
+def _irmao(caminho: str) -> Optional[str]:
+    """Mesmo arquivo com a outra extensão (PDF <-> XML)."""
+    if caminho.endswith(".pdf"):
+        return caminho[:-3] + "xml"
+    if caminho.endswith(".xml"):
+        return caminho[:-3] + "pdf"
+    return None
+
+
+def _em_ordem(itens: Iterable, chave, origem: str) -> Iterator:
+    """Confere que a origem vem ordenada; o merge-join daria resultados errados caso contrário."""
+    anterior = None
+    for item in itens:
+        atual = chave(item)
+        if anterior is not None and atual < anterior:
+            raise RuntimeError(f"{origem} fora de ordem: {atual!r} depois de {anterior!r}")
+        anterior = atual
+        yield item
+
+
+# ---------- Origens ----------
+
+def paginas_s3(s3_client, bucket: str, prefixo: str) -> Iterator[List[str]]:
+    """Chaves de PDF/XML do prefixo, uma página da listagem por vez (ordem binária do S3)."""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefixo):
+        yield [obj["Key"] for obj in page.get("Contents", [])
+               if obj["Key"].endswith(".pdf") or obj["Key"].endswith(".xml")]
+
+
+class FonteCaminhos:
+    """Caminhos gravados em service_notes, paginados por chave (caminho, id) via RPC."""
+
+    def __init__(self, supabase, prefixo: str = "notas/", tamanho_pagina: int = PAGE_SIZE):
+        self.supabase = supabase
+        self.prefixo = prefixo
+        self.tamanho_pagina = tamanho_pagina
+
+    def paginas(self, coluna: str) -> Iterator[List[Registro]]:
+        apos_caminho, apos_id = None, None
+        while True:
+            pagina = self.supabase.rpc("reconcile_service_note_paths", {
+                "p_coluna": coluna,
+                "p_prefixo": self.prefixo,
+                "p_apos_caminho": apos_caminho,
+                "p_apos_id": apos_id,
+                "p_limite": self.tamanho_pagina,
+            }).execute().data or []
+            yield [(linha["caminho"], coluna, linha["id"], linha["nota_id"], linha["outro"]) for linha in pagina]
+            if len(pagina) < self.tamanho_pagina:
+                return
+            apos_caminho, apos_id = pagina[-1]["caminho"], pagina[-1]["id"]
+
+    def registros(self) -> Iterator[Registro]:
+        """As duas colunas intercaladas numa única sequência ordenada por caminho."""
+        # Próximas páginas buscadas numa thread enquanto o merge consome a atual
+        colunas = [_em_ordem(chain.from_iterable(antecipar(self.paginas(coluna), 2)), itemgetter(0), coluna)
+                   for coluna in COLUNAS]
+        return heapq.merge(*colunas, key=itemgetter(0))
+
+
+# ---------- Merge-join ----------
+
+def conciliar(objetos: Iterable[str], registros: Iterable[Registro], contagem: Counter) -> Iterator[Dict]:
+    """
+    Percorre as duas sequências ordenadas uma única vez e gera os achados.
+    Memória constante: só guarda as notas da posição atual, os PDFs sem XML
+    esperando o irmão (que vem logo adiante) e a janela de órfãos recentes.
+    """
+    objetos = _em_ordem(objetos, lambda chave: chave, "listagem do S3")
+    registros = iter(registros)
+    objeto = next(objetos, None)
+    registro = next(registros, None)
+    aguardando_xml: deque = deque()   # (caminho do XML irmão, registro do PDF)
+    orfaos: "OrderedDict[str, None]" = OrderedDict()
+
+    def sem_xml(pdf: Registro, encontrado: Optional[str]) -> Dict:
+        contagem["sem_xml"] += 1
+        return {"tipo": "sem_xml", "id": pdf[2], "nota_id": pdf[3], "caminho_pdf": pdf[0], "encontrado": encontrado}
+
+    def orfao(caminho: str) -> Dict:
+        contagem["objeto_sem_registro"] += 1
+        return {"tipo": "objeto_sem_registro", "caminho": caminho}
+
+    def verificar_par(registro: Registro) -> Iterator[Dict]:
+        caminho, coluna, id_, nota_id, outro = registro
+        if outro is not None:
+            return
+        irmao = _irmao(caminho)
+        if coluna == "s3_path_pdf":
+            if irmao is None:
+                yield sem_xml(registro, None)
+            else:
+                aguardando_xml.append((irmao, registro))
+            return
+        # XML sem PDF: o PDF irmão vem antes na listagem, já passou pela janela de órfãos
+        encontrado = irmao if irmao in orfaos else None
+        if encontrado:
+            del orfaos[encontrado]
+        contagem["sem_pdf"] += 1
+        yield {"tipo": "sem_pdf", "id": id_, "nota_id": nota_id, "caminho_xml": caminho, "encontrado": encontrado}
+
+    while objeto is not None or registro is not None:
+        posicao = objeto if registro is None or (objeto is not None and objeto < registro[0]) else registro[0]
+        # PDFs cujo XML irmão já ficou para trás na listagem sem aparecer
+        while aguardando_xml and aguardando_xml[0][0] < posicao:
+            yield sem_xml(aguardando_xml.popleft()[1], None)
+
+        if registro is None or (objeto is not None and objeto < registro[0]):
+            contagem["objetos"] += 1
+            if aguardando_xml and aguardando_xml[0][0] == objeto:
+                # XML que faltava na nota do PDF
+                yield sem_xml(aguardando_xml.popleft()[1], objeto)
+            else:
+                orfaos[objeto] = None
+                if len(orfaos) > JANELA_ORFAOS:
+                    yield orfao(orfaos.popitem(last=False)[0])
+            objeto = next(objetos, None)
+            continue
+
+        # Todas as notas que apontam para este caminho
+        caminho = registro[0]
+        mesmo_caminho = []
+        while registro is not None and registro[0] == caminho:
+            mesmo_caminho.append(registro)
+            registro = next(registros, None)
+        contagem["registros"] += len(mesmo_caminho)
+
+        if objeto == caminho:
+            contagem["objetos"] += 1
+            objeto = next(objetos, None)
+            # O arquivo existe, mas já é de outra nota: não serve de irmão
+            while aguardando_xml and aguardando_xml[0][0] == caminho:
+                yield sem_xml(aguardando_xml.popleft()[1], None)
+        else:
+            for caminho_, coluna, id_, nota_id, _ in mesmo_caminho:
+                contagem["caminho_inexistente"] += 1
+                yield {"tipo": "caminho_inexistente", "id": id_, "nota_id": nota_id,
+                       "coluna": coluna, "caminho": caminho_}
+        if len(mesmo_caminho) > 1:
+            contagem["caminho_repetido"] += 1
+            yield {"tipo": "caminho_repetido", "caminho": caminho, "total": len(mesmo_caminho),
+                   "notas": [{"id": r[2], "nota_id": r[3], "coluna": r[1]} for r in mesmo_caminho[:20]]}
+        for r in mesmo_caminho:
+            yield from verificar_par(r)
+
+    while aguardando_xml:
+        yield sem_xml(aguardando_xml.popleft()[1], None)
+    for caminho in orfaos:
+        yield orfao(caminho)
+
+
+def gerar_relatorio(objetos: Iterable[str], registros: Iterable[Registro], destino: str) -> Counter:
+    """Grava os achados em JSONL (resumo na última linha) e retorna a contagem."""
+    os.makedirs(os.path.dirname(destino) or ".", exist_ok=True)
+    contagem = Counter()
+    inicio = ultimo_aviso = time.perf_counter()
+    tmp = destino + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for achado in conciliar(objetos, registros, contagem):
+            f.write(json.dumps(achado, ensure_ascii=False) + "\n")
+            if time.perf_counter() - ultimo_aviso >= 30:
+                ultimo_aviso = time.perf_counter()
+                print(f"  🔎 {contagem['objetos']} objetos | {contagem['registros']} caminhos no banco")
+        f.write(json.dumps({"tipo": "resumo", **contagem, "segundos": round(time.perf_counter() - inicio, 1)}) + "\n")
+    os.replace(tmp, destino)
+    return contagem
+
+
+def ler_relatorio(caminho: str) -> Iterator[Dict]:
+    with open(caminho, encoding="utf-8") as f:
+        for linha in f:
+            if linha.strip():
+                achado = json.loads(linha)
+                if achado.get("tipo") != "resumo":
+                    yield achado
+
+
+# ---------- Correções ----------
+
+def correcao_de_caminho(achado: Dict) -> Optional[Dict]:
+    """Item para reconcile_fix_service_note_paths; caminho None = arquivo não existe mais."""
+    if achado["tipo"] == "caminho_inexistente":
+        return {"id": achado["id"], "coluna": achado["coluna"], "caminho": None}
+    if achado["tipo"] == "sem_xml" and achado.get("encontrado"):
+        return {"id": achado["id"], "coluna": "s3_path_xml", "caminho": achado["encontrado"]}
+    if achado["tipo"] == "sem_pdf" and achado.get("encontrado"):
+        return {"id": achado["id"], "coluna": "s3_path_pdf", "caminho": achado["encontrado"]}
+    return None
+
+
+def corrigir_caminhos(supabase, achados: Iterable[Dict], tamanho_lote: int = TAMANHO_LOTE) -> int:
+    """Aplica as correções de caminho em lotes (uma chamada RPC por lote)."""
+    lote, corrigidas = [], 0
+
+    def enviar():
+        nonlocal corrigidas
+        corrigidas += supabase.rpc("reconcile_fix_service_note_paths", {"itens": lote}).execute().data or 0
+        lote.clear()
+
+    for achado in achados:
+        item = correcao_de_caminho(achado)
+        if item:
+            lote.append(item)
+            if len(lote) >= tamanho_lote:
+                enviar()
+    if lote:
+        enviar()
+    return corrigidas
+
+
+def importar_orfaos(achados: Iterable[Dict], tamanho_lote: int = TAMANHO_LOTE) -> Dict[str, int]:
+    """
+    Cria/atualiza as notas dos arquivos órfãos pelo mesmo caminho do sync do S3.
+    Os órfãos vêm em ordem de chave, então PDF e XML da mesma nota ficam juntos;
+    o lote só fecha na troca de nota, e o irmão que ficou de fora é procurado no bucket.
+    """
+    from s3_event_ingest import completar_par
+    from sync_notas_s3_supabase import group_files_by_nota, meses_alterados, supabase, sync_nota_to_supabase
+    from monthly_summary import atualizar_resumo_mensal
+
+    resultado = {"notas": 0, "erros": 0}
+    lote: List[str] = []
+
+    def enviar():
+        for nota in (n.como_dict() for n in group_files_by_nota(lote).values()):
+            if sync_nota_to_supabase(completar_par(nota)):
+                resultado["notas"] += 1
+            else:
+                resultado["erros"] += 1
+        lote.clear()
+
+    for achado in achados:
+        if achado["tipo"] != "objeto_sem_registro":
+            continue
+        caminho = achado["caminho"]
+        if len(lote) >= tamanho_lote and lote[-1][:-4] != caminho[:-4]:
+            enviar()
+        lote.append(caminho)
+    if lote:
+        enviar()
+    atualizar_resumo_mensal(supabase, meses_alterados)
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concilia os arquivos do bucket com os caminhos em service_notes.")
+    parser.add_argument("--prefix", default="notas/", help="Prefixo do bucket a conciliar")
+    parser.add_argument("--relatorio", default=RELATORIO_PADRAO, help="Arquivo JSONL do relatório")
+    parser.add_argument("--aplicar", metavar="RELATORIO",
+                        help="Não concilia: aplica as correções de um relatório já gerado")
+    parser.add_argument("--corrigir", action="store_true",
+                        help="Aplica as correções de caminho (arquivo ausente, irmão encontrado)")
+    parser.add_argument("--importar-orfaos", action="store_true",
+                        help="Cria as notas dos arquivos do bucket sem registro")
+    args = parser.parse_args()
+
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    if current_dir in sys.path:
+        sys.path.remove(current_dir)
+    from supabase import create_client
+    from dotenv import load_dotenv
+    sys.path.insert(0, current_dir)
+
+    load_dotenv(os.path.join(current_dir, "scripts", ".env"))
+    supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE_KEY"))
+
+    print("=" * 80)
+    print("🧮 CONCILIAÇÃO: S3 ↔ SERVICE_NOTES")
+    print("=" * 80)
+
+    relatorio = args.aplicar
+    if not relatorio:
+        import boto3
+        from botocore.config import Config
+
+        s3_client = boto3.client(
+            "s3",
+            aws_access_key_id=os.getenv("AWS_ACCESS_KEY"),
+            aws_secret_access_key=os.getenv("AWS_SECRET_KEY"),
+            region_name=os.getenv("AWS_REGION", "sa-east-1"),
+            config=Config(signature_version="s3v4"),
+        )
+        bucket = os.getenv("AWS_BUCKET", "plug-notas")
+        print(f"🔍 Conciliando {bucket}/{args.prefix}...")
+        # S3 e banco esperam a rede ao mesmo tempo
+        objetos = chain.from_iterable(antecipar(paginas_s3(s3_client, bucket, args.prefix), 2))
+        contagem = gerar_relatorio(objetos, FonteCaminhos(supabase, args.prefix).registros(), args.relatorio)
+        relatorio = args.relatorio
+
+        print(f"\n📊 Objetos no bucket: {contagem['objetos']} | Caminhos no banco: {contagem['registros']}")
+        print(f"  📄 Objetos sem registro: {contagem['objeto_sem_registro']}")
+        print(f"  ❌ Caminhos inexistentes: {contagem['caminho_inexistente']}")
+        print(f"  🔁 Caminhos repetidos: {contagem['caminho_repetido']}")
+        print(f"  ⚠️  Notas sem XML: {contagem['sem_xml']} | sem PDF: {contagem['sem_pdf']}")
+        print(f"📝 Relatório: {relatorio}")
+
+    if args.corrigir:
+        print("\n🔧 Corrigindo caminhos...")
+        print(f"✅ Notas corrigidas: {corrigir_caminhos(supabase, ler_relatorio(relatorio))}")
+    if args.importar_orfaos:
+        print("\n📥 Importando arquivos sem registro...")
+        resultado = importar_orfaos(ler_relatorio(relatorio))
+        print(f"✅ Notas importadas: {resultado['notas']} | Erros: {resultado['erros']}")
+
+
+if __name__ == "__main__":
+    main()
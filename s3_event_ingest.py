@@ -0,0 +1,311 @@
+"""
+Ingestão orientada a eventos: notificações ObjectCreated do S3 -> service_notes.
+
+Em vez de listar o bucket inteiro, consome as mensagens de evento do S3
+(JSON no formato das mensagens SQS, com ou sem envelope SNS) e faz o upsert
+só das notas afetadas, usando parse_s3_key e sync_nota_to_supabase.
+
+- PDF e XML da mesma nota chegando juntos viram um único upsert; se só um dos
+  arquivos chegou, o outro é procurado no bucket para não apagar o caminho já gravado.
+- Eventos repetidos (entrega "at least once") são ignorados pelo sequencer do S3,
+  guardado em .cache/s3_events.sqlite3.
+- XMLs regravados pela recompressão (s3_xml_gzip --recomprimir) não são notas
+  novas: o evento é descartado pelo metadado que a recompressão grava.
+- A origem é plugável: fila SQS ou arquivo JSONL (uma mensagem por linha; '-' = stdin).
+
+Uso:
+    python s3_event_ingest.py --sqs-url https://sqs.sa-east-1.amazonaws.com/123/notas-eventos
+    python s3_event_ingest.py --arquivo eventos.jsonl
+"""
+import argparse
+import boto3
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Tuple
+from urllib.parse import unquote_plus
+
+from sync_notas_s3_supabase import (
+    BUCKET_NAME, REGION_NAME, AWS_ACCESS_KEY, AWS_SECRET_KEY,
+    group_files_by_nota, meses_alterados, s3_client, supabase, sync_nota_to_supabase
+)
+from monthly_summary import atualizar_resumo_mensal
+from s3_xml_gzip import METADADO_RECOMPRESSAO
+
+EVENTS_DB_PATH = os.getenv(
+    "S3_EVENTS_DB_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "s3_events.sqlite3"),
+)
+# Quanto tempo esperar por mais mensagens para juntar PDF e XML no mesmo lote
+JANELA_COALESCENCIA = float(os.getenv("S3_EVENTS_COALESCE_SECONDS", "2"))
+RETENCAO_DIAS = int(os.getenv("S3_EVENTS_RETENTION_DAYS", "7"))
+
+# (chave do objeto, sequencer do evento)
+EventoObjeto = Tuple[str, str]
+
+
+class Mensagem:
+    """Mensagem recebida da origem; `confirmar()` a remove da origem após o processamento."""
+
+    def __init__(self, corpo: str, confirmar=None):
+        self.corpo = corpo
+        self._confirmar = confirmar
+
+    def confirmar(self):
+        if self._confirmar:
+            self._confirmar()
+
+
+class FonteArquivo:
+    """Origem local (testes/replay): arquivo JSONL com um corpo de mensagem por linha."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._linhas = None
+
+    def receber(self, max_mensagens: int = 10, espera: float = 0) -> List[Mensagem]:
+        if self._linhas is None:
+            arquivo = sys.stdin if self.path == "-" else open(self.path, encoding="utf-8")
+            self._linhas = (linha.strip() for linha in arquivo)
+        mensagens = []
+        for linha in self._linhas:
+            if linha:
+                mensagens.append(Mensagem(linha))
+            if len(mensagens) >= max_mensagens:
+                break
+        return mensagens
+
+    # Arquivo termina quando as linhas acabam
+    finita = True
+
+
+class FonteSQS:
+    """Fila SQS assinada nas notificações ObjectCreated do bucket (long polling)."""
+
+    def __init__(self, queue_url: str):
+        self.queue_url = queue_url
+        self.sqs = boto3.client(
+            "sqs",
+            aws_access_key_id=AWS_ACCESS_KEY,
+            aws_secret_access_key=AWS_SECRET_KEY,
+            region_name=REGION_NAME,
+        )
+
+    def receber(self, max_mensagens: int = 10, espera: float = 20) -> List[Mensagem]:
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(10, max_mensagens),
+            WaitTimeSeconds=int(espera),
+        )
+        return [
+            Mensagem(m["Body"], lambda handle=m["ReceiptHandle"]: self.sqs.delete_message(
+                QueueUrl=self.queue_url, ReceiptHandle=handle))
+            for m in response.get("Messages", [])
+        ]
+
+    finita = False
+
+
+def extrair_eventos(corpo: str) -> List[EventoObjeto]:
+    """Eventos ObjectCreated de PDF/XML do bucket contidos no corpo da mensagem."""
+    try:
+        dados = json.loads(corpo)
+    except ValueError:
+        print(f"  ⚠️  Mensagem ignorada (JSON inválido): {corpo[:200]}")
+        return []
+    # Envelope SNS -> SQS
+    if isinstance(dados, dict) and dados.get("Type") == "Notification" and isinstance(dados.get("Message"), str):
+        return extrair_eventos(dados["Message"])
+
+    eventos = []
+    for record in dados.get("Records", []) if isinstance(dados, dict) else []:
+        if not str(record.get("eventName", "")).startswith("ObjectCreated"):
+            continue
+        s3 = record.get("s3", {})
+        if s3.get("bucket", {}).get("name", BUCKET_NAME) != BUCKET_NAME:
+            continue
+        chave = unquote_plus(s3.get("object", {}).get("key", ""))
+        if chave.endswith(".pdf") or chave.endswith(".xml"):
+            eventos.append((chave, s3.get("object", {}).get("sequencer", "")))
+    return eventos
+
+
+def _sequencer_maior(novo: str, anterior: str) -> bool:
+    """Compara sequencers do S3 (hex de tamanho variável: completa o menor com zeros à direita)."""
+    tamanho = max(len(novo), len(anterior))
+    return novo.ljust(tamanho, "0").upper() > anterior.ljust(tamanho, "0").upper()
+
+
+class RegistroEventos:
+    """Último sequencer processado por chave, para descartar entregas duplicadas."""
+
+    def __init__(self, path: str = EVENTS_DB_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS eventos (chave TEXT PRIMARY KEY, sequencer TEXT NOT NULL, processado_em TEXT NOT NULL)"
+        )
+
+    def novo(self, chave: str, sequencer: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT sequencer FROM eventos WHERE chave = ?", (chave,)).fetchone()
+        if not row:
+            return True
+        # Sem sequencer não dá para ordenar: trata como novo (o upsert é idempotente)
+        return not sequencer or _sequencer_maior(sequencer, row[0])
+
+    def marcar(self, eventos: Iterable[EventoObjeto]):
+        agora = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO eventos (chave, sequencer, processado_em) VALUES (?, ?, ?) "
+                "ON CONFLICT(chave) DO UPDATE SET sequencer = excluded.sequencer, processado_em = excluded.processado_em",
+                [(chave, sequencer, agora) for chave, sequencer in eventos],
+            )
+
+    def limpar_antigos(self, dias: int = RETENCAO_DIAS) -> int:
+        limite = (datetime.now(timezone.utc) - timedelta(days=dias)).isoformat()
+        with self._lock:
+            return self._conn.execute("DELETE FROM eventos WHERE processado_em < ?", (limite,)).rowcount
+
+
+def _objeto_existe(chave: str) -> bool:
+    try:
+        s3_client.head_object(Bucket=BUCKET_NAME, Key=chave)
+        return True
+    except Exception:
+        return False
+
+
+def _regravado_pela_recompressao(chave: str) -> bool:
+    """O XML foi regravado pela recompressão (o evento não traz metadados: consulta o objeto)."""
+    try:
+        metadados = s3_client.head_object(Bucket=BUCKET_NAME, Key=chave).get("Metadata", {})
+    except Exception:
+        return False
+    return METADADO_RECOMPRESSAO in metadados
+
+
+def completar_par(nota: Dict) -> Dict:
+    """Se o evento trouxe só o PDF (ou só o XML), procura o outro arquivo no bucket."""
+    for tipo, outro in (("pdf", "xml"), ("xml", "pdf")):
+        caminho, campo_outro = nota[f"s3_path_{tipo}"], f"s3_path_{outro}"
+        if caminho and not nota[campo_outro]:
+            irmao = caminho[: -len(tipo)] + outro
+            if _objeto_existe(irmao):
+                nota[campo_outro] = irmao
+    return nota
+
+
+def processar_lote(mensagens: List[Mensagem], registro: RegistroEventos) -> Dict[str, int]:
+    """
+    Junta os eventos do lote por nota, faz um upsert por nota e confirma as
+    mensagens cujas notas foram todas gravadas (as demais voltam para a fila).
+    """
+    resultado = {"mensagens": len(mensagens), "notas": 0, "duplicados": 0, "erros": 0, "recomprimidos": 0}
+    eventos_por_mensagem = []
+    ultimos: Dict[str, str] = {}
+    for mensagem in mensagens:
+        eventos = extrair_eventos(mensagem.corpo)
+        eventos_por_mensagem.append(eventos)
+        for chave, sequencer in eventos:
+            if chave not in ultimos or _sequencer_maior(sequencer, ultimos[chave]):
+                ultimos[chave] = sequencer
+
+    novos = {chave: seq for chave, seq in ultimos.items() if registro.novo(chave, seq)}
+    resultado["duplicados"] = sum(len(e) for e in eventos_por_mensagem) - len(novos)
+
+    # Só um XML sem o PDF no lote pode ser regravação da recompressão (consulta um objeto por evento desses)
+    recomprimidos = [
+        (chave, seq) for chave, seq in novos.items()
+        if chave.endswith(".xml") and chave[:-3] + "pdf" not in novos and _regravado_pela_recompressao(chave)
+    ]
+    if recomprimidos:
+        registro.marcar(recomprimidos)
+        for chave, _ in recomprimidos:
+            del novos[chave]
+        resultado["recomprimidos"] = len(recomprimidos)
+
+    falhas = set()
+    for nota in (n.como_dict() for n in group_files_by_nota(novos).values()):
+        caminhos = [c for c in (nota["s3_path_pdf"], nota["s3_path_xml"]) if c]
+        if sync_nota_to_supabase(completar_par(nota)):
+            resultado["notas"] += 1
+            registro.marcar((c, novos[c]) for c in caminhos)
+        else:
+            resultado["erros"] += 1
+            falhas.update(caminhos)
+
+    atualizar_resumo_mensal(supabase, meses_alterados)
+
+    for mensagem, eventos in zip(mensagens, eventos_por_mensagem):
+        if not any(chave in falhas for chave, _ in eventos):
+            mensagem.confirmar()
+    return resultado
+
+
+def consumir(fonte, registro: RegistroEventos, uma_vez: bool = False, tamanho_lote: int = 10):
+    """Loop de consumo: recebe, espera a janela de coalescência e processa em lotes."""
+    total = {"mensagens": 0, "notas": 0, "duplicados": 0, "erros": 0, "recomprimidos": 0}
+    try:
+        while True:
+            mensagens = fonte.receber(tamanho_lote)
+            if mensagens and JANELA_COALESCENCIA > 0 and not fonte.finita:
+                # O par PDF/XML costuma chegar em mensagens separadas com milissegundos de diferença
+                limite = time.monotonic() + JANELA_COALESCENCIA
+                while len(mensagens) < tamanho_lote and time.monotonic() < limite:
+                    extras = fonte.receber(tamanho_lote - len(mensagens), espera=max(0, limite - time.monotonic()))
+                    if not extras:
+                        break
+                    mensagens.extend(extras)
+            if not mensagens:
+                if uma_vez or fonte.finita:
+                    break
+                continue
+
+            resultado = processar_lote(mensagens, registro)
+            for campo, valor in resultado.items():
+                total[campo] += valor
+            print(f"📨 Mensagens: {resultado['mensagens']} | Notas: {resultado['notas']} | "
+                  f"Duplicados: {resultado['duplicados']} | Recomprimidos: {resultado['recomprimidos']} | "
+                  f"Erros: {resultado['erros']}")
+    except KeyboardInterrupt:
+        print("\n⏹️  Interrompido.")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingestão de notas a partir de eventos ObjectCreated do S3.")
+    origem = parser.add_mutually_exclusive_group()
+    origem.add_argument("--sqs-url", default=os.getenv("S3_EVENTS_QUEUE_URL"),
+                        help="URL da fila SQS com as notificações do bucket")
+    origem.add_argument("--arquivo", help="Arquivo JSONL com uma mensagem por linha ('-' para stdin)")
+    parser.add_argument("--uma-vez", action="store_true", help="Esvazia a fila uma vez e sai")
+    args = parser.parse_args()
+
+    if args.arquivo:
+        fonte = FonteArquivo(args.arquivo)
+    elif args.sqs_url:
+        fonte = FonteSQS(args.sqs_url)
+    else:
+        parser.error("Informe --sqs-url (ou S3_EVENTS_QUEUE_URL) ou --arquivo")
+
+    registro = RegistroEventos()
+    registro.limpar_antigos()
+
+    print("=" * 80)
+    print("📡 INGESTÃO POR EVENTOS: S3 → SUPABASE")
+    print("=" * 80)
+    total = consumir(fonte, registro, uma_vez=args.uma_vez)
+    print(f"\n✅ Notas gravadas: {total['notas']} | Duplicados ignorados: {total['duplicados']} | "
+          f"Recompressões ignoradas: {total['recomprimidos']} | Erros: {total['erros']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Armazenamento dos XMLs das notas comprimidos com gzip no S3.
+
+Os objetos são gravados com `Content-Encoding: gzip` e `Content-Type: application/xml`,
+então os links pré-assinados continuam entregando o XML puro ao navegador (que
+descomprime sozinho). O tamanho original fica no metadado `x-amz-meta-original-size`.
+Quem lê o objeto pelo SDK usa `ler_objeto_s3`, que descomprime quando necessário.
+
+Recompressão dos objetos já existentes (retomável, com checkpoint local):
+    python s3_xml_gzip.py --recomprimir
+    python s3_xml_gzip.py --recomprimir --prefix notas/25249058000102/ --workers 16
+
+A recompressão regrava cada XML com put_object, o que dispara um evento
+ObjectCreated por objeto. Os objetos regravados levam o metadado
+`x-amz-meta-recomprimido`, e o s3_event_ingest descarta esses eventos em vez de
+regravar a nota. Se outro consumidor recebe os eventos do bucket, pause a
+notificação durante a recompressão. Tags, storage class e metadados do objeto
+original são mantidos.
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple
+from urllib.parse import quote, urlencode
+
+# Ativa a compressão nos uploads de XML (S3_XML_GZIP=1)
+COMPRIMIR_XML = os.getenv("S3_XML_GZIP", "0").lower() in ("1", "true", "sim")
+NIVEL_GZIP = int(os.getenv("S3_XML_GZIP_LEVEL", "9"))
+RECOMPRESS_WORKERS = int(os.getenv("S3_RECOMPRESS_WORKERS", "8"))
+CHECKPOINT_PATH = os.getenv(
+    "S3_RECOMPRESS_CHECKPOINT",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "xml_recompress.json"),
+)
+# Marca os objetos regravados pela recompressão (o evento ObjectCreated deles não é uma nota nova)
+METADADO_RECOMPRESSAO = "recomprimido"
+# Cabeçalhos do objeto original mantidos na regravação
+_CABECALHOS_MANTIDOS = ("CacheControl", "ContentDisposition", "ContentLanguage", "StorageClass")
+
+
+def parametros_upload(key: str, content: bytes, comprimir: bool = COMPRIMIR_XML) -> Tuple[bytes, Dict]:
+    """Body e argumentos extras do put_object: XMLs vão com gzip quando a opção está ativa."""
+    if not (comprimir and key.endswith(".xml")):
+        return content, {}
+    return gzip.compress(content, compresslevel=NIVEL_GZIP), {
+        "ContentType": "application/xml",
+        "ContentEncoding": "gzip",
+        "Metadata": {"original-size": str(len(content))},
+    }
+
+
+def descomprimir(body: bytes, content_encoding: str = None) -> bytes:
+    """Devolve o conteúdo original de um objeto lido do S3."""
+    if content_encoding == "gzip" or body[:2] == b"\x1f\x8b":
+        return gzip.decompress(body)
+    return body
+
+
+def ler_objeto_s3(s3_client, bucket: str, key: str) -> bytes:
+    """get_object + descompressão transparente (o SDK não descomprime Content-Encoding)."""
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    return descomprimir(response["Body"].read(), response.get("ContentEncoding"))
+
+
+def recomprimir_objeto(s3_client, bucket: str, key: str) -> Dict:
+    """
+    Regrava um XML existente com gzip, com as tags, a storage class e os metadados
+    do original. Retorna bytes antes/depois (iguais se já estava comprimido).
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    body = response["Body"].read()
+    if response.get("ContentEncoding") == "gzip":
+        return {"key": key, "antes": len(body), "depois": len(body), "comprimido": False}
+
+    novo, extras = parametros_upload(key, body, comprimir=True)
+    if len(novo) >= len(body):
+        return {"key": key, "antes": len(body), "depois": len(body), "comprimido": False}
+    extras["Metadata"] = {**response.get("Metadata", {}), **extras["Metadata"], METADADO_RECOMPRESSAO: "1"}
+    for campo in _CABECALHOS_MANTIDOS:
+        if response.get(campo):
+            extras[campo] = response[campo]
+    if response.get("TagCount"):
+        tags = s3_client.get_object_tagging(Bucket=bucket, Key=key)["TagSet"]
+        extras["Tagging"] = urlencode({tag["Key"]: tag["Value"] for tag in tags}, quote_via=quote)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=novo, **extras)
+    return {"key": key, "antes": len(body), "depois": len(novo), "comprimido": True}
+
+
+def _carregar_checkpoint(path: str) -> Dict:
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+
+def _salvar_checkpoint(path: str, checkpoint: Dict):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp, path)
+
+
+def recomprimir_bucket(s3_client, bucket: str, prefix: str = "notas/", workers: int = RECOMPRESS_WORKERS,
+                       checkpoint_path: str = CHECKPOINT_PATH) -> Dict:
+    """
+    Percorre a listagem do prefixo e recomprime os XMLs ainda sem gzip.
+
+    Cada página da listagem (até 1000 chaves) é processada em paralelo; o
+    checkpoint guarda a última chave da página concluída, e uma nova execução
+    continua dali (StartAfter). As chaves que falharam ficam no checkpoint
+    (`falhas`) e são tentadas de novo no começo da próxima execução. Os totais
+    acumulados também ficam no checkpoint.
+    """
+    checkpoint = _carregar_checkpoint(checkpoint_path)
+    if checkpoint.get("bucket") != bucket or checkpoint.get("prefix") != prefix:
+        checkpoint = {"bucket": bucket, "prefix": prefix, "ultima_chave": "", "falhas": [],
+                      "objetos": 0, "comprimidos": 0, "erros": 0, "bytes_antes": 0, "bytes_depois": 0}
+    elif checkpoint.get("ultima_chave"):
+        print(f"↩️  Retomando a partir de {checkpoint['ultima_chave']}")
+
+    def processar(pool, xmls):
+        futuros = [pool.submit(recomprimir_objeto, s3_client, bucket, key) for key in xmls]
+        for key, futuro in zip(xmls, futuros):
+            try:
+                resultado = futuro.result()
+            except Exception as e:
+                print(f"  ❌ Erro ao recomprimir {key}: {e}")
+                checkpoint["falhas"].append(key)
+                continue
+            checkpoint["objetos"] += 1
+            checkpoint["comprimidos"] += int(resultado["comprimido"])
+            checkpoint["bytes_antes"] += resultado["antes"]
+            checkpoint["bytes_depois"] += resultado["depois"]
+        checkpoint["erros"] = len(checkpoint["falhas"])
+
+    paginator = s3_client.get_paginator("list_objects_v2")
+    params = {"Bucket": bucket, "Prefix": prefix}
+    if checkpoint["ultima_chave"]:
+        params["StartAfter"] = checkpoint["ultima_chave"]
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # Falhas das execuções anteriores: ficam antes do StartAfter e a listagem não as traz de novo
+        retentar, checkpoint["falhas"] = checkpoint.get("falhas", []), []
+        if retentar:
+            print(f"🔁 Retentando {len(retentar)} XMLs que falharam antes")
+            processar(pool, retentar)
+            _salvar_checkpoint(checkpoint_path, checkpoint)
+
+        for page in paginator.paginate(**params):
+            contents = page.get("Contents", [])
+            if not contents:
+                continue
+            processar(pool, [obj["Key"] for obj in contents if obj["Key"].endswith(".xml")])
+
+            checkpoint["ultima_chave"] = contents[-1]["Key"]
+            _salvar_checkpoint(checkpoint_path, checkpoint)
+            print(f"  📦 {checkpoint['objetos']} XMLs verificados | {checkpoint['comprimidos']} comprimidos | "
+                  f"{_mb(checkpoint['bytes_antes'] - checkpoint['bytes_depois'])} economizados")
+
+    checkpoint["concluido"] = True
+    _salvar_checkpoint(checkpoint_path, checkpoint)
+    return checkpoint
+
+
+def _mb(n: int) -> str:
+    return f"{n / (1024 * 1024):.1f} MB"
+
+
+def imprimir_relatorio(resultado: Dict):
+    antes, depois = resultado["bytes_antes"], resultado["bytes_depois"]
+    economia = antes - depois
+    print("\n" + "=" * 80)
+    print("✅ RECOMPRESSÃO CONCLUÍDA")
+    print("=" * 80)
+    print(f"📄 XMLs verificados: {resultado['objetos']}")
+    print(f"🗜️  Recomprimidos agora: {resultado['comprimidos']}")
+    print(f"❌ Erros: {resultado['erros']}" + (" (tentados de novo na próxima execução)" if resultado["erros"] else ""))
+    print(f"💾 Antes: {_mb(antes)} | Depois: {_mb(depois)} | Economia: {_mb(economia)}"
+          + (f" ({economia / antes:.0%})" if antes else ""))
+    print("=" * 80)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compressão gzip dos XMLs de notas no S3.",
+        epilog="Cada XML regravado dispara um evento ObjectCreated. O s3_event_ingest ignora os "
+               f"objetos com o metadado '{METADADO_RECOMPRESSAO}'; outros consumidores dos eventos do "
+               "bucket devem ter a notificação pausada durante a recompressão.",
+    )
+    parser.add_argument("--recomprimir", action="store_true", help="Recomprime os XMLs já existentes no bucket")
+    parser.add_argument("--prefix", default="notas/", help="Prefixo do bucket a percorrer")
+    parser.add_argument("--workers", type=int, default=RECOMPRESS_WORKERS, help="Objetos processados em paralelo")
+    parser.add_argument("--reiniciar", action="store_true", help="Ignora o checkpoint e começa do início")
+    args = parser.parse_args()
+    if not args.recomprimir:
+        parser.print_help()
+        return
+
+    import boto3
+    from botocore.config import Config
+    from dotenv import load_dotenv
+
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    load_dotenv(os.path.join(current_dir, "scripts", ".env"))
+    region = os.getenv("AWS_REGION", "sa-east-1")
+    bucket = os.getenv("AWS_BUCKET", "plug-notas")
+    s3_client = boto3.client(
+        "s3",
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_KEY"),
+        region_name=region,
+        config=Config(signature_version="s3v4", max_pool_connections=max(10, args.workers)),
+    )
+
+    if args.reiniciar and os.path.exists(CHECKPOINT_PATH):
+        os.remove(CHECKPOINT_PATH)
+
+    print(f"🗜️  Recomprimindo XMLs em {bucket}/{args.prefix} ({args.workers} workers)...")
+    try:
+        resultado = recomprimir_bucket(s3_client, bucket, args.prefix, args.workers)
+    except KeyboardInterrupt:
+        print("\n⏹️  Interrompido. Rode de novo para continuar do último checkpoint.")
+        sys.exit(1)
+    imprimir_relatorio(resultado)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Benchmark de memória do agrupamento dos arquivos do bucket por nota (notas_s3.py).
+
+Gera chaves sintéticas no formato do bucket (PDF + XML por nota, ~2% das notas
+só com PDF e ~1% com o XML numa pasta de outro mês) e mede o pico de RSS de cada
+forma de agrupar, cada uma num processo separado:
+
+  anterior:          listagem inteira numa lista + dict de dicts por nota (chave string);
+  anterior, stream:  mesmo dict de dicts, mas consumindo a listagem em streaming;
+  compacto:          NotaS3 (__slots__, CNPJs internados, datas inteiras) em streaming.
+
+O processo filho tem o espaço de endereçamento limitado a ~85% da memória da
+máquina; se um modo não couber, aparece como "sem memória".
+
+Uso:
+    python scripts/benchmark_group_files.py                      # 1M e 5M notas
+    python scripts/benchmark_group_files.py --notas 200000
+"""
+import argparse
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from notas_s3 import group_files_by_nota
+
+MODOS = ("anterior", "anterior, stream", "compacto")
+TOMADORES = 300
+PRESTADORES = 20000
+
+
+def gerar_chaves(total_notas: int):
+    """Chaves do bucket em ordem de listagem (determinístico, sem guardar nada)."""
+    for i in range(total_notas):
+        tomador = f"{10_000_000 + i % TOMADORES:012d}01"
+        prestador = f"{50_000_000 + (i * 7919) % PRESTADORES:012d}01"
+        ano, mes, dia = 2024 + (i // 1_000_000) % 3, 1 + (i // 7) % 12, 1 + i % 28
+        base = f"NFSe_{dia:02d}-{mes:02d}-{ano}_{100000 + i}_{prestador}"
+        yield f"notas/{tomador}/{ano}/{mes:02d}/{base}.pdf"
+        if i % 50 == 0:
+            continue
+        if i % 100 == 1:
+            # XML gravado na pasta do mês seguinte (caminho fora do padrão)
+            yield f"notas/{tomador}/{ano + mes // 12}/{mes % 12 + 1:02d}/{base}.xml"
+        else:
+            yield f"notas/{tomador}/{ano}/{mes:02d}/{base}.xml"
+
+
+# ---------- implementação anterior (referência) ----------
+
+_PADRAO = r'notas/(\d{14})/(\d{4})/(\d{2})/NFSe_(\d{2})-(\d{2})-(\d{4})_(\d+)_(\d{14})\.(pdf|xml)'
+
+
+def _parse_s3_key_anterior(s3_key):
+    match = re.match(_PADRAO, s3_key)
+    if not match:
+        return None
+    cnpj_tomador, _, _, dia, mes_emissao, ano_emissao, numero, cnpj_prestador, tipo = match.groups()
+    return {
+        'cnpj_tomador': cnpj_tomador, 'cnpj_prestador': cnpj_prestador,
+        'ano': int(ano_emissao), 'mes': int(mes_emissao), 'dia': int(dia),
+        'data_emissao': f"{ano_emissao}-{mes_emissao}-{dia}", 'numero_nfse': numero, 'tipo': tipo,
+    }
+
+
+def _group_files_anterior(files):
+    notas = {}
+    for file_path in files:
+        info = _parse_s3_key_anterior(file_path)
+        if not info:
+            continue
+        nota_key = f"{info['cnpj_tomador']}_{info['numero_nfse']}_{info['data_emissao']}"
+        if nota_key not in notas:
+            notas[nota_key] = {
+                'cnpj_tomador': info['cnpj_tomador'], 'cnpj_prestador': info['cnpj_prestador'],
+                'numero_nfse': info['numero_nfse'], 'data_emissao': info['data_emissao'],
+                'ano': info['ano'], 'mes': info['mes'], 'dia': info['dia'],
+                's3_path_pdf': None, 's3_path_xml': None,
+            }
+        if info['tipo'] == 'pdf':
+            notas[nota_key]['s3_path_pdf'] = file_path
+        elif info['tipo'] == 'xml':
+            notas[nota_key]['s3_path_xml'] = file_path
+    return notas
+
+
+# ---------- processo filho ----------
+
+def medir(modo: str, total_notas: int):
+    """Agrupa no processo atual e imprime 'notas segundos pico_rss_kb'."""
+    inicio = time.perf_counter()
+    if modo == "anterior":
+        notas = _group_files_anterior(list(gerar_chaves(total_notas)))
+    elif modo == "anterior, stream":
+        notas = _group_files_anterior(gerar_chaves(total_notas))
+    else:
+        notas = group_files_by_nota(gerar_chaves(total_notas))
+    print(len(notas), f"{time.perf_counter() - inicio:.1f}", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def _memoria_total() -> int:
+    with open("/proc/meminfo") as f:
+        return int(f.readline().split()[1]) * 1024
+
+
+def _limitar_memoria():
+    limite = int(_memoria_total() * 0.85)
+    resource.setrlimit(resource.RLIMIT_AS, (limite, limite))
+
+
+def executar(modo: str, total_notas: int):
+    """Roda `medir` num processo novo; retorna (notas, segundos, pico de RSS em MB) ou None."""
+    processo = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--medir", modo, "--notas", str(total_notas)],
+        capture_output=True, text=True, preexec_fn=_limitar_memoria,
+    )
+    if processo.returncode != 0:
+        return None
+    notas, segundos, pico_kb = processo.stdout.split()
+    return int(notas), float(segundos), int(pico_kb) / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de memória do agrupamento por nota.")
+    parser.add_argument("--notas", type=int, nargs="+", default=[1_000_000, 5_000_000])
+    parser.add_argument("--medir", choices=MODOS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.medir:
+        medir(args.medir, args.notas[0])
+        return
+
+    for total in args.notas:
+        print(f"📊 {total:,} notas ({total * 2 - total // 50:,} chaves)".replace(",", "."))
+        for modo in MODOS:
+            resultado = executar(modo, total)
+            if resultado is None:
+                print(f"  {modo:<18} sem memória (limite de {_memoria_total() * 0.85 / 2**30:.1f} GB)")
+                continue
+            notas, segundos, pico_mb = resultado
+            print(f"  {modo:<18} pico RSS {pico_mb:8.0f} MB | {pico_mb * 2**20 / notas:6.0f} bytes/nota | "
+                  f"{segundos:6.1f} s")
+
+
+if __name__ == "__main__":
+    main()
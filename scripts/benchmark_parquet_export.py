@@ -0,0 +1,154 @@
+"""
+Benchmark da exportação Parquet (parquet_export.py) com notas sintéticas.
+
+Gera N notas em memória (padrão 1M), exporta para um diretório temporário e
+mede o tempo de exportação, o tamanho em disco e duas consultas típicas com
+pyarrow.dataset: uma filtrada pelas partições (ano/tomador) e uma varredura
+completa. Em seguida altera ~1% das notas (no mês mais recente) e mede a
+exportação incremental.
+
+Uso:
+    python scripts/benchmark_parquet_export.py
+    python scripts/benchmark_parquet_export.py --linhas 200000 --tomadores 50
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parquet_export import DestinoLocal, _exigir_pyarrow, exportar, particionamento
+from cnpj_canon import canonical_cnpj, limpar_cnpj
+
+
+class FonteMemoria:
+    """Mesma interface de FontePostgrest, sobre uma lista de notas em memória."""
+
+    def __init__(self, notas):
+        self.notas = notas
+        self._por_particao = None
+
+    def alteracoes(self, desde):
+        chave = (desde["updated_at"], desde["id"]) if desde else None
+        for nota in sorted(self.notas, key=lambda n: (n["updated_at"], n["id"])):
+            if chave is None or (nota["updated_at"], nota["id"]) > chave:
+                yield nota
+
+    def mudancas(self, desde_id):
+        # Sem notas movidas ou removidas no benchmark
+        return iter(())
+
+    def linhas_da_particao(self, particao):
+        if self._por_particao is None:
+            self._por_particao = defaultdict(list)
+            for nota in self.notas:
+                self._por_particao[(limpar_cnpj(nota["cnpj_tomador"]), nota["ano"], nota["mes"])].append(nota)
+        return self._por_particao.get(particao, [])
+
+
+def _cnpj(i: int) -> str:
+    return canonical_cnpj(f"{i:012d}01")
+
+
+def gerar_notas(total: int, tomadores: int, prestadores: int):
+    rnd = random.Random(42)
+    cnpjs_tomador = [_cnpj(10_000_000 + i) for i in range(tomadores)]
+    cnpjs_prestador = [_cnpj(50_000_000 + i) for i in range(prestadores)]
+    inicio = date(2024, 1, 1)
+    base = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    notas = []
+    for i in range(total):
+        emissao = inicio + timedelta(days=rnd.randrange(730))
+        notas.append({
+            "id": str(uuid.UUID(int=rnd.getrandbits(128))),
+            "nota_id": f"{i:024x}",
+            "numero_nfse": str(100000 + i),
+            "company_id": None,
+            "cnpj_tomador": rnd.choice(cnpjs_tomador),
+            "cnpj_prestador": rnd.choice(cnpjs_prestador),
+            "data_emissao": emissao.isoformat(),
+            "ano": emissao.year,
+            "mes": emissao.month,
+            "dia": emissao.day,
+            "valor_total": round(rnd.uniform(50, 50000), 2),
+            "descricao_servico": "Prestação de serviços de consultoria",
+            "codigo_servico": rnd.choice(["1.07", "17.01", "7.02", "14.01"]),
+            "status": "CONCLUIDO",
+            "s3_path_pdf": f"notas/{i}.pdf",
+            "s3_path_xml": f"notas/{i}.xml",
+            "created_at": (base + timedelta(seconds=i)).isoformat(),
+            "updated_at": (base + timedelta(seconds=i)).isoformat(),
+        })
+    return notas
+
+
+def tamanho_diretorio(raiz: str) -> int:
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, arquivos in os.walk(raiz) for f in arquivos)
+
+
+def medir_consultas(raiz: str, cnpj_exemplo: str):
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(raiz, format="parquet", partitioning=particionamento())
+
+    inicio = time.perf_counter()
+    tabela = dataset.to_table(columns=["cnpj_prestador", "valor_total"],
+                              filter=(ds.field("ano") == 2025) & (ds.field("cnpj_tomador") == cnpj_exemplo))
+    total = pc.sum(tabela["valor_total"]).as_py()
+    filtrada = time.perf_counter() - inicio
+    print(f"  🔎 Tomador {cnpj_exemplo} em 2025 (poda de partições): {tabela.num_rows} notas, "
+          f"R$ {total} em {filtrada * 1000:.0f} ms")
+
+    inicio = time.perf_counter()
+    tabela = dataset.to_table(columns=["ano", "valor_total"])
+    por_ano = tabela.group_by("ano").aggregate([("valor_total", "sum")])
+    completa = time.perf_counter() - inicio
+    print(f"  🔎 Soma por ano (varredura completa): {tabela.num_rows} notas, "
+          f"{por_ano.num_rows} anos em {completa * 1000:.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark da exportação Parquet de service_notes.")
+    parser.add_argument("--linhas", type=int, default=1_000_000)
+    parser.add_argument("--tomadores", type=int, default=200)
+    parser.add_argument("--prestadores", type=int, default=5000)
+    args = parser.parse_args()
+    _exigir_pyarrow()
+
+    print(f"🧪 Gerando {args.linhas} notas sintéticas ({args.tomadores} tomadores)...")
+    notas = gerar_notas(args.linhas, args.tomadores, args.prestadores)
+    raiz = tempfile.mkdtemp(prefix="parquet_export_")
+    try:
+        fonte = FonteMemoria(notas)
+        resultado = exportar(fonte, DestinoLocal(raiz))
+        tamanho = tamanho_diretorio(raiz)
+        print(f"⏱️  Exportação completa: {resultado['segundos']:.1f}s | {resultado['particoes']} partições | "
+              f"{resultado['linhas'] / resultado['segundos']:.0f} linhas/s | {tamanho / (1024 * 1024):.1f} MB")
+
+        medir_consultas(raiz, limpar_cnpj(notas[0]["cnpj_tomador"]))
+
+        # ~1% das notas alteradas depois da exportação, concentradas no mês mais recente
+        # (como na sincronização real, que revisita os últimos dias)
+        recentes = [n for n in notas if (n["ano"], n["mes"]) == (2025, 12)]
+        depois = datetime(2030, 1, 1, tzinfo=timezone.utc)
+        alteradas = random.Random(7).sample(recentes, min(len(recentes), max(1, len(notas) // 100)))
+        for i, nota in enumerate(alteradas):
+            nota["valor_total"] = round(nota["valor_total"] * 1.1, 2)
+            nota["updated_at"] = (depois + timedelta(seconds=i)).isoformat()
+        resultado = exportar(FonteMemoria(notas), DestinoLocal(raiz))
+        print(f"⏱️  Exportação incremental (1% alterado): {resultado['segundos']:.1f}s | "
+              f"{resultado['particoes']} partições regravadas | {resultado['linhas']} linhas")
+    finally:
+        shutil.rmtree(raiz, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
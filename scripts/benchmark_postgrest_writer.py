@@ -0,0 +1,211 @@
+"""
+Benchmark do escritor assíncrono do PostgREST (postgrest_async.py) contra a
+gravação síncrona atual (uma requisição por nota, como o supabase-py faz).
+
+Sobe um PostgREST de mentira local (HTTP, em memória) que responde com uma
+latência artificial por requisição e um custo pequeno por linha, e grava N notas
+sintéticas de três formas:
+
+  1. síncrono: jobs numa FilaTrabalho consumidos por executar_jobs com `workers`
+     threads, um upsert bloqueante por nota (caminho atual de sync_to_supabase);
+  2. assíncrono, mesma fila: o handler devolve o Future do escritor e o worker
+     segue para o próximo job (upserts das threads saem no mesmo lote);
+  3. assíncrono, uma thread em pipeline (em_ordem), como sync_notas_s3_supabase
+     e sync_notas_por_cnpj com --escrita-async. Aqui parte das notas é gravada
+     duas vezes (versão 1 e depois 2).
+
+Ao final de cada cenário confere que todas as notas existem e que prevaleceu a
+última versão enviada de cada uma.
+
+Uso:
+    python scripts/benchmark_postgrest_writer.py
+    python scripts/benchmark_postgrest_writer.py --notas 20000 --latencia-ms 80 --workers 4
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from postgrest_async import EscritorEmSegundoPlano, em_ordem, encadear
+from work_queue import FilaTrabalho, executar_jobs
+
+
+class PostgrestLocal:
+    """PostgREST mínimo em memória: POST (insert/upsert por on_conflict) e PATCH ?col=eq.valor."""
+
+    def __init__(self, latencia: float, custo_linha: float):
+        self.latencia = latencia
+        self.custo_linha = custo_linha
+        self.tabelas = {}
+        self.requisicoes = 0
+        self._lock = threading.Lock()
+        servidor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _responder(self, status, corpo=b""):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(corpo)))
+                self.end_headers()
+                self.wfile.write(corpo)
+
+            def _ler(self):
+                url = urlparse(self.path)
+                tamanho = int(self.headers.get("Content-Length") or 0)
+                return url.path.rsplit("/", 1)[-1], parse_qs(url.query), json.loads(self.rfile.read(tamanho) or b"null")
+
+            def do_POST(self):
+                tabela, params, corpo = self._ler()
+                linhas = corpo if isinstance(corpo, list) else [corpo]
+                time.sleep(servidor.latencia + servidor.custo_linha * len(linhas))
+                conflito = params.get("on_conflict", ["nota_id"])[0]
+                with servidor._lock:
+                    servidor.requisicoes += 1
+                    destino = servidor.tabelas.setdefault(tabela, {})
+                    for linha in linhas:
+                        if linha.get(conflito) in destino and "merge-duplicates" not in self.headers.get("Prefer", ""):
+                            return self._responder(409, b'{"message":"duplicate key"}')
+                        destino[linha.get(conflito)] = linha
+                self._responder(201)
+
+            def do_PATCH(self):
+                tabela, params, corpo = self._ler()
+                time.sleep(servidor.latencia + servidor.custo_linha)
+                coluna, valor = next(iter(params.items()))
+                with servidor._lock:
+                    servidor.requisicoes += 1
+                    for linha in servidor.tabelas.get(tabela, {}).values():
+                        if str(linha.get(coluna)) == valor[0].removeprefix("eq."):
+                            linha.update(corpo)
+                self._responder(204)
+
+        self.http = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.http.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.http.server_port}"
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+
+    def reiniciar(self):
+        with self._lock:
+            self.tabelas, self.requisicoes = {}, 0
+
+    def conferir(self, gravacoes):
+        """Todas as notas gravadas e com a última versão enviada de cada uma."""
+        esperado = {}
+        for nota in gravacoes:
+            esperado[nota["nota_id"]] = nota["versao"]
+        linhas = self.tabelas.get("service_notes", {})
+        faltando = sum(1 for nota_id in esperado if nota_id not in linhas)
+        fora_de_ordem = sum(1 for nota_id, versao in esperado.items()
+                            if nota_id in linhas and linhas[nota_id]["versao"] != versao)
+        return faltando, fora_de_ordem
+
+
+def gerar_gravacoes(total: int, repetidas: float):
+    """Notas sintéticas; uma fração `repetidas` é regravada (versão 2) logo depois da primeira gravação."""
+    gravacoes = []
+    passo = int(1 / repetidas) if repetidas else 0
+    for i in range(total):
+        nota = {"nota_id": f"nota-{i:08d}", "numero_nfse": str(i), "cnpj_prestador": "11.222.333/0001-81",
+                "valor_total": round(i * 1.37 % 5000, 2), "versao": 1}
+        gravacoes.append(nota)
+        if passo and i % passo == 0:
+            gravacoes.append({**nota, "valor_total": nota["valor_total"] + 1, "versao": 2})
+    return gravacoes
+
+
+def _executar_fila(gravacoes, handler, workers: int):
+    with tempfile.TemporaryDirectory() as pasta:
+        fila = FilaTrabalho(os.path.join(pasta, "fila.sqlite3"))
+        for nota in gravacoes:
+            fila.enfileirar(nota["nota_id"], nota)
+        resultado = executar_jobs(fila, handler, workers=workers)
+        fila.fechar()
+    if resultado["falhas"]:
+        print(f"  ⚠️ {resultado['falhas']} jobs falharam")
+
+
+def gravar_sincrono(servidor: PostgrestLocal, gravacoes, workers: int):
+    sessao = requests.Session()
+    sessao.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=workers))
+    url = f"{servidor.url}/rest/v1/service_notes"
+
+    def handler(nota):
+        resposta = sessao.post(url, params={"on_conflict": "nota_id"}, json=nota,
+                               headers={"Prefer": "return=minimal,resolution=merge-duplicates"})
+        return resposta.status_code < 300
+
+    _executar_fila(gravacoes, handler, workers)
+
+
+def gravar_async_fila(servidor: PostgrestLocal, gravacoes, workers: int, em_voo: int, lote: int):
+    with EscritorEmSegundoPlano(servidor.url, "chave", em_voo=em_voo, tamanho_lote=lote) as escritor:
+        def handler(nota):
+            futuro = escritor.upsert("service_notes", nota, on_conflict="nota_id", chave=nota["nota_id"])
+            return encadear(futuro, lambda erro: erro is None)
+
+        _executar_fila(gravacoes, handler, workers)
+
+
+def gravar_async_pipeline(servidor: PostgrestLocal, gravacoes, em_voo: int, lote: int):
+    with EscritorEmSegundoPlano(servidor.url, "chave", em_voo=em_voo, tamanho_lote=lote) as escritor:
+        def enviar(nota):
+            return escritor.upsert("service_notes", nota, on_conflict="nota_id", chave=nota["nota_id"])
+
+        for _ in em_ordem(gravacoes, enviar, escritor.limite_pendentes):
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark do escritor assíncrono do PostgREST.")
+    parser.add_argument("--notas", type=int, default=5000)
+    parser.add_argument("--latencia-ms", type=float, default=50, help="Latência artificial por requisição")
+    parser.add_argument("--custo-linha-ms", type=float, default=0.05, help="Custo adicional por linha no servidor")
+    parser.add_argument("--workers", type=int, default=4, help="Threads de gravação (WORK_QUEUE_WORKERS)")
+    parser.add_argument("--em-voo", type=int, default=8)
+    parser.add_argument("--lote", type=int, default=200)
+    parser.add_argument("--repetidas", type=float, default=0.1,
+                        help="Fração das notas gravadas duas vezes (cenário em pipeline)")
+    args = parser.parse_args()
+
+    servidor = PostgrestLocal(args.latencia_ms / 1000, args.custo_linha_ms / 1000)
+    notas = gerar_gravacoes(args.notas, 0)
+    com_regravacoes = gerar_gravacoes(args.notas, args.repetidas)
+    print(f"📊 {args.notas} notas | latência {args.latencia_ms:.0f} ms | {args.workers} workers | "
+          f"até {args.em_voo} lotes de {args.lote} em voo")
+
+    cenarios = [
+        ("síncrono, fila", notas, lambda: gravar_sincrono(servidor, notas, args.workers)),
+        ("assíncrono, fila", notas, lambda: gravar_async_fila(servidor, notas, args.workers,
+                                                               args.em_voo, args.lote)),
+        ("assíncrono, pipeline em 1 thread", com_regravacoes,
+         lambda: gravar_async_pipeline(servidor, com_regravacoes, args.em_voo, args.lote)),
+    ]
+    base = None
+    for nome, gravacoes, executar in cenarios:
+        servidor.reiniciar()
+        inicio = time.perf_counter()
+        executar()
+        duracao = time.perf_counter() - inicio
+        faltando, fora_de_ordem = servidor.conferir(gravacoes)
+        base = base or duracao
+        print(f"  {nome:<34} {len(gravacoes):7d} gravações {duracao:7.2f} s | "
+              f"{len(gravacoes) / duracao:8.0f} /s | {servidor.requisicoes:6d} requisições | "
+              f"{base / duracao:5.1f}x | faltando: {faltando} | versão errada: {fora_de_ordem}")
+    servidor.http.shutdown()
+
+
+if __name__ == "__main__":
+    main()
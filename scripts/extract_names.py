@@ -1,53 +1,198 @@
+"""
+Preenche companies.razao_social a partir dos nomes dos arquivos de certificado.
+
+Padrão do nome do arquivo: "<14 dígitos> + <Razão Social> + ...".
+
+As pastas (uma ou mais, com subpastas) vêm de --dir ou de CERTIFICADOS_DIRS
+(separadas por os.pathsep: ";" no Windows, ":" no Linux). O resultado da
+leitura de cada pasta fica em cache pelo mtime, então pastas sem arquivos
+novos, removidos ou renomeados não são relidas. As razões sociais atuais são
+lidas uma vez e só as mudanças reais são gravadas, em lotes.
+
+Uso:
+    python scripts/extract_names.py --dir "/mnt/certificados"
+    python scripts/extract_names.py --sobrescrever --simular
+"""
+import argparse
+import json
 import os
 import re
+import sys
+from typing import Dict, List
+
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
-# Carregar variáveis de ambiente
-env_path = r'c:\Users\SR APOIO\OneDrive\Documents\Projetos IA\portal-de-notas-de-serviço\scripts\.env'
-load_dotenv(env_path)
+# Módulos compartilhados ficam na raiz do projeto (append para não sombrear o pacote supabase)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cnpj_canon import limpar_cnpj
+
+# Carregar variáveis de ambiente do .env local da pasta de scripts
+load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-dir_path = r"C:\Users\SR APOIO\OneDrive\Documents\Certificados Digitais"
+CERTIFICADOS_DIRS = [d for d in os.getenv("CERTIFICADOS_DIRS", "").split(os.pathsep) if d]
+CACHE_PATH = os.getenv(
+    "CERTIFICADOS_CACHE",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "extract_names.json"),
+)
+LOTE_ATUALIZACAO = 500
+TAMANHO_RAZAO_SOCIAL = 255  # companies.razao_social VARCHAR(255)
 
-def run_extraction():
-    if not os.path.exists(dir_path):
-        print(f"❌ Diretório não encontrado: {dir_path}")
-        return
+# Padrão: 14 dígitos + " + " + Nome
+PADRAO_ARQUIVO = re.compile(r"^(\d{14})\s+\+\s+([^+]+)\s+\+")
+
+
+def melhor_nome(atual: str, novo: str) -> str:
+    """O nome mais longo vence (os arquivos às vezes trazem a razão social abreviada)."""
+    if not atual or len(novo) > len(atual) or (len(novo) == len(atual) and novo < atual):
+        return novo
+    return atual
 
-    files = os.listdir(dir_path)
-    mapping = {}
-
-    # Padrão: 14 dígitos + " + " + Nome
-    for f in files:
-        match = re.search(r"^(\d{14})\s+\+\s+([^+]+)\s+\+", f)
-        if match:
-            cnpj_clean = match.group(1)
-            name = match.group(2).strip()
-            
-            # Formatar CNPJ: 00.000.000/0000-00
-            formatted = f"{cnpj_clean[:2]}.{cnpj_clean[2:5]}.{cnpj_clean[5:8]}/{cnpj_clean[8:12]}-{cnpj_clean[12:]}"
-            
-            if formatted not in mapping or len(name) > len(mapping[formatted]):
-                mapping[formatted] = name
-
-    print(f"🔍 Processando {len(mapping)} empresas...")
-    for cnpj, name in mapping.items():
+
+def carregar_cache(path: str) -> Dict:
+    if os.path.exists(path):
         try:
-            # Atualização segura via client (impede SQL Injection)
-            res = supabase.table("companies")\
-                .update({"razao_social": name})\
-                .eq("cnpj", cnpj)\
-                .or_("razao_social.eq.,razao_social.is.null")\
-                .execute()
-            
-            if res.data:
-                print(f"  ✅ Atualizada: {cnpj} -> {name}")
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+    return {}
+
+
+def salvar_cache(path: str, cache: Dict):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(cache, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def escanear_pasta(pasta: str, cache: Dict, novo_cache: Dict, estatisticas: Dict) -> Dict[str, str]:
+    """
+    Nomes por CNPJ (só dígitos) encontrados na pasta e nas subpastas.
+    O mtime de uma pasta muda quando arquivos são criados, removidos ou renomeados
+    nela; se não mudou, a leitura anterior é reaproveitada.
+    """
+    mtime = os.stat(pasta).st_mtime_ns
+    entrada = cache.get(pasta)
+    if entrada and entrada["mtime"] == mtime:
+        estatisticas["em_cache"] += 1
+        nomes, subpastas = entrada["nomes"], entrada["subpastas"]
+    else:
+        estatisticas["lidas"] += 1
+        nomes, subpastas = {}, []
+        with os.scandir(pasta) as it:
+            for item in it:
+                if item.is_dir(follow_symlinks=False):
+                    subpastas.append(item.path)
+                    continue
+                match = PADRAO_ARQUIVO.search(item.name)
+                if match:
+                    cnpj = match.group(1)
+                    nomes[cnpj] = melhor_nome(nomes.get(cnpj), match.group(2).strip()[:TAMANHO_RAZAO_SOCIAL])
+    novo_cache[pasta] = {"mtime": mtime, "nomes": nomes, "subpastas": subpastas}
+
+    resultado = dict(nomes)
+    for subpasta in subpastas:
+        try:
+            for cnpj, nome in escanear_pasta(subpasta, cache, novo_cache, estatisticas).items():
+                resultado[cnpj] = melhor_nome(resultado.get(cnpj), nome)
+        except OSError as e:
+            print(f"  ⚠️ Não foi possível ler {subpasta}: {e}")
+    return resultado
+
+
+def razoes_sociais_atuais() -> Dict[str, str]:
+    """cnpj (só dígitos) -> razão social atual, lendo companies uma única vez (paginado)."""
+    atuais, inicio, pagina = {}, 0, 1000
+    while True:
+        dados = supabase.table("companies").select("cnpj, razao_social")\
+            .order("cnpj").range(inicio, inicio + pagina - 1).execute().data or []
+        for empresa in dados:
+            atuais[limpar_cnpj(empresa["cnpj"])] = (empresa.get("razao_social") or "").strip()
+        if len(dados) < pagina:
+            return atuais
+        inicio += pagina
+
+
+def calcular_mudancas(encontrados: Dict[str, str], atuais: Dict[str, str], sobrescrever: bool) -> List[Dict]:
+    """Só empresas cadastradas cujo nome muda (por padrão, só as que estão sem razão social)."""
+    mudancas = []
+    for cnpj, nome in sorted(encontrados.items()):
+        if cnpj not in atuais or atuais[cnpj] == nome:
+            continue
+        if atuais[cnpj] and not sobrescrever:
+            continue
+        mudancas.append({"cnpj": cnpj, "razao_social": nome})
+    return mudancas
+
+
+def aplicar_mudancas(mudancas: List[Dict]) -> int:
+    """Grava em lotes, uma chamada por lote (função SQL da migration)."""
+    atualizadas = 0
+    for i in range(0, len(mudancas), LOTE_ATUALIZACAO):
+        lote = mudancas[i:i + LOTE_ATUALIZACAO]
+        try:
+            response = supabase.rpc("update_companies_razao_social", {"itens": lote}).execute()
+            atualizadas += response.data or 0
         except Exception as e:
-            print(f"  ❌ Erro ao atualizar {cnpj}: {e}")
+            print(f"  ❌ Erro ao atualizar lote {i // LOTE_ATUALIZACAO + 1}: {e}")
+    return atualizadas
+
+
+def run_extraction(pastas: List[str], sobrescrever: bool = False, simular: bool = False):
+    cache = carregar_cache(CACHE_PATH)
+    novo_cache = {}
+    estatisticas = {"lidas": 0, "em_cache": 0}
+    encontrados: Dict[str, str] = {}
+
+    for pasta in pastas:
+        if not os.path.isdir(pasta):
+            print(f"❌ Diretório não encontrado: {pasta}")
+            continue
+        for cnpj, nome in escanear_pasta(os.path.abspath(pasta), cache, novo_cache, estatisticas).items():
+            encontrados[cnpj] = melhor_nome(encontrados.get(cnpj), nome)
+
+    print(f"📂 Pastas lidas: {estatisticas['lidas']} | Sem alteração (cache): {estatisticas['em_cache']}")
+    print(f"🔍 {len(encontrados)} empresas nos certificados")
+    if not encontrados:
+        return
+
+    mudancas = calcular_mudancas(encontrados, razoes_sociais_atuais(), sobrescrever)
+    print(f"✏️  {len(mudancas)} razões sociais a atualizar")
+    for mudanca in mudancas[:20]:
+        print(f"  {mudanca['cnpj']} -> {mudanca['razao_social']}")
+    if len(mudancas) > 20:
+        print(f"  ... e mais {len(mudancas) - 20}")
+
+    if simular:
+        print("🧪 Simulação: nada foi gravado.")
+        return
+    if mudancas:
+        print(f"✅ Atualizadas: {aplicar_mudancas(mudancas)}")
+    # O cache guarda só a leitura das pastas; a comparação com o banco é refeita a cada execução
+    salvar_cache(CACHE_PATH, {**cache, **novo_cache})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preenche a razão social das empresas a partir dos certificados.")
+    parser.add_argument("--dir", action="append", dest="pastas",
+                        help="Pasta de certificados (pode repetir; padrão: CERTIFICADOS_DIRS)")
+    parser.add_argument("--sobrescrever", action="store_true",
+                        help="Substitui razões sociais já preenchidas que forem diferentes")
+    parser.add_argument("--simular", action="store_true", help="Só mostra as mudanças, sem gravar")
+    args = parser.parse_args()
+
+    pastas = args.pastas or CERTIFICADOS_DIRS
+    if not pastas:
+        parser.error("informe --dir ou defina CERTIFICADOS_DIRS no scripts/.env")
+    run_extraction(pastas, args.sobrescrever, args.simular)
+
 
 if __name__ == "__main__":
-    run_extraction()
+    main()
@@ -0,0 +1,6 @@
+
+@echo off
+echo Iniciando daemon de sincronizacao de notas (Python): %date% %time%
+cd /d "c:\Users\SR APOIO\OneDrive\Documents\Projetos IA\portal-de-notas-de-serviço"
+python scripts\sync_daemon.py
+echo Finalizado: %date% %time%
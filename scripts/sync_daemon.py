@@ -0,0 +1,368 @@
+"""
+Daemon de sincronização PlugNotas -> S3 -> Supabase (substitui a execução horária do run_sync.bat).
+
+Um único processo mantém aquecidos os clientes (sessão HTTP, boto3, Supabase),
+o cache de densidade e a fila local. Cada empresa tem o seu próprio agendamento:
+o intervalo entre consultas acompanha a taxa recente de notas do CNPJ (cache de
+densidade do window_planner) e recebe jitter para os tenants não consultarem
+todos ao mesmo tempo.
+
+Uso:
+    python scripts/sync_daemon.py
+    curl http://127.0.0.1:8787/health
+    curl http://127.0.0.1:8787/metrics
+
+SIGTERM/SIGINT: para de agendar, espera as sincronizações em andamento e sai.
+Jobs que não terminarem no prazo ficam na fila local e são retomados no próximo início.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sync_to_supabase import (
+    POSTGREST_ASYNC, ativar_escrita_async, cache_paginas, corrigir_registros_incompletos, densidade_cache,
+    encerrar_escrita_async, periodo_incremental, registrar_log, sincronizar_empresa, supabase
+)
+from cnpj_canon import limpar_cnpj
+from sync_leases import Lease, LeasePerdido, filtrar_shard, id_worker, parse_shard, reivindicar
+from sync_state import SYNC_LOOKBACK_DAYS
+from work_queue import WORK_QUEUE_WORKERS, FilaTrabalho
+
+# ================= CONFIGURAÇÕES DO DAEMON =================
+INTERVALO_MIN = int(os.getenv("DAEMON_MIN_INTERVAL", "300"))        # 5 min
+INTERVALO_MAX = int(os.getenv("DAEMON_MAX_INTERVAL", "21600"))      # 6 h
+INTERVALO_PADRAO = int(os.getenv("DAEMON_DEFAULT_INTERVAL", "3600"))  # sem histórico: 1 h, como o cron
+NOTAS_POR_CONSULTA = float(os.getenv("DAEMON_NOTES_PER_POLL", "5"))
+JITTER = float(os.getenv("DAEMON_JITTER", "0.2"))
+DIAS_TAXA = int(os.getenv("DAEMON_RATE_DAYS", "14"))
+CONCORRENCIA = int(os.getenv("DAEMON_CONCURRENCY", "2"))
+REFRESH_EMPRESAS = int(os.getenv("DAEMON_COMPANIES_REFRESH", "600"))
+INTERVALO_MANUTENCAO = int(os.getenv("DAEMON_MAINTENANCE_INTERVAL", "3600"))
+TIMEOUT_ENCERRAMENTO = int(os.getenv("DAEMON_SHUTDOWN_TIMEOUT", "300"))
+HEALTH_HOST = os.getenv("DAEMON_HEALTH_HOST", "127.0.0.1")
+HEALTH_PORT = int(os.getenv("DAEMON_HEALTH_PORT", "8787"))
+SHARD = os.getenv("DAEMON_SHARD")                                    # "i/N"
+USAR_LEASE = os.getenv("DAEMON_LEASE", "0").lower() in ("1", "true", "sim")
+
+
+def intervalo_adaptativo(cnpj, hoje=None):
+    """
+    Intervalo (s) até a próxima consulta do CNPJ: o tempo esperado para chegarem
+    NOTAS_POR_CONSULTA notas, pela taxa dos últimos DIAS_TAXA dias.
+    """
+    hoje = hoje or datetime.now().date()
+    densidade = densidade_cache.densidade(limpar_cnpj(cnpj))
+    if not densidade:
+        return INTERVALO_PADRAO
+    inicio = hoje - timedelta(days=DIAS_TAXA)
+    notas_recentes = sum(v for d, v in densidade.items() if inicio < d <= hoje)
+    notas_por_hora = notas_recentes / (DIAS_TAXA * 24)
+    if notas_por_hora <= 0:
+        return INTERVALO_MAX
+    return min(INTERVALO_MAX, max(INTERVALO_MIN, NOTAS_POR_CONSULTA / notas_por_hora * 3600))
+
+
+def com_jitter(segundos):
+    return segundos * random.uniform(1 - JITTER, 1 + JITTER)
+
+
+class SyncDaemon:
+    def __init__(self, workers=WORK_QUEUE_WORKERS, concorrencia=CONCORRENCIA, lookback=SYNC_LOOKBACK_DAYS,
+                 shard=None, lease=False):
+        self.workers = workers
+        self.lookback = lookback
+        self.shard = shard
+        self.lease = lease
+        self.worker = id_worker()
+        self.concorrencia = max(1, concorrencia)
+        # Uma thread extra para consultas de empresas e manutenção
+        self.executor = ThreadPoolExecutor(max_workers=self.concorrencia + 1, thread_name_prefix="sync")
+        self.semaforo = None
+        self.parar = None
+        self.fila = FilaTrabalho()
+        self.iniciado_em = time.time()
+        # id da empresa -> estado do agendamento
+        self.empresas = {}
+        self.metricas = {"consultas": 0, "notas": 0, "erros": 0}
+        self.notas_desde_log = 0
+        self.consultas_desde_log = 0
+        self.ultima_consulta = None
+
+    # ---------- Agendamento ----------
+
+    async def executar(self, funcao, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, funcao, *args)
+
+    async def atualizar_empresas(self):
+        response = await self.executar(
+            lambda: supabase.table("companies").select("id, cnpj, sync_watermark").eq("active", True).execute()
+        )
+        ativas = {emp["id"]: emp for emp in filtrar_shard(response.data or [], self.shard)}
+        for company_id in list(self.empresas):
+            if company_id not in ativas and not self.empresas[company_id]["em_andamento"]:
+                print(f"  [Daemon] Empresa {self.empresas[company_id]['emp']['cnpj']} desativada, removida da agenda.")
+                del self.empresas[company_id]
+        agora = time.monotonic()
+        for company_id, emp in ativas.items():
+            if company_id not in self.empresas:
+                # Primeira consulta espalhada nos primeiros minutos para não disparar todas juntas
+                self.empresas[company_id] = {
+                    "emp": emp,
+                    "proxima": agora + random.uniform(0, INTERVALO_MIN),
+                    "intervalo": INTERVALO_PADRAO,
+                    "em_andamento": False,
+                    "falhas_seguidas": 0,
+                    "ultima_consulta": None,
+                    "ultimas_notas": 0,
+                    "ultimo_erro": None,
+                }
+
+    def sincronizar(self, emp, data_inicial, data_final):
+        """Sincroniza a empresa (com lease, se ativo). None se outro worker está com ela (ou assumiu no meio)."""
+        if not self.lease:
+            return sincronizar_empresa(emp, data_inicial, data_final, self.fila, self.workers)
+        if not reivindicar(supabase, emp["id"], self.worker):
+            return None
+        try:
+            with Lease(supabase, emp["id"], self.worker) as lease:
+                return sincronizar_empresa(emp, data_inicial, data_final, self.fila, self.workers, lease=lease)
+        except LeasePerdido as e:
+            print(f"  [Lease] ⚠️ {emp['cnpj']} interrompida: {e}")
+            return None
+
+    async def consultar(self, estado):
+        async with self.semaforo:
+            if self.parar.is_set():
+                # Encerrando: a consulta que esperava vaga não começa
+                estado["em_andamento"] = False
+                return
+            emp = estado["emp"]
+            try:
+                data_inicial, data_final = periodo_incremental(emp, self.lookback)
+                notas = await self.executar(self.sincronizar, emp, data_inicial, data_final)
+                if notas is None:
+                    # Lease com outro worker (ex.: execução horária): tenta de novo mais tarde
+                    intervalo = INTERVALO_MIN
+                else:
+                    self.metricas["consultas"] += 1
+                    self.metricas["notas"] += notas
+                    self.consultas_desde_log += 1
+                    self.notas_desde_log += notas
+                    estado.update(ultimas_notas=notas, ultimo_erro=None, falhas_seguidas=0)
+                    intervalo = intervalo_adaptativo(emp["cnpj"])
+            except Exception as e:
+                self.metricas["erros"] += 1
+                estado["falhas_seguidas"] += 1
+                estado["ultimo_erro"] = str(e)
+                # Backoff exponencial a partir do intervalo mínimo
+                intervalo = min(INTERVALO_MAX, INTERVALO_MIN * 2 ** estado["falhas_seguidas"])
+                print(f"  [Daemon] Erro ao sincronizar {emp['cnpj']}: {e}")
+
+            agora = time.time()
+            estado["ultima_consulta"] = agora
+            self.ultima_consulta = agora
+            estado["intervalo"] = intervalo
+            estado["proxima"] = time.monotonic() + com_jitter(intervalo)
+            estado["em_andamento"] = False
+
+    async def manutencao(self):
+        """Tarefas que o cron fazia a cada execução: correção de legados e log para o portal."""
+        try:
+            await self.executar(corrigir_registros_incompletos)
+            if self.consultas_desde_log:
+                notas = self.notas_desde_log
+                self.notas_desde_log = 0
+                self.consultas_desde_log = 0
+                await self.executar(registrar_log, "completed", notas, None, cache_paginas.extrair_contadores())
+            removidos = await self.executar(self.fila.limpar_concluidos)
+            if removidos:
+                print(f"  [Fila] {removidos} jobs concluídos removidos.")
+            await self.executar(cache_paginas.limpar_antigas)
+        except Exception as e:
+            print(f"  [Daemon] Erro na manutenção: {e}")
+
+    async def agendar(self):
+        tarefas = set()
+        proximo_refresh = 0.0
+        proxima_manutencao = time.monotonic() + INTERVALO_MANUTENCAO
+        while not self.parar.is_set():
+            agora = time.monotonic()
+            if agora >= proximo_refresh:
+                try:
+                    await self.atualizar_empresas()
+                except Exception as e:
+                    print(f"  [Daemon] Erro ao buscar empresas: {e}")
+                proximo_refresh = agora + REFRESH_EMPRESAS
+
+            for estado in self.empresas.values():
+                if not estado["em_andamento"] and estado["proxima"] <= agora:
+                    estado["em_andamento"] = True
+                    tarefa = asyncio.create_task(self.consultar(estado))
+                    tarefas.add(tarefa)
+                    tarefa.add_done_callback(tarefas.discard)
+
+            if agora >= proxima_manutencao:
+                # Em segundo plano para não atrasar o agendamento
+                tarefa = asyncio.create_task(self.manutencao())
+                tarefas.add(tarefa)
+                tarefa.add_done_callback(tarefas.discard)
+                proxima_manutencao = agora + INTERVALO_MANUTENCAO
+
+            try:
+                await asyncio.wait_for(self.parar.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+
+        # Encerramento: novas consultas não começam (ver consultar); espera as que estão rodando
+        if tarefas:
+            print(f"  [Daemon] Aguardando {len(tarefas)} sincronizações em andamento (até {TIMEOUT_ENCERRAMENTO}s)...")
+            _, pendentes = await asyncio.wait(tarefas, timeout=TIMEOUT_ENCERRAMENTO)
+            if pendentes:
+                return False
+        if self.consultas_desde_log:
+            await self.executar(registrar_log, "completed", self.notas_desde_log, None,
+                                cache_paginas.extrair_contadores())
+        return True
+
+    # ---------- Health / métricas ----------
+
+    def saude(self):
+        contagem = self.fila.contagem()
+        return {
+            "status": "encerrando" if self.parar.is_set() else "ok",
+            "uptime_s": round(time.time() - self.iniciado_em),
+            "empresas": len(self.empresas),
+            "em_andamento": sum(1 for e in self.empresas.values() if e["em_andamento"]),
+            "ultima_consulta": datetime.fromtimestamp(self.ultima_consulta).isoformat() if self.ultima_consulta else None,
+            "fila": contagem,
+            **self.metricas,
+        }
+
+    def metricas_prometheus(self):
+        saude = self.saude()
+        linhas = [
+            f"plugnotas_sync_uptime_seconds {saude['uptime_s']}",
+            f"plugnotas_sync_consultas_total {self.metricas['consultas']}",
+            f"plugnotas_sync_notas_total {self.metricas['notas']}",
+            f"plugnotas_sync_erros_total {self.metricas['erros']}",
+            f"plugnotas_sync_empresas {saude['empresas']}",
+            f"plugnotas_sync_em_andamento {saude['em_andamento']}",
+        ]
+        for status, total in saude["fila"].items():
+            linhas.append(f'plugnotas_sync_fila_jobs{{status="{status}"}} {total}')
+        for estado in self.empresas.values():
+            cnpj = limpar_cnpj(estado["emp"]["cnpj"])
+            linhas.append(f'plugnotas_sync_intervalo_segundos{{cnpj="{cnpj}"}} {estado["intervalo"]:.0f}')
+            if estado["ultima_consulta"]:
+                linhas.append(f'plugnotas_sync_ultima_consulta_timestamp{{cnpj="{cnpj}"}} {estado["ultima_consulta"]:.0f}')
+        return "\n".join(linhas) + "\n"
+
+    async def atender_http(self, reader, writer):
+        """Servidor HTTP mínimo: GET /health (JSON) e GET /metrics (formato Prometheus)."""
+        try:
+            linha = await asyncio.wait_for(reader.readline(), timeout=5)
+            partes = linha.decode("latin-1").split()
+            caminho = partes[1] if len(partes) > 1 else "/"
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+
+            if caminho == "/health":
+                saude = self.saude()
+                status = "200 OK" if saude["status"] == "ok" else "503 Service Unavailable"
+                tipo, corpo = "application/json", json.dumps(saude)
+            elif caminho == "/metrics":
+                status, tipo = "200 OK", "text/plain; version=0.0.4"
+                corpo = self.metricas_prometheus()
+            else:
+                status, tipo, corpo = "404 Not Found", "text/plain", "not found\n"
+
+            corpo = corpo.encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {tipo}\r\nContent-Length: {len(corpo)}\r\n"
+                f"Connection: close\r\n\r\n".encode("latin-1") + corpo
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    # ---------- Ciclo de vida ----------
+
+    def instalar_sinais(self):
+        loop = asyncio.get_running_loop()
+
+        def encerrar(*_):
+            if not self.parar.is_set():
+                print("\n--- Sinal de encerramento recebido. Finalizando o daemon... ---")
+            loop.call_soon_threadsafe(self.parar.set)
+
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, encerrar)
+            except (NotImplementedError, RuntimeError):
+                # Windows: o loop não suporta add_signal_handler
+                signal.signal(sig, encerrar)
+
+    async def rodar(self):
+        self.parar = asyncio.Event()
+        self.semaforo = asyncio.Semaphore(self.concorrencia)
+        self.instalar_sinais()
+
+        recuperados = self.fila.recuperar_interrompidos()
+        if recuperados:
+            print(f"  [Fila] {recuperados} jobs interrompidos voltaram para a fila.")
+
+        servidor = await asyncio.start_server(self.atender_http, HEALTH_HOST, HEALTH_PORT)
+        print(f"--- Daemon de sincronização iniciado ({datetime.now().strftime('%d/%m/%Y %H:%M')}) ---")
+        print(f"  Health: http://{HEALTH_HOST}:{HEALTH_PORT}/health | Métricas: /metrics")
+        try:
+            concluido = await self.agendar()
+        finally:
+            servidor.close()
+            await servidor.wait_closed()
+        return concluido
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Daemon de sincronização PlugNotas -> S3 -> Supabase.")
+    parser.add_argument("--workers", type=int, default=WORK_QUEUE_WORKERS,
+                        help="Workers da fila local por empresa")
+    parser.add_argument("--concorrencia", type=int, default=CONCORRENCIA,
+                        help="Empresas sincronizadas ao mesmo tempo")
+    parser.add_argument("--lookback", type=int, default=SYNC_LOOKBACK_DAYS,
+                        help="Dias antes do watermark reconsultados para pegar notas atrasadas")
+    parser.add_argument("--shard", default=SHARD, metavar="i/N",
+                        help="Só as empresas do shard i de N (0..N-1), por hash estável do CNPJ")
+    parser.add_argument("--lease", action="store_true", default=USAR_LEASE,
+                        help="Reivindica cada empresa na tabela sync_leases antes de sincronizar")
+    parser.add_argument("--escrita-async", action="store_true", default=POSTGREST_ASYNC,
+                        help="Grava pelo escritor assíncrono do PostgREST (lotes em voo, requer httpx)")
+    args = parser.parse_args()
+    try:
+        shard = parse_shard(args.shard) if args.shard else None
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.escrita_async:
+        ativar_escrita_async()
+    daemon = SyncDaemon(workers=args.workers, concorrencia=args.concorrencia, lookback=args.lookback,
+                        shard=shard, lease=args.lease)
+    concluido = asyncio.run(daemon.rodar())
+    if not concluido:
+        # Jobs em andamento ficam como 'running' na fila e são retomados no próximo início
+        print("⚠️ Sincronizações não terminaram no prazo; encerrando mesmo assim.")
+        os._exit(1)
+    daemon.executor.shutdown(wait=True)
+    encerrar_escrita_async()
+    print("--- Daemon finalizado. ---")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,37 @@
 
 import os
+import sys
+import argparse
 import requests
 import boto3
 import time
 import calendar
-from datetime import datetime, timedelta
+import io
+from collections import Counter
+from datetime import datetime, timedelta, date, timezone
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
+# Módulos compartilhados ficam na raiz do projeto (append para não sombrear o pacote supabase)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cnpj_canon import adotar_ids_plugnotas, canonical_cnpj, limpar_cnpj
+from monthly_summary import MesesAlterados, atualizar_resumo_mensal
+from postgrest_async import EscritorEmSegundoPlano, encadear, executar_agora
+from page_cache import CachePaginas, ConfirmacaoPaginas, chave_pagina
+from parties import CacheParties, item_parte
+from sync_deadline import EstadoPrazo, Prazo, Unidade, parse_deadline, priorizar
+from sync_leases import Lease, LeasePerdido, filtrar_shard, id_worker, parse_shard, reivindicar_proxima
+from s3_xml_gzip import parametros_upload
+from table_scan import SCAN_PAGE_SIZE, VarreduraTabela
+from sync_failures import SYNC_RETRY_MAX_ATTEMPTS, RegistroFalhas, classe_do_erro, falhas_a_retentar
+from xml_metadata import extrair_campos
+from window_planner import DensidadeCache, buscar_adaptativo
+from work_queue import WORK_QUEUE_WORKERS, ConsumoConcorrente, FilaTrabalho, MonitorFila, executar_jobs
+from sync_state import (
+    SYNC_LOOKBACK_DAYS, ProgressoWatermark, calcular_inicio, parse_backfill, parse_data, salvar_watermark
+)
+
 # Carregar variáveis de ambiente do .env local da pasta de scripts
 load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
 
@@ -31,7 +55,53 @@ s3_client = boto3.client(
 )
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-def registrar_log(status, notes=0, error=None):
+# Sessão HTTP compartilhada: reaproveita conexões/TLS com a PlugNotas entre as requisições
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+http = requests.Session()
+http.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+
+# Densidade de notas por CNPJ, usada para planejar as janelas de consulta
+densidade_cache = DensidadeCache()
+
+# Meses (empresa/ano/mês) gravados, para o resumo mensal
+meses_alterados = MesesAlterados()
+
+# Hash das páginas da consulta por período: páginas iguais à última execução são puladas
+cache_paginas = CachePaginas()
+
+# Tomador/prestador normalizados na tabela parties: só grava quando o JSON muda
+partes = CacheParties(supabase)
+
+# Paginação à frente do processamento: com a fila, os workers gravam as notas enquanto
+# as próximas páginas são buscadas, e a busca espera se passar desta folga
+NOTAS_POR_PAGINA = 50
+PAGINAS_ADIANTADAS = int(os.getenv("SYNC_LOOKAHEAD_PAGES", "2"))
+
+# Notas incompletas corrigidas por execução (as seguintes ficam para a próxima)
+CORRECAO_MAX_NOTAS = int(os.getenv("INCOMPLETE_FIX_LIMIT", "100"))
+
+# Notas que falharam (sync_failures), refeitas com --retentar-falhas
+falhas = RegistroFalhas(supabase, "plugnotas")
+GRUPO_RETENTATIVAS = "retentativas"
+
+# Escritor assíncrono do PostgREST (--escrita-async ou POSTGREST_ASYNC=1): os upserts dos
+# workers da fila saem agrupados, com várias requisições em voo
+POSTGREST_ASYNC = os.getenv("POSTGREST_ASYNC", "0").lower() in ("1", "true", "sim")
+escritor = None
+
+def ativar_escrita_async():
+    global escritor
+    if escritor is None:
+        escritor = EscritorEmSegundoPlano(SUPABASE_URL, SUPABASE_KEY)
+        print(f"  [PostgREST] Escrita assíncrona: até {escritor.em_voo} lotes de {escritor.tamanho_lote} em voo.")
+
+def encerrar_escrita_async():
+    global escritor
+    if escritor is not None:
+        escritor.fechar()
+        escritor = None
+
+def registrar_log(status, notes=0, error=None, metadata=None):
     try:
         data = {
             "status": status,
@@ -39,13 +109,17 @@ def registrar_log(status, notes=0, error=None):
             "error_message": error,
             "finished_at": datetime.now().isoformat()
         }
+        if metadata:
+            data["metadata"] = metadata
         supabase.table("sync_logs").insert(data).execute()
     except Exception as e:
         print(f"Erro ao registrar log: {e}")
 
 def upload_s3(content, key):
     try:
-        s3_client.put_object(Bucket=AWS_BUCKET, Key=key, Body=content)
+        # XMLs vão comprimidos quando S3_XML_GZIP está ativo (ver s3_xml_gzip)
+        body, extras = parametros_upload(key, content)
+        s3_client.put_object(Bucket=AWS_BUCKET, Key=key, Body=body, **extras)
         return True
     except Exception as e:
         print(f"      [S3] Erro: {e}")
@@ -65,32 +139,48 @@ def generate_presigned_url(key, expiration=604800): # 7 dias
         return None
 
 def baixar_e_enviar(url, s3_key, headers):
+    """
+    Baixa o arquivo da PlugNotas e envia ao S3. Retorna o conteúdo (bytes) quando
+    o arquivo foi enviado agora, True se ele já estava no S3 e False na falha.
+    """
     try:
         try:
             s3_client.head_object(Bucket=AWS_BUCKET, Key=s3_key)
             return True # Já existe
         except: pass
 
-        response = requests.get(url, headers=headers, timeout=30)
+        response = http.get(url, headers=headers, timeout=30)
         if response.status_code == 200:
-            return upload_s3(response.content, s3_key)
+            return response.content if upload_s3(response.content, s3_key) else False
     except Exception as e:
         print(f"      [Erro] Download/Upload: {e}")
     return False
 
+def parse_emissao(nota):
+    emissao = nota.get("emissao") or "2000-01-01"
+    emissao_limpa = emissao[:10].replace("/", "-")
+    
+    try:
+        # Tenta YYYY-MM-DD primeiro
+        return datetime.strptime(emissao_limpa, "%Y-%m-%d")
+    except ValueError:
+        # Tenta DD-MM-YYYY
+        return datetime.strptime(emissao_limpa, "%d-%m-%Y")
+
 def registrar_nota_no_supabase(nota, cnpj_alvo, s3_paths, company_id):
+    return enviar_nota_ao_supabase(nota, cnpj_alvo, s3_paths, company_id).result()
+
+def enviar_nota_ao_supabase(nota, cnpj_alvo, s3_paths, company_id, ao_falhar=None, xml=None):
+    """
+    Mesmo que registrar_nota_no_supabase, mas retorna um Future[bool]: com o escritor
+    assíncrono o upsert fica em voo (agrupado com os das outras threads) e a chamada volta logo.
+    `ao_falhar(classe, erro)` recebe a classe do erro (ver sync_failures) quando a nota não é gravada.
+    `xml` (bytes) é o XML que acabou de ser enviado ao S3: valor, descrição e código
+    do serviço saem dele em memória. Sem ele a nota fica para o `xml_metadata.py`.
+    """
     try:
         nota_id = nota.get("id")
-        emissao = nota.get("emissao") or "2000-01-01"
-        emissao_limpa = emissao[:10].replace("/", "-")
-        
-        try:
-            # Tenta YYYY-MM-DD primeiro
-            data_conv = datetime.strptime(emissao_limpa, "%Y-%m-%d")
-        except ValueError:
-            # Tenta DD-MM-YYYY
-            data_conv = datetime.strptime(emissao_limpa, "%d-%m-%Y")
-        
+        data_conv = parse_emissao(nota)
         data_iso = data_conv.strftime("%Y-%m-%d")
 
         # DETECTAR O VALOR CORRETO
@@ -115,21 +205,27 @@ def registrar_nota_no_supabase(nota, cnpj_alvo, s3_paths, company_id):
             if nota_id: return f"https://api.plugnotas.com.br/nfse/{type_str}/{nota_id}"
             return None
 
-        # CNPJ Formatado para as colunas de busca rápida
-        def format_cnpj(c):
-            if not c: return c
-            c = str(c).replace(".", "").replace("/", "").replace("-", "")
-            if len(c) != 14: return c
-            return f"{c[:2]}.{c[2:5]}.{c[5:8]}/{c[8:12]}-{c[12:]}"
+        # Valor, descrição e código do serviço saem do XML recém-baixado (sem nova
+        # leitura no S3 nem o detalhe da nota na PlugNotas)
+        metadados_xml = {}
+        if xml:
+            try:
+                metadados_xml = extrair_campos(io.BytesIO(xml))
+            except Exception as e:
+                print(f"      [Aviso] XML não lido ({s3_paths.get('xml')}): {e}")
+        if valor == 0:
+            valor = metadados_xml.get("valor_total") or 0
 
-        # Se o tomador ou prestador forem apenas strings (CNPJ), ou se o valor for zero,
+        # Se o tomador ou prestador forem apenas strings (CNPJ), ou se o valor continuar zero,
         # e tivermos um nota_id válido, tentamos buscar o detalhe completo da nota.
         # Isso garante que teremos o endereço (dentro do objeto tomador/prestador).
+        # Se o tomador já está em parties, o endereço não depende do detalhe desta nota.
         full_nota = nota
-        if nota_id and len(nota_id) == 24 and (not isinstance(nota.get("tomador"), dict) or valor == 0):
+        sem_tomador = not isinstance(nota.get("tomador"), dict) and not partes.conhece(cnpj_alvo)
+        if nota_id and len(nota_id) == 24 and (sem_tomador or valor == 0):
             try:
                 headers = {"X-API-KEY": PLUGNOTAS_API_KEY}
-                res = requests.get(f"https://api.plugnotas.com.br/nfse/{nota_id}", headers=headers, timeout=15)
+                res = http.get(f"https://api.plugnotas.com.br/nfse/{nota_id}", headers=headers, timeout=15)
                 if res.status_code == 200:
                     full_nota = res.json()
                     # Recalcular valor com dados completos
@@ -158,6 +254,12 @@ def registrar_nota_no_supabase(nota, cnpj_alvo, s3_paths, company_id):
             elif isinstance(field, dict) and field.get('url'): url_xml = field.get('url')
             elif nota_id: url_xml = f"https://api.plugnotas.com.br/nfse/xml/{nota_id}"
 
+        # Tomador e prestador vão para parties (uma vez por CNPJ); a nota guarda só os CNPJs
+        cnpj_tomador = canonical_cnpj(cnpj_alvo)
+        cnpj_prestador = canonical_cnpj(full_nota.get("prestador", {}).get("cpfCnpj") if isinstance(full_nota.get("prestador"), dict) else str(full_nota.get("prestador")))
+        partes.registrar(item_parte(cnpj_tomador, full_nota.get("tomador"), data_iso),
+                         item_parte(cnpj_prestador, full_nota.get("prestador"), data_iso))
+
         data = {
             "nota_id": nota_id,
             "id_dps": full_nota.get("idDPS") or full_nota.get("id_dps"),
@@ -167,15 +269,16 @@ def registrar_nota_no_supabase(nota, cnpj_alvo, s3_paths, company_id):
             "numero_nfse": str(full_nota.get("numeroNfse") or full_nota.get("numero") or nota_id),
             "chave_acesso_nfse": full_nota.get("chaveAcessoNfse"),
             "company_id": company_id,
-            "cnpj_tomador": format_cnpj(cnpj_alvo),
-            "cnpj_prestador": format_cnpj(full_nota.get("prestador", {}).get("cpfCnpj") if isinstance(full_nota.get("prestador"), dict) else str(full_nota.get("prestador"))),
-            "tomador": full_nota.get("tomador"),
-            "prestador": full_nota.get("prestador"),
+            "cnpj_tomador": cnpj_tomador,
+            "cnpj_prestador": cnpj_prestador,
             "data_emissao": data_iso,
             "ano": data_conv.year,
             "mes": data_conv.month,
             "dia": data_conv.day,
             "valor_total": valor,
+            "descricao_servico": metadados_xml.get("descricao_servico"),
+            "codigo_servico": metadados_xml.get("codigo_servico"),
+            "metadados_xml_em": datetime.now(timezone.utc).isoformat() if metadados_xml else None,
             "s3_path_pdf": s3_paths.get("pdf"),
             "s3_path_xml": s3_paths.get("xml"),
             "s3_bucket": AWS_BUCKET,
@@ -188,186 +291,706 @@ def registrar_nota_no_supabase(nota, cnpj_alvo, s3_paths, company_id):
         # Limpar campos None para não quebrar o banco se houver restrições
         data = {k: v for k, v in data.items() if v is not None}
         
-        supabase.table("service_notes").upsert(data, on_conflict="nota_id").execute()
-        return True
+        if escritor:
+            futuro = escritor.upsert("service_notes", data, on_conflict="nota_id", chave=data.get("nota_id"))
+        else:
+            futuro = executar_agora(
+                lambda: supabase.table("service_notes").upsert(data, on_conflict="nota_id").execute()
+            )
     except Exception as e:
         print(f"      [Erro] Registro Supabase: {e}")
-        return False
+        if ao_falhar:
+            ao_falhar(classe_do_erro(e, "dados"), e)
+        return executar_agora(lambda: False)
+
+    def concluir(erro):
+        if erro:
+            print(f"      [Erro] Registro Supabase: {erro}")
+            if ao_falhar:
+                ao_falhar(classe_do_erro(erro, "supabase"), erro)
+            return False
+        meses_alterados.registrar(data)
+        return True
 
-def sync_periodo(cnpj_formatado, company_id, ano, mes):
-    headers = {"X-API-KEY": PLUGNOTAS_API_KEY, "Content-Type": "application/json"}
-    cnpj_limpo = cnpj_formatado.replace(".", "").replace("/", "").replace("-", "")
+    return encadear(futuro, concluir)
+
+def identidade_da_nota(nota, cnpj_alvo):
+    """nota_id, número e CNPJs canônicos da nota da listagem, como enviar_nota_ao_supabase os grava."""
+    prestador = nota.get("prestador")
+    return {
+        "nota_id": nota.get("id"),
+        "numero_nfse": str(nota.get("numeroNfse") or nota.get("numero") or nota.get("id")),
+        "cnpj_tomador": canonical_cnpj(cnpj_alvo),
+        "cnpj_prestador": canonical_cnpj(prestador.get("cpfCnpj") if isinstance(prestador, dict) else str(prestador)),
+    }
+
+def adotar_fallbacks(notas, cnpj_alvo):
+    """Uma chamada por página: registros de fallback do bucket passam a usar o ID do PlugNotas."""
+    try:
+        adotadas = adotar_ids_plugnotas(supabase, [identidade_da_nota(nota, cnpj_alvo) for nota in notas])
+        if adotadas:
+            print(f"      [Dedup] {adotadas} nota(s) do bucket passaram a usar o ID do PlugNotas")
+    except Exception as e:
+        # Sem a adoção a nota ainda é gravada; o duplicado sai no merge (cnpj_canon --merge-duplicados)
+        print(f"      [Aviso] Adoção de IDs do PlugNotas falhou: {e}")
+
+def headers_plugnotas():
+    return {"X-API-KEY": PLUGNOTAS_API_KEY, "Content-Type": "application/json"}
+
+def payload_job(nota, cnpj_formatado, company_id, ano, mes):
+    """Argumentos de processar_nota, guardados na fila local e em sync_failures."""
+    return {"nota": nota, "cnpj": cnpj_formatado, "company_id": company_id, "ano": ano, "mes": mes}
+
+def registrar_falha(payload, erro, classe=None):
+    """Grava a falha da nota em sync_failures (em lote), para o modo --retentar-falhas."""
+    falhas.falhou(chave_job(payload["nota"], payload["cnpj"]), payload, erro, classe,
+                  nota_id=payload["nota"].get("id"), company_id=payload["company_id"])
+
+def processar_nota(nota, cnpj_formatado, company_id, ano, mes, headers, aguardar=True):
+    """
+    Transfere PDF/XML da nota para o S3 e registra no Supabase.
+    Com `aguardar=False` retorna o Future[bool] do registro (ver enviar_nota_ao_supabase).
+    Arquivo não transferido ou gravação recusada contam como falha e vão para
+    sync_failures; o sucesso remove a falha anterior da nota, se houver.
+    """
+    cnpj_limpo = limpar_cnpj(cnpj_formatado)
+    nota_id = nota.get("id")
+    numero = str(nota.get("numeroNfse") or nota.get("numero") or nota_id)
+    emissao_limpa = str(nota.get("emissao", "00-00-00")).replace("/", "-")[:10]
+    
+    path_base = f"notas/{cnpj_limpo}/{ano}/{mes:02d}/NFSe_{emissao_limpa}_{numero}"
+    s3_pdf, s3_xml = path_base + ".pdf", path_base + ".xml"
+
+    # Download e Upload S3 (o XML baixado agora vai junto para o registro)
+    transferidos = {tipo: baixar_e_enviar(origem, destino, headers) for tipo, origem, destino in (
+        ("PDF", nota.get("pdf") or f"https://api.plugnotas.com.br/nfse/pdf/{nota_id}", s3_pdf),
+        ("XML", nota.get("xml") or f"https://api.plugnotas.com.br/nfse/xml/{nota_id}", s3_xml),
+    )}
+    nao_transferidos = [tipo for tipo, ok in transferidos.items() if not ok]
+    xml = transferidos["XML"] if isinstance(transferidos["XML"], bytes) else None
+
+    payload = payload_job(nota, cnpj_formatado, company_id, ano, mes)
+    ao_falhar = lambda classe, erro: registrar_falha(payload, erro, classe)
+    
+    # Registro no Supabase (a nota é gravada mesmo sem os arquivos, como antes)
+    registro = enviar_nota_ao_supabase(nota, cnpj_formatado, {"pdf": s3_pdf, "xml": s3_xml}, company_id, ao_falhar,
+                                       xml)
+
+    def concluir(_):
+        if not registro.result():
+            return False
+        if nao_transferidos:
+            ao_falhar("transferencia", f"{' e '.join(nao_transferidos)} não transferido(s) para o S3")
+            return False
+        falhas.resolveu(chave_job(nota, cnpj_formatado))
+        return True
+
+    futuro = encadear(registro, concluir)
+    return futuro.result() if aguardar else futuro
+
+def processar_job(payload):
+    """Handler dos jobs da fila local (ver work_queue): o worker não espera o upsert terminar."""
+    try:
+        return processar_nota(payload["nota"], payload["cnpj"], payload["company_id"],
+                              payload["ano"], payload["mes"], headers_plugnotas(), aguardar=False)
+    except Exception as e:
+        registrar_falha(payload, e)
+        raise
+
+def chave_job(nota, cnpj_formatado):
+    """Chave de idempotência do job: nota_id do PlugNotas (ou número + tomador)."""
+    return nota.get("id") or f"{nota.get('numeroNfse') or nota.get('numero')}_{limpar_cnpj(cnpj_formatado)}"
+
+def registrar_progresso(progresso, nota, ok):
+    if not progresso:
+        return
+    try:
+        data_nota = parse_emissao(nota)
+    except ValueError:
+        return
+    if ok:
+        progresso.sucesso(data_nota)
+    else:
+        progresso.falha(data_nota)
+
+def sync_periodo(cnpj_formatado, company_id, ano, mes, data_inicial=None, data_final=None, progresso=None, fila=None,
+                 confirmacao=None, consumo=None, lease=None, prazo=None):
+    """
+    Sincroniza as notas de um mês. `data_inicial`/`data_final` (date) recortam o mês
+    e `progresso` (ProgressoWatermark) recebe as datas sincronizadas e as falhas.
+    O mês é consultado em janelas adaptativas (window_planner): janelas cheias são
+    divididas e buscadas em paralelo enquanto as notas já recebidas são processadas.
+    Com `fila` (FilaTrabalho), as notas só são enfileiradas; o processamento fica
+    com os workers de executar_jobs. Com `consumo` (ConsumoConcorrente), os workers
+    já estão rodando e as notas entram na fila por ele: depois de cada página a busca
+    espera enquanto houver mais de PAGINAS_ADIANTADAS páginas de notas por processar.
+    Com `confirmacao` (ConfirmacaoPaginas), páginas iguais à última execução são
+    puladas antes de qualquer trabalho por nota.
+    Com `lease` (sync_leases.Lease), cada página confere se o lease continua deste
+    worker; se outro assumiu a empresa, LeasePerdido interrompe a busca.
+    Com `prazo` (time.monotonic), a paginação para na primeira página que chega
+    depois dele e o mês fica incompleto.
+    Retorna o número de notas descobertas (sem as das páginas puladas) e se a
+    paginação chegou ao fim.
+    """
+    headers = headers_plugnotas()
+    cnpj_limpo = limpar_cnpj(cnpj_formatado)
     
     ultimo_dia = calendar.monthrange(ano, mes)[1]
-    data_ini = f"{ano}-{mes:02d}-01"
-    data_fim = f"{ano}-{mes:02d}-{ultimo_dia:02d}"
+    inicio = data_inicial or date(ano, mes, 1)
+    fim = data_final or date(ano, mes, ultimo_dia)
 
     url = f"https://api.plugnotas.com.br/nfse/nacional/{cnpj_limpo}/consultar/periodo"
     count = 0
-    hash_pagina = None
 
-    while True:
-        params = {"dataInicial": data_ini, "dataFinal": data_fim, "ator": 2, "quantidade": 50}
+    def buscar_pagina(janela_ini, janela_fim, hash_pagina):
+        params = {"dataInicial": janela_ini.isoformat(), "dataFinal": janela_fim.isoformat(), "ator": 2,
+                  "quantidade": NOTAS_POR_PAGINA}
         if hash_pagina: params["hashProximaPagina"] = hash_pagina
 
-        try:
-            response = requests.get(url, headers=headers, params=params, timeout=30)
-            if response.status_code != 200: break
-            
-            dados = response.json()
-            notas = dados.get("notas", [])
-            hash_pagina = dados.get("hashProximaPagina")
-
+        response = http.get(url, headers=headers, params=params, timeout=30)
+        if response.status_code != 200:
+            raise RuntimeError(f"API retornou {response.status_code} para {janela_ini} a {janela_fim}")
+        
+        dados = response.json()
+        notas = dados.get("notas", [])
+        if confirmacao and notas:
+            notas = cache_paginas.pagina(chave_pagina(cnpj_limpo, janela_ini, janela_fim, hash_pagina), notas)
+        hash_pagina = dados.get("hashProximaPagina")
+        return notas, (hash_pagina if hash_pagina and notas else None)
+
+    def ao_falhar(janela, e):
+        print(f"      [Erro] Falha na paginação: {e}")
+        if progresso: progresso.falha(janela[0])
+
+    for janela, notas in buscar_adaptativo(inicio, fim, buscar_pagina, NOTAS_POR_PAGINA, cnpj=cnpj_limpo,
+                                           cache=densidade_cache, ao_falhar=ao_falhar):
+        if lease:
+            lease.verificar()
+        if prazo is not None and time.monotonic() >= prazo:
+            print(f"      [Prazo] Prazo atingido em {janela[0]} a {janela[1]}; o mês fica para a próxima execução.")
+            return count, False
+        if confirmacao and confirmacao.deve_pular(notas):
+            # Mesma página da última execução: as notas já foram gravadas
+            cache_paginas.registrar_pulo(notas)
             for nota in notas:
-                nota_id = nota.get("id")
-                numero = str(nota.get("numeroNfse") or nota.get("numero") or nota_id)
-                emissao_limpa = str(nota.get("emissao", "00-00-00")).replace("/", "-")[:10]
-                
-                path_base = f"notas/{cnpj_limpo}/{ano}/{mes:02d}/NFSe_{emissao_limpa}_{numero}"
-                s3_pdf, s3_xml = path_base + ".pdf", path_base + ".xml"
-
-                # Download e Upload S3
-                baixar_e_enviar(nota.get("pdf") or f"https://api.plugnotas.com.br/nfse/pdf/{nota_id}", s3_pdf, headers)
-                baixar_e_enviar(nota.get("xml") or f"https://api.plugnotas.com.br/nfse/xml/{nota_id}", s3_xml, headers)
-                
-                # Registro no Supabase
-                registrar_nota_no_supabase(nota, cnpj_formatado, {"pdf": s3_pdf, "xml": s3_xml}, company_id)
-                count += 1
-            
-            if not hash_pagina or len(notas) == 0: break
-        except Exception as e:
-            print(f"      [Erro] Falha na paginação: {e}")
-            break
+                registrar_progresso(progresso, nota, True)
+            continue
+        adotar_fallbacks(notas, cnpj_formatado)
+        chaves = [chave_job(nota, cnpj_formatado) for nota in notas]
+        if confirmacao:
+            confirmacao.adicionar(notas, chaves)
+        for nota, chave in zip(notas, chaves):
+            count += 1
+            if fila:
+                payload = payload_job(nota, cnpj_formatado, company_id, ano, mes)
+                if consumo:
+                    enfileirado = consumo.enfileirar(chave, payload)
+                else:
+                    enfileirado = fila.enfileirar(chave, payload, grupo=company_id)
+                if not enfileirado and confirmacao:
+                    # Já concluída nesta rodada da fila; pendente ou em andamento confirma ao terminar
+                    if fila.status(chave) == "done":
+                        confirmacao.nota_concluida(chave, True)
+                continue
+            try:
+                ok = processar_nota(nota, cnpj_formatado, company_id, ano, mes, headers)
+            except Exception as e:
+                print(f"      [Erro] Falha ao processar nota {nota.get('id')}: {e}")
+                registrar_falha(payload_job(nota, cnpj_formatado, company_id, ano, mes), e)
+                ok = False
+            registrar_progresso(progresso, nota, ok)
+            if confirmacao:
+                confirmacao.nota_concluida(chave, ok)
+        if consumo:
+            # Folga limitada: a próxima página espera os workers alcançarem
+            consumo.aguardar_vaga()
             
-    return count
-
-def corrigir_registros_incompletos():
+    return count, True
+
+def corrigir_registros_incompletos(limite=CORRECAO_MAX_NOTAS):
+    """
+    Completa as notas sem valor ou sem endereço do tomador com o detalhe da PlugNotas.
+    Lê a view service_notes_incompletas por id (table_scan), até `limite` notas por
+    execução, e a próxima execução continua de onde esta parou: as notas que a API
+    não encontra não ocupam sempre o começo da lista.
+    """
     print("\n--- Verificando registros incompletos no Supabase ---")
     headers = {"X-API-KEY": PLUGNOTAS_API_KEY, "Content-Type": "application/json"}
     
     try:
-        # Buscar notas com valor nulo ou sem endereço (tomador nulo)
-        response = supabase.table("service_notes").select("id, nota_id, numero_nfse, cnpj_prestador, cnpj_tomador")\
-            .or_("valor_total.is.null,tomador.is.null").limit(100).execute()
-        
-        incompletas = response.data
-        if not incompletas:
-            print("Nenhum registro incompleto encontrado.")
-            return
-
-        print(f"Encontrados {len(incompletas)} registros para tentar correção.")
-        for note in incompletas:
-            numero = note.get("numero_nfse")
-            # Limpar CNPJ para pesquisa
-            cnpj_prestador = str(note.get("cnpj_prestador", "")).replace(".", "").replace("/", "").replace("-", "")
-            cnpj_tomador = str(note.get("cnpj_tomador", "")).replace(".", "").replace("/", "").replace("-", "")
-            
-            print(f"  > Corrigindo Nota {numero} (Prest: {cnpj_prestador})")
+        # Notas com valor nulo ou sem endereço (tomador nem na nota, nem em parties)
+        varredura = VarreduraTabela(
+            supabase, "service_notes_incompletas",
+            "id, nota_id, numero_nfse, cnpj_prestador, cnpj_tomador, company_id, ano, mes, s3_path_pdf, s3_path_xml",
+            tamanho_pagina=max(1, min(limite, SCAN_PAGE_SIZE)), cursor="corrigir_registros_incompletos",
+        )
+        processadas = 0
+        legados_duplicados = []
+        for incompletas in varredura.paginas():
+            if processadas >= limite:
+                break
+            processadas += len(incompletas)
+            print(f"Encontrados {len(incompletas)} registros para tentar correção.")
+            for note in incompletas:
+                numero = note.get("numero_nfse")
+                # Limpar CNPJ para pesquisa
+                cnpj_prestador = limpar_cnpj(note.get("cnpj_prestador"))
+                cnpj_tomador = limpar_cnpj(note.get("cnpj_tomador"))
             
-            # 1. Tentar buscar por ID se for um ID válido do PlugNotas (24 chars hex)
-            full_data = None
-            orig_id = note.get("nota_id")
-            if orig_id and len(orig_id) == 24:
-                try:
-                    res = requests.get(f"https://api.plugnotas.com.br/nfse/{orig_id}", headers=headers, timeout=20)
-                    if res.status_code == 200: full_data = res.json()
-                except: pass
+                print(f"  > Corrigindo Nota {numero} (Prest: {cnpj_prestador})")
             
-            # 2. Se não encontrou por ID, buscar por Numero/Prestador
-            if not full_data:
-                try:
-                    params = {"numero": numero, "cnpjPrestador": cnpj_prestador}
-                    if cnpj_tomador: params["cnpjTomador"] = cnpj_tomador
-                    res = requests.get("https://api.plugnotas.com.br/nfse", headers=headers, params=params, timeout=20)
-                    if res.status_code == 200:
-                        results = res.json()
-                        if isinstance(results, list) and len(results) > 0:
-                            full_data = results[0]
-                except: pass
+                # 1. Tentar buscar por ID se for um ID válido do PlugNotas (24 chars hex)
+                full_data = None
+                orig_id = note.get("nota_id")
+                if orig_id and len(orig_id) == 24:
+                    try:
+                        res = http.get(f"https://api.plugnotas.com.br/nfse/{orig_id}", headers=headers, timeout=20)
+                        if res.status_code == 200: full_data = res.json()
+                    except: pass
             
-            if full_data:
-                # Re-utilizar a lógica de registro para atualizar
-                # Note: aqui passamos caminhos vazios para S3 se não soubermos, 
-                # mas o upsert manterá os existentes se não sobrescrevermos.
-                # Para garantir que não deletamos os caminhos S3, vamos buscar os atuais.
-                # Na verdade, a lógica de registrar_nota_no_supabase agora reconstrói tudo.
-                s3_paths = {
-                    "pdf": note.get("s3_path_pdf"),
-                    "xml": note.get("s3_path_xml")
-                }
-                # Se não tem caminhos S3, vamos tentar gerar o base
-                if not s3_paths["pdf"]:
-                    # Tentar extrair ano/mes da emissao se disponível
-                    emissao = full_data.get("emissao", "2000-01-01")
+                # 2. Se não encontrou por ID, buscar por Numero/Prestador
+                if not full_data:
                     try:
-                        dt = datetime.strptime(emissao[:10].replace("/", "-"), "%Y-%m-%d")
-                    except:
-                        dt = datetime.now()
-                    path_base = f"notas/{cnpj_tomador}/{dt.year}/{dt.month:02d}/NFSe_{emissao[:10].replace('/', '-')}_{numero}"
-                    s3_paths = {"pdf": path_base + ".pdf", "xml": path_base + ".xml"}
-
-                # Pegar o company_id original
-                company_id = note.get("company_id")
-                # Se mudou o nota_id (ex: de manual para PlugNotas ID), precisamos deletar o antigo 
-                # ou o upsert criará um novo. Como nota_id é o conflict target, se mudar, vira novo.
-                new_id = full_data.get("id")
+                        params = {"numero": numero, "cnpjPrestador": cnpj_prestador}
+                        if cnpj_tomador: params["cnpjTomador"] = cnpj_tomador
+                        res = http.get("https://api.plugnotas.com.br/nfse", headers=headers, params=params, timeout=20)
+                        if res.status_code == 200:
+                            results = res.json()
+                            if isinstance(results, list) and len(results) > 0:
+                                full_data = results[0]
+                    except: pass
+            
+                if full_data:
+                    # Re-utilizar a lógica de registro para atualizar
+                    # Note: aqui passamos caminhos vazios para S3 se não soubermos, 
+                    # mas o upsert manterá os existentes se não sobrescrevermos.
+                    # Para garantir que não deletamos os caminhos S3, vamos buscar os atuais.
+                    # Na verdade, a lógica de registrar_nota_no_supabase agora reconstrói tudo.
+                    s3_paths = {
+                        "pdf": note.get("s3_path_pdf"),
+                        "xml": note.get("s3_path_xml")
+                    }
+                    # Se não tem caminhos S3, vamos tentar gerar o base
+                    if not s3_paths["pdf"]:
+                        # Tentar extrair ano/mes da emissao se disponível
+                        emissao = full_data.get("emissao", "2000-01-01")
+                        try:
+                            dt = datetime.strptime(emissao[:10].replace("/", "-"), "%Y-%m-%d")
+                        except:
+                            dt = datetime.now()
+                        path_base = f"notas/{cnpj_tomador}/{dt.year}/{dt.month:02d}/NFSe_{emissao[:10].replace('/', '-')}_{numero}"
+                        s3_paths = {"pdf": path_base + ".pdf", "xml": path_base + ".xml"}
+
+                    # Pegar o company_id original
+                    company_id = note.get("company_id")
+                    # Se mudou o nota_id (ex: de manual para PlugNotas ID), precisamos deletar o antigo 
+                    # ou o upsert criará um novo. Como nota_id é o conflict target, se mudar, vira novo.
+                    new_id = full_data.get("id")
                 
-                if registrar_nota_no_supabase(full_data, cnpj_tomador, s3_paths, company_id):
-                    print(f"    [OK] Atualizada com sucesso.")
-                    # Se o ID mudou, deletar o registro antigo (o incompleto)
-                    if new_id and orig_id and new_id != orig_id:
-                        supabase.table("service_notes").delete().eq("id", note.get("id")).execute()
-                        print(f"    [OK] Removido registro legado duplicado.")
-            else:
-                print(f"    [Aviso] Não encontrada na API.")
+                    if registrar_nota_no_supabase(full_data, cnpj_tomador, s3_paths, company_id):
+                        print(f"    [OK] Atualizada com sucesso.")
+                        # Se o ID mudou, o registro antigo (o incompleto) vira duplicado
+                        if new_id and orig_id and new_id != orig_id:
+                            legados_duplicados.append(note.get("id"))
+                            meses_alterados.registrar(note)
+                else:
+                    print(f"    [Aviso] Não encontrada na API.")
+
+        if not processadas:
+            print("Nenhum registro incompleto encontrado.")
+
+        # Remover os duplicados legados numa única operação
+        if legados_duplicados:
+            supabase.table("service_notes").delete().in_("id", legados_duplicados).execute()
+            print(f"  [OK] Removidos {len(legados_duplicados)} registros legados duplicados.")
+        atualizar_resumo_mensal(supabase, meses_alterados)
 
     except Exception as e:
         print(f"Erro na correção: {e}")
 
+def meses_entre(inicio, fim):
+    """Quebra o intervalo [inicio, fim] em (ano, mes, data_inicial, data_final) por mês."""
+    atual = date(inicio.year, inicio.month, 1)
+    while atual <= fim:
+        ultimo = date(atual.year, atual.month, calendar.monthrange(atual.year, atual.month)[1])
+        yield atual.year, atual.month, max(inicio, atual), min(fim, ultimo)
+        atual = ultimo + timedelta(days=1)
+
+def periodo_incremental(emp, lookback=SYNC_LOOKBACK_DAYS):
+    """Período da sincronização incremental: do watermark (menos o lookback) até hoje."""
+    hoje = datetime.now().date()
+    # Primeira execução sem watermark: mês atual e o anterior, como antes
+    inicio_padrao = (hoje - timedelta(days=28)).replace(day=1)
+    return calcular_inicio(parse_data(emp.get('sync_watermark')), inicio_padrao, lookback), hoje
+
+def _contexto_empresa(emp, pular_paginas=True):
+    """Estado de uma empresa durante a execução: progresso do watermark e páginas a confirmar."""
+    return {
+        "emp": emp,
+        "watermark": parse_data(emp.get('sync_watermark')),
+        "progresso": ProgressoWatermark(),
+        "confirmacao": ConfirmacaoPaginas(cache_paginas, pular=pular_paginas),
+        "total": 0,
+        "interrompida": False,
+    }
+
+def _sincronizar_meses(ctx, meses, fila=None, workers=WORK_QUEUE_WORKERS, prazo=None):
+    """
+    Busca os meses [(ano, mes, data_inicial, data_final)] da empresa, até `prazo`
+    (time.monotonic), se houver: a paginação para ao atingi-lo e ctx["interrompida"]
+    fica True. Com `fila`, os jobs da empresa são processados enquanto a paginação
+    segue (os workers também param no prazo): os workers começam na primeira página
+    e a busca fica no máximo PAGINAS_ADIANTADAS páginas à frente deles.
+    Com o lease de ctx perdido, a busca e os workers param e os jobs pendentes da
+    empresa saem da fila (o worker que assumiu a empresa os redescobre).
+    """
+    emp = ctx["emp"]
+    lease = ctx.get("lease")
+    consumo = None
+    if fila:
+        progresso, confirmacao = ctx["progresso"], ctx["confirmacao"]
+
+        def ao_concluir(payload, ok):
+            registrar_progresso(progresso, payload["nota"], ok)
+            confirmacao.nota_concluida(chave_job(payload["nota"], payload["cnpj"]), ok)
+
+        consumo = ConsumoConcorrente(fila, processar_job, grupo=emp['id'], workers=workers, ao_concluir=ao_concluir,
+                                     prazo=prazo, max_adiantados=PAGINAS_ADIANTADAS * NOTAS_POR_PAGINA,
+                                     cancelar=lease.perda if lease else None)
+    try:
+        for ano, mes, ini, fim in meses:
+            notas, completo = sync_periodo(emp['cnpj'], emp['id'], ano, mes, ini, fim, ctx["progresso"], fila,
+                                           ctx["confirmacao"], consumo, lease, prazo)
+            ctx["total"] += notas
+            if not completo:
+                ctx["interrompida"] = True
+                break
+    finally:
+        if consumo:
+            resultado = consumo.encerrar()
+            print(f"  [Fila] Processados: {resultado['ok']} | Falhas: {resultado['falhas']}")
+    if lease and lease.perdido:
+        if fila:
+            fila.descartar_pendentes(emp['id'])
+        lease.verificar()
+
+def _finalizar_empresa(ctx, avancar_watermark=True):
+    """
+    Confirma as páginas concluídas, atualiza o resumo mensal e, se a empresa foi
+    sincronizada por inteiro, grava last_sync e o novo watermark.
+    """
+    emp = ctx["emp"]
+    # Páginas com todas as notas gravadas entram no cache
+    ctx["confirmacao"].confirmar()
+    descarregar_falhas()
+    densidade_cache.salvar()
+    
+    # Resumo mensal dos meses gravados
+    atualizar_resumo_mensal(supabase, meses_alterados)
+    if not avancar_watermark:
+        return
+    
+    # Atualizar last_sync e watermark da empresa
+    watermark = ctx["watermark"]
+    novo = ctx["progresso"].novo_watermark()
+    salvar_watermark(supabase, emp['id'], novo, watermark)
+    if novo and (not watermark or novo > watermark):
+        emp['sync_watermark'] = novo.isoformat()
+
+def sincronizar_empresa(emp, data_inicial, data_final, fila=None, workers=WORK_QUEUE_WORKERS, pular_paginas=True,
+                        lease=None):
+    """
+    Sincroniza [data_inicial, data_final] de uma empresa ({id, cnpj, sync_watermark})
+    e avança o watermark. Atualiza emp['sync_watermark'] e retorna o número de notas.
+    Com `pular_paginas=False` todas as páginas são reprocessadas (o cache é atualizado).
+    Com `lease`, LeasePerdido interrompe a empresa sem gravar watermark nem last_sync.
+    """
+    cnpj = emp['cnpj']
+    company_id = emp['id']
+    ctx = _contexto_empresa(emp, pular_paginas)
+    ctx["lease"] = lease
+    print(f"\n> Processando: {cnpj} ({data_inicial} a {data_final}, watermark: {ctx['watermark'] or 'nenhum'})")
+    
+    _sincronizar_meses(ctx, meses_entre(data_inicial, data_final), fila, workers)
+    if lease:
+        lease.verificar()
+    _finalizar_empresa(ctx)
+    print(f"  [OK] Concluído. Notas: {ctx['total']}")
+    return ctx["total"]
+
+def descarregar_falhas():
+    """Grava as falhas pendentes; se o Supabase recusar, o lote fica para o próximo descarregar."""
+    try:
+        falhas.descarregar()
+    except Exception as e:
+        print(f"  [Falhas] Erro ao gravar as falhas das notas: {e}")
+
+def retentar_falhas(fila=None, workers=WORK_QUEUE_WORKERS, max_tentativas=SYNC_RETRY_MAX_ATTEMPTS):
+    """
+    Reprocessa só as notas de sync_failures com a próxima tentativa vencida e abaixo
+    de `max_tentativas`, sem consultar os períodos na API. Quem falhar de novo volta
+    para sync_failures com a espera dobrada. Retorna (retentadas, gravadas).
+    """
+    headers = headers_plugnotas()
+    total, gravadas = 0, 0
+    for pagina in falhas_a_retentar(supabase, "plugnotas", max_tentativas):
+        print(f"  [Falhas] Retentando {len(pagina)} notas...")
+        total += len(pagina)
+        if fila:
+            for falha in pagina:
+                fila.enfileirar(falha["chave"], falha["payload"], grupo=GRUPO_RETENTATIVAS)
+            gravadas += executar_jobs(fila, processar_job, grupo=GRUPO_RETENTATIVAS, workers=workers)["ok"]
+        else:
+            for falha in pagina:
+                payload = falha["payload"]
+                try:
+                    ok = processar_nota(payload["nota"], payload["cnpj"], payload["company_id"],
+                                        payload["ano"], payload["mes"], headers)
+                except Exception as e:
+                    print(f"      [Erro] Falha ao processar nota {falha['chave']}: {e}")
+                    registrar_falha(payload, e)
+                    ok = False
+                gravadas += bool(ok)
+        descarregar_falhas()
+    atualizar_resumo_mensal(supabase, meses_alterados)
+    return total, gravadas
+
+def taxa_notas_por_dia(emp, dias=14):
+    """Notas por dia do CNPJ nos últimos `dias` dias (cache de densidade do window_planner)."""
+    densidade = densidade_cache.densidade(limpar_cnpj(emp['cnpj']))
+    hoje = datetime.now().date()
+    inicio = hoje - timedelta(days=dias)
+    return sum(v for d, v in densidade.items() if inicio < d <= hoje) / dias
+
+def sincronizar_com_prazo(empresas, periodo, prazo, fila=None, workers=WORK_QUEUE_WORKERS, pular_paginas=True):
+    """
+    Sincroniza as empresas em unidades (empresa, mês) na ordem de prioridade de
+    sync_deadline, parando antes de `prazo` (Prazo). `periodo(emp)` retorna
+    (data_inicial, data_final). Só as empresas com todos os meses concluídos
+    avançam last_sync/watermark; as unidades restantes ficam salvas para a
+    próxima execução, que começa por elas. Retorna o total de notas e a cobertura.
+    """
+    estado = EstadoPrazo()
+    por_id = {emp['id']: emp for emp in empresas}
+    unidades = [Unidade(emp['id'], ano, mes, ini, fim)
+                for emp in empresas for ano, mes, ini, fim in meses_entre(*periodo(emp))]
+    unidades = priorizar(unidades, por_id, taxa_notas_por_dia, estado.pendentes)
+    anteriores = set(estado.pendentes)
+    sobras = sum(1 for u in unidades if u.chave in anteriores)
+    print(f"  [Prazo] {len(unidades)} unidades (empresa/mês) até {prazo.limite.strftime('%H:%M:%S')}"
+          + (f", {sobras} da execução anterior" if sobras else ""))
+
+    restantes = Counter(u.company_id for u in unidades)
+    contextos = {}
+    concluidas = []
+    pendentes = []
+    for i, unidade in enumerate(unidades):
+        estimativa = estado.estimativa(unidade.company_id)
+        if not prazo.cabe(estimativa):
+            print(f"  [Prazo] Restam {prazo.restante():.0f}s; a próxima unidade leva ~{estimativa:.0f}s. Parando.")
+            pendentes = unidades[i:]
+            break
+        emp = por_id[unidade.company_id]
+        ctx = contextos.get(unidade.company_id)
+        if ctx is None:
+            ctx = contextos[unidade.company_id] = _contexto_empresa(emp, pular_paginas)
+        print(f"\n> {emp['cnpj']} {unidade.mes:02d}/{unidade.ano} ({unidade.data_inicial} a {unidade.data_final})")
+
+        inicio = time.monotonic()
+        _sincronizar_meses(ctx, [(unidade.ano, unidade.mes, unidade.data_inicial, unidade.data_final)],
+                           fila, workers, prazo.parar_em)
+        if ctx["interrompida"]:
+            # Prazo atingido no meio da paginação: a unidade é refeita na próxima execução
+            pendentes = unidades[i:]
+            break
+        if fila:
+            if fila.contagem(emp['id'])["pending"]:
+                # Prazo atingido no meio da unidade: os jobs restantes ficam na fila
+                print("  [Prazo] Prazo atingido com jobs pendentes na fila.")
+                pendentes = unidades[i:]
+                break
+        estado.registrar_duracao(unidade.company_id, time.monotonic() - inicio)
+        concluidas.append(unidade)
+        restantes[unidade.company_id] -= 1
+        if not restantes[unidade.company_id]:
+            _finalizar_empresa(ctx)
+            print(f"  [OK] Empresa concluída. Notas: {ctx['total']}")
+
+    # Empresas interrompidas: guarda as páginas concluídas, mas não avança last_sync/watermark
+    for company_id in {u.company_id for u in pendentes} & contextos.keys():
+        _finalizar_empresa(contextos[company_id], avancar_watermark=False)
+    estado.salvar(pendentes)
+
+    hoje = datetime.now().date()
+    mes_atual = [u for u in unidades if (u.ano, u.mes) == (hoje.year, hoje.month)]
+    feitas = set(concluidas)
+    cobertura = {
+        "prazo": prazo.limite.isoformat(),
+        "interrompida": bool(pendentes),
+        "unidades": len(unidades),
+        "unidades_concluidas": len(concluidas),
+        "unidades_pendentes": len(pendentes),
+        "empresas": len(por_id),
+        "empresas_concluidas": sum(1 for company_id in por_id if not restantes[company_id]),
+        "mes_atual_concluido": sum(1 for u in mes_atual if u in feitas) / len(mes_atual) if mes_atual else 1.0,
+        "segundos_restantes": round(prazo.restante()),
+    }
+    print(f"  [Prazo] Concluídas {cobertura['unidades_concluidas']}/{cobertura['unidades']} unidades | "
+          f"empresas completas: {cobertura['empresas_concluidas']}/{cobertura['empresas']} | "
+          f"mês atual: {cobertura['mes_atual_concluido']:.0%}")
+    return sum(ctx["total"] for ctx in contextos.values()), cobertura
+
+def executar_retentativas(args):
+    """Modo --retentar-falhas: só as notas de sync_failures, sem varrer as empresas."""
+    print(f"\n--- Retentando Notas com Falha ({datetime.now().strftime('%d/%m/%Y %H:%M')}) ---")
+    if args.escrita_async:
+        ativar_escrita_async()
+    try:
+        fila = None if args.sem_fila else FilaTrabalho()
+        if fila:
+            fila.recuperar_interrompidos()
+        total, gravadas = retentar_falhas(fila, args.workers, args.max_tentativas)
+        registrar_log('completed', notes=gravadas, metadata={"modo": "retentar_falhas", "retentadas": total,
+                                                             **falhas.extrair_contadores()})
+        print(f"\n--- Retentativas Finalizadas. Notas: {total} | Gravadas: {gravadas} | "
+              f"Ainda com falha: {total - gravadas} ---")
+    except Exception as e:
+        registrar_log('failed', error=str(e))
+        print(f"Erro Crítico nas retentativas: {e}")
+    finally:
+        encerrar_escrita_async()
+
 def main():
+    parser = argparse.ArgumentParser(description="Sincronização horária PlugNotas -> S3 -> Supabase.")
+    parser.add_argument("--backfill", nargs=2, metavar=("FROM", "TO"),
+                        help="Sincroniza o histórico completo entre FROM e TO (YYYY-MM-DD), ignorando o watermark")
+    parser.add_argument("--lookback", type=int, default=SYNC_LOOKBACK_DAYS,
+                        help="Dias antes do watermark reconsultados para pegar notas atrasadas")
+    parser.add_argument("--sem-fila", action="store_true",
+                        help="Processa cada nota na hora, sem a fila local durável")
+    parser.add_argument("--workers", type=int, default=WORK_QUEUE_WORKERS,
+                        help="Workers que consomem a fila local")
+    parser.add_argument("--revalidar-paginas", action="store_true",
+                        help="Reprocessa todas as páginas, mesmo as iguais à última execução")
+    parser.add_argument("--shard", metavar="i/N",
+                        help="Só as empresas do shard i de N (0..N-1), por hash estável do CNPJ")
+    parser.add_argument("--lease", action="store_true",
+                        help="Reivindica as empresas na tabela sync_leases (vários workers em paralelo)")
+    parser.add_argument("--escrita-async", action="store_true", default=POSTGREST_ASYNC,
+                        help="Grava pelo escritor assíncrono do PostgREST (lotes em voo, requer httpx)")
+    parser.add_argument("--deadline", metavar="PRAZO",
+                        help="Para antes do prazo (minutos, ex.: 50 ou 1h30m, ou horário HH:MM), começando pelo "
+                             "mês atual e pelas empresas mais atrasadas; o que sobrar fica para a próxima execução")
+    parser.add_argument("--retentar-falhas", action="store_true",
+                        help="Reprocessa só as notas que falharam (sync_failures) e cuja espera já venceu")
+    parser.add_argument("--max-tentativas", type=int, default=SYNC_RETRY_MAX_ATTEMPTS,
+                        help="Com --retentar-falhas, ignora as notas que já falharam este número de vezes")
+    args = parser.parse_args()
+    try:
+        shard = parse_shard(args.shard) if args.shard else None
+        prazo = Prazo(parse_deadline(args.deadline)) if args.deadline else None
+    except ValueError as e:
+        parser.error(str(e))
+    if prazo and args.lease:
+        parser.error("--deadline não combina com --lease (com lease, a ordem das empresas vem do banco)")
+    if args.retentar_falhas and (prazo or args.lease or args.backfill):
+        parser.error("--retentar-falhas não combina com --deadline, --lease ou --backfill")
+
+    if args.retentar_falhas:
+        executar_retentativas(args)
+        return
+
     print(f"\n--- Iniciando Sincronização Horária ({datetime.now().strftime('%d/%m/%Y %H:%M')}) ---")
     
     # 0. Corrigir registros legados sem valor ou endereço
     corrigir_registros_incompletos()
     
+    if args.escrita_async:
+        ativar_escrita_async()
     try:
-        # 1. Buscar empresas ativas do banco
-        empresas = supabase.table("companies").select("id, cnpj").eq("active", True).execute()
-        if not empresas.data:
-            print("Nenhuma empresa ativa encontrada para sincronização.")
-            return
+        inicio_execucao = datetime.now(timezone.utc).isoformat()
+        worker = id_worker()
+        if not args.lease:
+            # 1. Buscar empresas ativas do banco (só as do shard, se houver)
+            empresas = supabase.table("companies").select("id, cnpj, sync_watermark, last_sync").eq("active", True).execute()
+            empresas = filtrar_shard(empresas.data or [], shard)
+            if not empresas:
+                print("Nenhuma empresa ativa encontrada para sincronização.")
+                return
+            if shard:
+                print(f"  [Shard {shard[0]}/{shard[1]}] {len(empresas)} empresas.")
 
         total_global = 0
-        now = datetime.now()
-        
-        # Sincroniza o mês atual e o anterior para garantir que nada foi perdido
-        meses_a_sincronizar = [
-            (now.year, now.month),
-            ((now - timedelta(days=28)).year, (now - timedelta(days=28)).month)
-        ]
-        # Remover duplicata se for o mesmo mês
-        meses_a_sincronizar = list(set(meses_a_sincronizar))
-
-        for emp in empresas.data:
-            cnpj = emp['cnpj']
-            company_id = emp['id']
-            print(f"\n> Processando: {cnpj}")
-            
-            total_empresa = 0
-            for ano, mes in meses_a_sincronizar:
-                total_empresa += sync_periodo(cnpj, company_id, ano, mes)
-            
-            # Atualizar last_sync da empresa
-            supabase.table("companies").update({"last_sync": now.isoformat()}).eq("id", company_id).execute()
-            print(f"  [OK] Concluído. Notas: {total_empresa}")
-            total_global += total_empresa
-
-        registrar_log('completed', notes=total_global)
-        print(f"\n--- Sincronização Finalizada. Total de Notas: {total_global} ---")
+        cobertura = None
+        backfill = parse_backfill(args.backfill) if args.backfill else None
+
+        # Fila durável: jobs de uma execução interrompida continuam de onde pararam
+        fila = None if args.sem_fila else FilaTrabalho()
+        monitor = None
+        if fila:
+            fila.recuperar_interrompidos()
+            pendentes = fila.contagem()["pending"]
+            if pendentes:
+                print(f"  [Fila] Retomando execução anterior: {pendentes} jobs pendentes.")
+            monitor = MonitorFila(fila)
+            monitor.start()
+
+        def periodo(emp):
+            return backfill or periodo_incremental(emp, args.lookback)
+
+        def sincronizar(emp, lease=None):
+            data_inicial, data_final = periodo(emp)
+            return sincronizar_empresa(emp, data_inicial, data_final, fila, args.workers,
+                                       pular_paginas=not args.revalidar_paginas, lease=lease)
+
+        if args.lease:
+            # 1. Empresas reivindicadas uma a uma no banco, até não sobrar nenhuma
+            # não sincronizada desde o início desta execução (nem com lease de outro worker)
+            print(f"  [Lease] Worker {worker}" + (f", shard {shard[0]}/{shard[1]}" if shard else ""))
+            while True:
+                emp = reivindicar_proxima(supabase, worker, inicio_execucao, shard)
+                if not emp:
+                    break
+                # Uma empresa com erro não encerra a execução (o lease dela é liberado com espera)
+                try:
+                    with Lease(supabase, emp["id"], worker) as lease:
+                        total_global += sincronizar(emp, lease)
+                except LeasePerdido as e:
+                    print(f"  [Lease] ⚠️ {emp['cnpj']} interrompida: {e}")
+                except Exception as e:
+                    print(f"  [Erro] Falha ao sincronizar {emp['cnpj']}: {e}")
+        elif prazo:
+            # 1. Unidades (empresa, mês) por prioridade, até o prazo
+            total_global, cobertura = sincronizar_com_prazo(empresas, periodo, prazo, fila, args.workers,
+                                                            pular_paginas=not args.revalidar_paginas)
+        else:
+            for emp in empresas:
+                total_global += sincronizar(emp)
+
+        if fila:
+            # Jobs restantes de execuções anteriores (ex.: empresas que deixaram de estar ativas)
+            executar_jobs(fila, processar_job, workers=args.workers, prazo=prazo.parar_em if prazo else None)
+            monitor.parar()
+            # Com jobs pendentes (prazo atingido), os concluídos ficam para a próxima execução pulá-los
+            if not fila.contagem()["pending"]:
+                fila.limpar_concluidos()
+
+        descarregar_falhas()
+        cache_paginas.limpar_antigas()
+        puladas = cache_paginas.extrair_contadores()
+        metadata = {**puladas, **partes.extrair_contadores(), **falhas.extrair_contadores()}
+        if cobertura:
+            metadata["cobertura"] = cobertura
+        registrar_log('completed', notes=total_global, metadata=metadata)
+        print(f"\n--- Sincronização Finalizada. Total de Notas: {total_global} "
+              f"(páginas sem alteração: {puladas['paginas_puladas']}, notas puladas: {puladas['notas_puladas']}) ---")
 
     except Exception as e:
         registrar_log('failed', error=str(e))
         print(f"Erro Crítico na main: {e}")
+    finally:
+        encerrar_escrita_async()
 
 if __name__ == "__main__":
     main()
@@ -1,67 +1,280 @@
+"""
+Pré-verificação das dependências da sincronização (S3, PlugNotas, PostgREST).
 
+Para cada serviço confere as credenciais com uma requisição e depois mede, em
+paralelo entre os serviços, N requisições por endpoint em níveis crescentes de
+concorrência: latência p50/p95/p99 e requisições por segundo sustentadas. Ao
+final recomenda os valores de HTTP_POOL_SIZE, WORK_QUEUE_WORKERS e
+DAEMON_CONCURRENCY para a sincronização.
+
+Endpoints configuráveis (para rodar contra serviços locais de teste):
+    S3_ENDPOINT_URL, PLUGNOTAS_URL, SUPABASE_URL
+
+Uso:
+    python scripts/test_keys.py
+    python scripts/test_keys.py --requisicoes 50 --niveis 1,4,8,16,32
+    python scripts/test_keys.py --servicos plugnotas,postgrest --cnpj 25249058000102
+"""
+import argparse
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from typing import Callable, Dict, List, Optional
+
 import requests
-import boto3
-from supabase import create_client
 from dotenv import load_dotenv
 
-# Carregar variáveis de ambiente
-load_dotenv()
+# Carregar variáveis de ambiente do .env local da pasta de scripts
+load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
 
-def test_aws():
-    print("[1/3] Testando AWS S3...")
-    try:
-        s3 = boto3.client(
-            "s3",
-            aws_access_key_id=os.getenv("AWS_ACCESS_KEY"),
-            aws_secret_access_key=os.getenv("AWS_SECRET_KEY"),
-            region_name=os.getenv("AWS_REGION")
-        )
-        s3.list_objects_v2(Bucket=os.getenv("AWS_BUCKET"), MaxKeys=1)
-        print("✅ AWS S3: Conexão ok!")
-        return True
-    except Exception as e:
-        print(f"❌ AWS S3: Erro -> {e}")
-        return False
+PLUGNOTAS_URL = os.getenv("PLUGNOTAS_URL", "https://api.plugnotas.com.br").rstrip("/")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+SUPABASE_URL = (os.getenv("SUPABASE_URL") or "").rstrip("/")
+
+SERVICOS = ("s3", "plugnotas", "postgrest")
+NIVEIS_PADRAO = (1, 4, 8, 16)
+GANHO_MINIMO = 1.15       # subir a concorrência precisa render 15% a mais de req/s
+PIORA_P95_MAXIMA = 3.0    # ... sem multiplicar o p95 da concorrência 1 por mais que isso
+
+
+def percentil(ordenados: List[float], p: float) -> float:
+    if not ordenados:
+        return 0.0
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def medir(funcao: Callable[[], None], total: int, concorrencia: int) -> Dict:
+    """Executa `total` chamadas com `concorrencia` threads; latências em ms."""
+    def cronometrar(_):
+        inicio = time.perf_counter()
+        try:
+            funcao()
+            return (time.perf_counter() - inicio) * 1000, None
+        except Exception as e:
+            return (time.perf_counter() - inicio) * 1000, f"{type(e).__name__}: {e}"
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concorrencia) as pool:
+        resultados = list(pool.map(cronometrar, range(total)))
+    duracao = time.perf_counter() - inicio
+
+    latencias = sorted(ms for ms, erro in resultados if erro is None)
+    erros = [erro for _, erro in resultados if erro is not None]
+    return {
+        "concorrencia": concorrencia,
+        "ok": len(latencias),
+        "erros": len(erros),
+        "primeiro_erro": erros[0] if erros else None,
+        "p50": percentil(latencias, 50),
+        "p95": percentil(latencias, 95),
+        "p99": percentil(latencias, 99),
+        "rps": len(latencias) / duracao if duracao else 0.0,
+    }
+
+
+def sondar(funcao: Callable[[], None], total: int, niveis: List[int]) -> List[Dict]:
+    """
+    Mede cada nível de concorrência em ordem e para de subir quando aparecem erros
+    (limite de taxa, conexões recusadas) ou a vazão deixa de crescer.
+    """
+    medicoes = []
+    for nivel in niveis:
+        # Pelo menos 4 requisições por thread, senão a vazão medida é só o aquecimento
+        medicao = medir(funcao, max(total, nivel * 4), nivel)
+        medicoes.append(medicao)
+        if medicao["erros"]:
+            break
+        if len(medicoes) > 1 and medicao["rps"] < medicoes[-2]["rps"] * GANHO_MINIMO:
+            break
+    return medicoes
+
+
+def concorrencia_recomendada(medicoes: List[Dict]) -> int:
+    """Maior nível sem erros em que a vazão ainda crescia e o p95 continuava aceitável."""
+    if not medicoes or medicoes[0]["erros"]:
+        return 1
+    base_p95 = medicoes[0]["p95"] or 1.0
+    melhor = medicoes[0]
+    for anterior, medicao in zip(medicoes, medicoes[1:]):
+        if medicao["erros"] or medicao["p95"] > base_p95 * PIORA_P95_MAXIMA:
+            break
+        if medicao["rps"] < anterior["rps"] * GANHO_MINIMO:
+            break
+        melhor = medicao
+    return melhor["concorrencia"]
+
+
+# ---------- Endpoints ----------
+
+def endpoints_s3(tamanho_pool: int) -> Dict[str, Callable[[], None]]:
+    import boto3
+    from botocore.config import Config
+
+    bucket = os.getenv("AWS_BUCKET", "plug-notas")
+    s3 = boto3.client(
+        "s3",
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_KEY"),
+        region_name=os.getenv("AWS_REGION", "sa-east-1"),
+        endpoint_url=S3_ENDPOINT_URL,
+        config=Config(signature_version="s3v4", max_pool_connections=tamanho_pool),
+    )
+    # Conferência das credenciais e uma chave real para o head
+    listagem = s3.list_objects_v2(Bucket=bucket, Prefix="notas/", MaxKeys=1)
+    chave = (listagem.get("Contents") or [{}])[0].get("Key")
+
+    endpoints = {
+        "S3 list": lambda: s3.list_objects_v2(Bucket=bucket, Prefix="notas/", MaxKeys=1),
+        "S3 presign": lambda: s3.generate_presigned_url(
+            "get_object", Params={"Bucket": bucket, "Key": chave or "notas/"}, ExpiresIn=3600),
+    }
+    if chave:
+        endpoints["S3 head"] = lambda: s3.head_object(Bucket=bucket, Key=chave)
+    return endpoints
+
+
+def _sessao(tamanho_pool: int) -> requests.Session:
+    sessao = requests.Session()
+    adaptador = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=tamanho_pool)
+    sessao.mount("https://", adaptador)
+    sessao.mount("http://", adaptador)
+    return sessao
+
+
+def _get(sessao: requests.Session, url: str, **kwargs) -> Callable[[], None]:
+    def chamada():
+        response = sessao.get(url, timeout=30, **kwargs)
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+    return chamada
 
-def test_plugnotas():
-    print("\n[2/3] Testando PlugNotas API...")
+
+def headers_postgrest() -> Dict:
+    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+    return {"apikey": key, "Authorization": f"Bearer {key}"}
+
+
+def cnpj_para_teste() -> Optional[str]:
+    """CNPJ de uma empresa ativa, para a consulta de período na PlugNotas."""
+    response = requests.get(f"{SUPABASE_URL}/rest/v1/companies", headers=headers_postgrest(),
+                            params={"select": "cnpj", "active": "eq.true", "limit": 1}, timeout=30)
+    response.raise_for_status()
+    dados = response.json()
+    return dados[0]["cnpj"] if dados else None
+
+
+def endpoints_plugnotas(cnpj: Optional[str], tamanho_pool: int) -> Dict[str, Callable[[], None]]:
+    sessao = _sessao(tamanho_pool)
+    headers = {"X-API-KEY": os.getenv("PLUGNOTAS_API_KEY")}
+    _get(sessao, f"{PLUGNOTAS_URL}/empresa", headers=headers)()
+    cnpj = "".join(c for c in (cnpj or cnpj_para_teste() or "") if c.isdigit())
+    if not cnpj:
+        raise RuntimeError("nenhum CNPJ para a consulta de período (use --cnpj)")
+    fim = date.today()
+    # Mesma consulta da sincronização (sync_periodo), numa janela de 7 dias
+    params = {"dataInicial": (fim - timedelta(days=7)).isoformat(), "dataFinal": fim.isoformat(),
+              "ator": 2, "quantidade": 50}
+    return {"PlugNotas período": _get(sessao, f"{PLUGNOTAS_URL}/nfse/nacional/{cnpj}/consultar/periodo",
+                                      headers=headers, params=params)}
+
+
+def endpoints_postgrest(tamanho_pool: int) -> Dict[str, Callable[[], None]]:
+    sessao = _sessao(tamanho_pool)
+    chamada = _get(sessao, f"{SUPABASE_URL}/rest/v1/service_notes", headers=headers_postgrest(),
+                   params={"select": "id,nota_id,cnpj_tomador", "order": "id", "limit": 50})
+    chamada()
+    return {"PostgREST select": chamada}
+
+
+# ---------- Execução ----------
+
+def verificar_servico(servico: str, args) -> Dict:
+    """Confere as credenciais e mede os endpoints de um serviço (roda numa thread por serviço)."""
+    # Pool de conexões do tamanho do maior nível, para o pool não virar o gargalo medido
+    tamanho_pool = max(args.niveis)
     try:
-        headers = {"X-API-KEY": os.getenv("PLUGNOTAS_API_KEY")}
-        # Testa listando empresas (endpoint simples)
-        response = requests.get("https://api.plugnotas.com.br/empresa", headers=headers)
-        if response.status_code == 200:
-            print("✅ PlugNotas: Conexão ok!")
-            return True
+        if servico == "s3":
+            endpoints = endpoints_s3(tamanho_pool)
+        elif servico == "plugnotas":
+            endpoints = endpoints_plugnotas(args.cnpj, tamanho_pool)
         else:
-            print(f"❌ PlugNotas: Erro {response.status_code} -> {response.text}")
-            return False
+            endpoints = endpoints_postgrest(tamanho_pool)
     except Exception as e:
-        print(f"❌ PlugNotas: Erro -> {e}")
-        return False
+        return {"servico": servico, "erro": f"{type(e).__name__}: {e}", "endpoints": {}}
+    return {
+        "servico": servico,
+        "erro": None,
+        "endpoints": {nome: sondar(funcao, args.requisicoes, args.niveis) for nome, funcao in endpoints.items()},
+    }
 
-def test_supabase():
-    print("\n[3/3] Testando Supabase...")
-    try:
-        url = os.getenv("SUPABASE_URL")
-        key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-        supabase = create_client(url, key)
-        res = supabase.table("companies").select("count").execute()
-        print("✅ Supabase: Conexão ok!")
-        return True
-    except Exception as e:
-        print(f"❌ Supabase: Erro -> {e}")
-        return False
 
-if __name__ == "__main__":
-    print("=== INICIANDO TESTE DE CREDENCIAIS ===\n")
-    aws = test_aws()
-    plug = test_plugnotas()
-    supa = test_supabase()
-    
-    print("\n" + "="*40)
-    if aws and plug and supa:
-        print("🎯 TUDO PRONTO! Todas as chaves estão corretas.")
-    else:
+def imprimir_resultado(resultado: Dict):
+    if resultado["erro"]:
+        print(f"❌ {resultado['servico']}: {resultado['erro']}")
+        return
+    for nome, medicoes in resultado["endpoints"].items():
+        print(f"\n✅ {nome}")
+        print(f"  {'conc.':>5} {'ok':>5} {'erros':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8}")
+        for m in medicoes:
+            print(f"  {m['concorrencia']:>5} {m['ok']:>5} {m['erros']:>5} {m['p50']:>8.1f} {m['p95']:>8.1f} "
+                  f"{m['p99']:>8.1f} {m['rps']:>8.1f}")
+            if m["primeiro_erro"]:
+                print(f"        ⚠️ {m['primeiro_erro']}")
+        print(f"  👉 concorrência sustentável: {concorrencia_recomendada(medicoes)}")
+
+
+def recomendar(resultados: Dict[str, Dict]):
+    def nivel(servico: str) -> Optional[int]:
+        endpoints = resultados.get(servico, {}).get("endpoints") or {}
+        niveis = [concorrencia_recomendada(m) for nome, m in endpoints.items() if "presign" not in nome]
+        return min(niveis) if niveis else None
+
+    plugnotas, s3, postgrest = nivel("plugnotas"), nivel("s3"), nivel("postgrest")
+    print("\n" + "=" * 60)
+    print("⚙️  CONFIGURAÇÃO RECOMENDADA (scripts/.env)")
+    # Os workers da fila fazem download da PlugNotas + upload no S3 + gravação no Supabase
+    medidos = [n for n in (plugnotas, s3, postgrest) if n]
+    workers = min(medidos) if medidos else None
+    if plugnotas:
+        print(f"  HTTP_POOL_SIZE={plugnotas}")
+    if workers:
+        print(f"  WORK_QUEUE_WORKERS={workers}")
+    if plugnotas and workers:
+        # Cada empresa sincronizada pelo daemon usa até WORK_QUEUE_WORKERS conexões com a PlugNotas
+        print(f"  DAEMON_CONCURRENCY={max(1, plugnotas // workers)}")
+    print("=" * 60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pré-verificação de credenciais, latência e vazão das dependências.")
+    parser.add_argument("--requisicoes", type=int, default=20, help="Requisições por endpoint em cada nível")
+    parser.add_argument("--niveis", type=lambda v: sorted({int(n) for n in v.split(",")}),
+                        default=list(NIVEIS_PADRAO), help="Níveis de concorrência (ex.: 1,4,8,16)")
+    parser.add_argument("--servicos", type=lambda v: [s.strip() for s in v.split(",")],
+                        default=list(SERVICOS), help="Serviços a verificar: s3,plugnotas,postgrest")
+    parser.add_argument("--cnpj", help="CNPJ para a consulta de período (padrão: uma empresa ativa)")
+    args = parser.parse_args()
+    invalidos = set(args.servicos) - set(SERVICOS)
+    if invalidos:
+        parser.error(f"serviços desconhecidos: {', '.join(sorted(invalidos))}")
+
+    print("=== PRÉ-VERIFICAÇÃO DAS DEPENDÊNCIAS ===")
+    print(f"🔁 {args.requisicoes} requisições por endpoint | concorrência {args.niveis} | "
+          f"serviços em paralelo: {', '.join(args.servicos)}\n")
+    with ThreadPoolExecutor(max_workers=len(args.servicos)) as pool:
+        resultados = {r["servico"]: r for r in pool.map(lambda s: verificar_servico(s, args), args.servicos)}
+
+    for servico in args.servicos:
+        imprimir_resultado(resultados[servico])
+    recomendar(resultados)
+
+    if any(r["erro"] for r in resultados.values()):
         print("⚠️ ATENÇÃO: Verifique os erros acima antes de prosseguir.")
-    print("="*40)
+        sys.exit(1)
+    print("🎯 TUDO PRONTO! Todas as chaves estão corretas.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+-- Watermark incremental por empresa para os fetchers da PlugNotas
+-- sync_watermark guarda a última data_emissao sincronizada com sucesso;
+-- as próximas execuções só consultam a partir dela (menos o lookback).
+
+ALTER TABLE companies
+ADD COLUMN IF NOT EXISTS last_sync TIMESTAMPTZ,
+ADD COLUMN IF NOT EXISTS sync_watermark DATE;
@@ -0,0 +1,40 @@
+-- Adoção do ID do PlugNotas pelas notas gravadas com ID de fallback
+-- O sync do bucket grava a nota como `{numero}_{cnpj_prestador}` quando ainda não
+-- conhece o ID do PlugNotas. O sync da API grava nota a nota por nota_id, então,
+-- sem esta etapa, a mesma nota ficaria duas vezes em service_notes. Recebe as
+-- notas de uma página da API: [{nota_id, numero_nfse, cnpj_tomador, cnpj_prestador}, ...]
+-- (CNPJs canônicos) e troca o nota_id do registro de fallback de mesma identidade
+-- pelo ID oficial, como bulk_upsert_service_notes(preferir_id_da_origem=True).
+CREATE OR REPLACE FUNCTION adopt_plugnotas_ids(itens JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+DECLARE
+  v_adotadas INTEGER;
+BEGIN
+  WITH entrada AS (
+    SELECT DISTINCT ON (i.nota_id) i.nota_id, i.numero_nfse, i.cnpj_tomador, i.cnpj_prestador
+    FROM jsonb_to_recordset(itens) AS i(nota_id VARCHAR(100), numero_nfse VARCHAR(50),
+                                        cnpj_tomador VARCHAR(18), cnpj_prestador VARCHAR(18))
+    WHERE i.nota_id ~ '^[0-9a-f]{24}$' AND i.numero_nfse IS NOT NULL
+  ), alvo AS (
+    -- Um registro de fallback por nota; os demais ficam para merge_service_notes_duplicates
+    SELECT DISTINCT ON (e.nota_id) n.id, e.nota_id
+    FROM entrada e
+    JOIN service_notes n
+      ON n.numero_nfse = e.numero_nfse
+     AND n.cnpj_tomador = e.cnpj_tomador
+     AND n.cnpj_prestador = e.cnpj_prestador
+    WHERE n.nota_id !~ '^[0-9a-f]{24}$'
+      AND NOT EXISTS (SELECT 1 FROM service_notes d WHERE d.nota_id = e.nota_id)
+    ORDER BY e.nota_id, n.updated_at DESC NULLS LAST, n.id
+  )
+  UPDATE service_notes n SET nota_id = a.nota_id
+  FROM alvo a
+  WHERE n.id = a.id;
+
+  GET DIAGNOSTICS v_adotadas = ROW_COUNT;
+  RETURN v_adotadas;
+END;
+$$;
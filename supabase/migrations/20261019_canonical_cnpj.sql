@@ -0,0 +1,93 @@
+-- Forma canônica dos CNPJs e merge set-based de notas duplicadas
+-- service_notes guarda CNPJs formatados (00.000.000/0001-91); companies guarda só dígitos.
+
+-- 1. Colunas de CNPJ de service_notes comportam o formato canônico (18 caracteres)
+ALTER TABLE service_notes ALTER COLUMN cnpj_tomador TYPE VARCHAR(18);
+ALTER TABLE service_notes ALTER COLUMN cnpj_prestador TYPE VARCHAR(18);
+
+-- Busca por chave semântica (número + prestador) usada pelos scripts de sync
+CREATE INDEX IF NOT EXISTS idx_service_notes_numero_prestador ON service_notes(numero_nfse, cnpj_prestador);
+
+-- 2. Normalização de CNPJ (mesma regra de cnpj_canon.canonical_cnpj)
+CREATE OR REPLACE FUNCTION canonical_cnpj(valor TEXT)
+RETURNS TEXT
+LANGUAGE sql IMMUTABLE AS $$
+  SELECT CASE
+    WHEN valor IS NULL THEN NULL
+    WHEN length(regexp_replace(valor, '\D', '', 'g')) = 14 THEN
+      regexp_replace(regexp_replace(valor, '\D', '', 'g'), '^(\d{2})(\d{3})(\d{3})(\d{4})(\d{2})$', '\1.\2.\3/\4-\5')
+    ELSE NULLIF(regexp_replace(valor, '\D', '', 'g'), '')
+  END
+$$;
+
+-- 3. Merge único dos duplicados já gravados
+-- Agrupa por tomador + número + prestador (canônicos), mantém o registro com ID do
+-- PlugNotas (ou o mais recente), completa os campos vazios dele com os dos
+-- duplicados e remove o resto em lote.
+CREATE OR REPLACE FUNCTION merge_service_notes_duplicates()
+RETURNS TABLE (cnpjs_normalizados BIGINT, registros_mesclados BIGINT, duplicados_removidos BIGINT)
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+DECLARE
+  v_normalizados BIGINT;
+  v_mesclados BIGINT;
+  v_removidos BIGINT;
+BEGIN
+  CREATE TEMP TABLE _grupos ON COMMIT DROP AS
+  SELECT id,
+         first_value(id) OVER w AS manter_id,
+         row_number() OVER w AS posicao
+  FROM service_notes
+  WINDOW w AS (
+    PARTITION BY canonical_cnpj(cnpj_tomador), numero_nfse, canonical_cnpj(cnpj_prestador)
+    ORDER BY (nota_id ~ '^[0-9a-f]{24}$') DESC, updated_at DESC NULLS LAST, id
+  );
+
+  DELETE FROM _grupos
+  WHERE manter_id IN (SELECT manter_id FROM _grupos GROUP BY manter_id HAVING count(*) = 1);
+
+  UPDATE service_notes n SET
+    company_id = COALESCE(n.company_id, d.company_id),
+    s3_path_pdf = COALESCE(n.s3_path_pdf, d.s3_path_pdf),
+    s3_path_xml = COALESCE(n.s3_path_xml, d.s3_path_xml),
+    download_url_pdf = COALESCE(n.download_url_pdf, d.download_url_pdf),
+    download_url_xml = COALESCE(n.download_url_xml, d.download_url_xml),
+    valor_total = COALESCE(n.valor_total, d.valor_total),
+    descricao_servico = COALESCE(n.descricao_servico, d.descricao_servico),
+    codigo_servico = COALESCE(n.codigo_servico, d.codigo_servico)
+  FROM (
+    SELECT g.manter_id,
+      (array_agg(s.company_id ORDER BY g.posicao) FILTER (WHERE s.company_id IS NOT NULL))[1] AS company_id,
+      (array_agg(s.s3_path_pdf ORDER BY g.posicao) FILTER (WHERE s.s3_path_pdf IS NOT NULL))[1] AS s3_path_pdf,
+      (array_agg(s.s3_path_xml ORDER BY g.posicao) FILTER (WHERE s.s3_path_xml IS NOT NULL))[1] AS s3_path_xml,
+      (array_agg(s.download_url_pdf ORDER BY g.posicao) FILTER (WHERE s.download_url_pdf IS NOT NULL))[1] AS download_url_pdf,
+      (array_agg(s.download_url_xml ORDER BY g.posicao) FILTER (WHERE s.download_url_xml IS NOT NULL))[1] AS download_url_xml,
+      (array_agg(s.valor_total ORDER BY g.posicao) FILTER (WHERE s.valor_total IS NOT NULL))[1] AS valor_total,
+      (array_agg(s.descricao_servico ORDER BY g.posicao) FILTER (WHERE s.descricao_servico IS NOT NULL))[1] AS descricao_servico,
+      (array_agg(s.codigo_servico ORDER BY g.posicao) FILTER (WHERE s.codigo_servico IS NOT NULL))[1] AS codigo_servico
+    FROM _grupos g
+    JOIN service_notes s ON s.id = g.id
+    WHERE g.posicao > 1
+    GROUP BY g.manter_id
+  ) d
+  WHERE n.id = d.manter_id;
+  GET DIAGNOSTICS v_mesclados = ROW_COUNT;
+
+  DELETE FROM service_notes s USING _grupos g WHERE s.id = g.id AND g.posicao > 1;
+  GET DIAGNOSTICS v_removidos = ROW_COUNT;
+
+  UPDATE service_notes SET
+    cnpj_tomador = canonical_cnpj(cnpj_tomador),
+    cnpj_prestador = canonical_cnpj(cnpj_prestador)
+  WHERE cnpj_tomador IS DISTINCT FROM canonical_cnpj(cnpj_tomador)
+     OR cnpj_prestador IS DISTINCT FROM canonical_cnpj(cnpj_prestador);
+  GET DIAGNOSTICS v_normalizados = ROW_COUNT;
+
+  UPDATE companies c SET cnpj = regexp_replace(c.cnpj, '\D', '', 'g')
+  WHERE c.cnpj ~ '\D'
+    AND NOT EXISTS (SELECT 1 FROM companies o WHERE o.cnpj = regexp_replace(c.cnpj, '\D', '', 'g'));
+
+  RETURN QUERY SELECT v_normalizados, v_mesclados, v_removidos;
+END;
+$$;
@@ -0,0 +1,21 @@
+-- Renovação das URLs de download em lote (update_download_urls.py)
+-- Aplica uma página [{id, download_url_pdf, download_url_xml}, ...] num único UPDATE,
+-- em vez de uma requisição por nota. URL ausente no item mantém a atual.
+CREATE OR REPLACE FUNCTION update_service_note_download_urls(itens JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+DECLARE
+  v_atualizadas INTEGER;
+BEGIN
+  UPDATE service_notes n SET
+    download_url_pdf = COALESCE(i.download_url_pdf, n.download_url_pdf),
+    download_url_xml = COALESCE(i.download_url_xml, n.download_url_xml)
+  FROM jsonb_to_recordset(itens) AS i(id UUID, download_url_pdf TEXT, download_url_xml TEXT)
+  WHERE n.id = i.id;
+
+  GET DIAGNOSTICS v_atualizadas = ROW_COUNT;
+  RETURN v_atualizadas;
+END;
+$$;
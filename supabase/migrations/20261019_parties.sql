@@ -0,0 +1,87 @@
+-- Tomadores e prestadores normalizados (parties.py)
+-- O JSON de tomador/prestador da PlugNotas deixa de ser repetido em cada nota:
+-- fica uma vez por CNPJ, com o hash do JSON para só regravar quando ele muda.
+-- As notas referenciam as partes pelo CNPJ canônico que já gravam
+-- (service_notes.cnpj_tomador / cnpj_prestador); sem FK, para a nota não
+-- depender da ordem de gravação.
+CREATE TABLE IF NOT EXISTS parties (
+  cnpj VARCHAR(18) PRIMARY KEY,           -- canônico, igual a service_notes.cnpj_*
+  dados JSONB NOT NULL,                   -- último JSON recebido da PlugNotas
+  hash CHAR(32) NOT NULL,                 -- md5 do JSON canônico (ver parties.hash_parte)
+  data_referencia DATE,                   -- emissão da nota de onde veio o JSON
+  created_at TIMESTAMPTZ DEFAULT NOW(),
+  updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+ALTER TABLE parties ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Enable read access for authenticated users" ON parties
+  FOR SELECT USING (auth.role() = 'authenticated');
+
+-- Gravação em lote: [{cnpj, dados, hash, data_referencia}, ...]
+-- Só altera a parte se o hash mudou e o JSON não é mais antigo que o gravado.
+CREATE OR REPLACE FUNCTION upsert_parties(itens JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+DECLARE
+  v_gravadas INTEGER;
+BEGIN
+  INSERT INTO parties AS p (cnpj, dados, hash, data_referencia)
+  SELECT DISTINCT ON (i.cnpj) i.cnpj, i.dados, i.hash, i.data_referencia
+  FROM jsonb_to_recordset(itens) AS i(cnpj VARCHAR(18), dados JSONB, hash CHAR(32), data_referencia DATE)
+  WHERE i.cnpj IS NOT NULL AND i.dados IS NOT NULL
+  ORDER BY i.cnpj, i.data_referencia DESC NULLS LAST
+  ON CONFLICT (cnpj) DO UPDATE SET
+    dados = EXCLUDED.dados,
+    hash = EXCLUDED.hash,
+    data_referencia = EXCLUDED.data_referencia,
+    updated_at = NOW()
+  WHERE p.hash IS DISTINCT FROM EXCLUDED.hash
+    AND (p.data_referencia IS NULL OR EXCLUDED.data_referencia IS NULL
+         OR EXCLUDED.data_referencia >= p.data_referencia);
+
+  GET DIAGNOSTICS v_gravadas = ROW_COUNT;
+  RETURN v_gravadas;
+END;
+$$;
+
+-- Migração: limpa o JSON já copiado para parties. [{id, tomador, prestador}, ...]
+-- (booleanos indicando quais colunas limpar)
+CREATE OR REPLACE FUNCTION clear_service_note_parties(itens JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+DECLARE
+  v_limpas INTEGER;
+BEGIN
+  UPDATE service_notes n SET
+    tomador = CASE WHEN i.tomador THEN NULL ELSE n.tomador END,
+    prestador = CASE WHEN i.prestador THEN NULL ELSE n.prestador END
+  FROM jsonb_to_recordset(itens) AS i(id UUID, tomador BOOLEAN, prestador BOOLEAN)
+  WHERE n.id = i.id;
+
+  GET DIAGNOSTICS v_limpas = ROW_COUNT;
+  RETURN v_limpas;
+END;
+$$;
+
+-- Leitura com o JSON das partes (para quem lia service_notes.tomador/prestador)
+CREATE OR REPLACE VIEW service_notes_com_partes WITH (security_invoker = true) AS
+SELECT
+  n.*,
+  COALESCE(n.tomador, t.dados) AS dados_tomador,
+  COALESCE(n.prestador, p.dados) AS dados_prestador
+FROM service_notes n
+LEFT JOIN parties t ON t.cnpj = n.cnpj_tomador
+LEFT JOIN parties p ON p.cnpj = n.cnpj_prestador;
+
+-- Notas sem valor ou sem os dados do tomador (nem na nota, nem em parties),
+-- corrigidas por sync_to_supabase.corrigir_registros_incompletos
+CREATE OR REPLACE VIEW service_notes_incompletas WITH (security_invoker = true) AS
+SELECT n.*
+FROM service_notes n
+WHERE n.valor_total IS NULL
+   OR (n.tomador IS NULL AND NOT EXISTS (SELECT 1 FROM parties t WHERE t.cnpj = n.cnpj_tomador));
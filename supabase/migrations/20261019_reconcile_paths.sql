@@ -0,0 +1,88 @@
+-- Conciliação S3 <-> service_notes (reconcile.py)
+-- Os caminhos são lidos em ordem binária (COLLATE "C"), a mesma da listagem do S3,
+-- para o merge-join em uma única passada. Os índices permitem paginar por chave
+-- (caminho, id) sem ordenar a tabela inteira a cada página.
+CREATE INDEX IF NOT EXISTS idx_service_notes_s3_path_pdf_c
+  ON service_notes ((s3_path_pdf COLLATE "C"), id) WHERE s3_path_pdf IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_service_notes_s3_path_xml_c
+  ON service_notes ((s3_path_xml COLLATE "C"), id) WHERE s3_path_xml IS NOT NULL;
+
+-- Página de caminhos de uma coluna (s3_path_pdf ou s3_path_xml) depois do cursor
+-- (p_apos_caminho, p_apos_id), restrita ao prefixo. `outro` é o caminho da outra coluna.
+CREATE OR REPLACE FUNCTION reconcile_service_note_paths(
+  p_coluna TEXT,
+  p_prefixo TEXT DEFAULT 'notas/',
+  p_apos_caminho TEXT DEFAULT NULL,
+  p_apos_id UUID DEFAULT NULL,
+  p_limite INTEGER DEFAULT 1000
+)
+RETURNS TABLE (caminho TEXT, id UUID, nota_id TEXT, outro TEXT)
+LANGUAGE plpgsql
+STABLE
+SECURITY DEFINER
+SET search_path = public AS $$
+DECLARE
+  -- Limite superior do prefixo na ordem binária
+  v_fim TEXT := p_prefixo || chr(1114111);
+  v_inicio TEXT := COALESCE(p_apos_caminho, p_prefixo);
+  v_apos_id UUID := COALESCE(p_apos_id, '00000000-0000-0000-0000-000000000000');
+BEGIN
+  IF p_coluna = 's3_path_pdf' THEN
+    RETURN QUERY
+      SELECT n.s3_path_pdf, n.id, n.nota_id::TEXT, n.s3_path_xml
+      FROM service_notes n
+      WHERE n.s3_path_pdf IS NOT NULL
+        AND (n.s3_path_pdf COLLATE "C", n.id) > (v_inicio COLLATE "C", v_apos_id)
+        AND n.s3_path_pdf COLLATE "C" < v_fim COLLATE "C"
+      ORDER BY n.s3_path_pdf COLLATE "C", n.id
+      LIMIT p_limite;
+  ELSIF p_coluna = 's3_path_xml' THEN
+    RETURN QUERY
+      SELECT n.s3_path_xml, n.id, n.nota_id::TEXT, n.s3_path_pdf
+      FROM service_notes n
+      WHERE n.s3_path_xml IS NOT NULL
+        AND (n.s3_path_xml COLLATE "C", n.id) > (v_inicio COLLATE "C", v_apos_id)
+        AND n.s3_path_xml COLLATE "C" < v_fim COLLATE "C"
+      ORDER BY n.s3_path_xml COLLATE "C", n.id
+      LIMIT p_limite;
+  ELSE
+    RAISE EXCEPTION 'Coluna inválida: %', p_coluna;
+  END IF;
+END;
+$$;
+
+-- Correções em lote: [{id, coluna, caminho}, ...]
+--   caminho preenchido: grava o caminho encontrado no bucket (ex.: XML irmão do PDF);
+--   caminho nulo: o arquivo não existe mais; limpa a coluna e a URL e marca a nota com erro.
+CREATE OR REPLACE FUNCTION reconcile_fix_service_note_paths(itens JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+DECLARE
+  v_pdf INTEGER;
+  v_xml INTEGER;
+BEGIN
+  UPDATE service_notes n SET
+    s3_path_pdf = i.caminho,
+    download_url_pdf = NULL,
+    sync_status = CASE WHEN i.caminho IS NULL THEN 'error' ELSE n.sync_status END,
+    error_message = CASE WHEN i.caminho IS NULL
+      THEN 'PDF ausente no S3: ' || n.s3_path_pdf ELSE n.error_message END
+  FROM jsonb_to_recordset(itens) AS i(id UUID, coluna TEXT, caminho TEXT)
+  WHERE n.id = i.id AND i.coluna = 's3_path_pdf';
+  GET DIAGNOSTICS v_pdf = ROW_COUNT;
+
+  UPDATE service_notes n SET
+    s3_path_xml = i.caminho,
+    download_url_xml = NULL,
+    sync_status = CASE WHEN i.caminho IS NULL THEN 'error' ELSE n.sync_status END,
+    error_message = CASE WHEN i.caminho IS NULL
+      THEN 'XML ausente no S3: ' || n.s3_path_xml ELSE n.error_message END
+  FROM jsonb_to_recordset(itens) AS i(id UUID, coluna TEXT, caminho TEXT)
+  WHERE n.id = i.id AND i.coluna = 's3_path_xml';
+  GET DIAGNOSTICS v_xml = ROW_COUNT;
+
+  RETURN v_pdf + v_xml;
+END;
+$$;
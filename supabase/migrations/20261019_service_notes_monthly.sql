@@ -0,0 +1,137 @@
+-- Resumo mensal de service_notes por empresa (mantido pelos scripts de sync)
+-- O portal consulta esta tabela para contagens e totais em vez de carregar as notas.
+
+CREATE TABLE IF NOT EXISTS service_notes_monthly (
+  company_id UUID NOT NULL REFERENCES companies(id) ON DELETE CASCADE,
+  ano INTEGER NOT NULL,
+  mes INTEGER NOT NULL,
+  total_notas INTEGER NOT NULL DEFAULT 0,
+  valor_total DECIMAL(15,2) NOT NULL DEFAULT 0,
+  prestadores_distintos INTEGER NOT NULL DEFAULT 0,
+  ultima_emissao DATE,
+  updated_at TIMESTAMPTZ DEFAULT NOW(),
+  PRIMARY KEY (company_id, ano, mes)
+);
+
+-- Recalcular um mês de uma empresa lê só as notas daquele mês
+CREATE INDEX IF NOT EXISTS idx_service_notes_company_ano_mes ON service_notes(company_id, ano, mes);
+
+ALTER TABLE service_notes_monthly ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Enable read access for authenticated users" ON service_notes_monthly
+  FOR SELECT USING (auth.role() = 'authenticated');
+
+-- Agregado completo, a partir do zero (usado na verificação e na reconstrução)
+CREATE OR REPLACE VIEW service_notes_monthly_calculado AS
+SELECT
+  company_id,
+  ano,
+  mes,
+  count(*)::INTEGER AS total_notas,
+  COALESCE(sum(valor_total), 0)::DECIMAL(15,2) AS valor_total,
+  count(DISTINCT canonical_cnpj(cnpj_prestador))::INTEGER AS prestadores_distintos,
+  max(data_emissao) AS ultima_emissao
+FROM service_notes
+WHERE company_id IS NOT NULL AND ano IS NOT NULL AND mes IS NOT NULL
+GROUP BY company_id, ano, mes;
+
+-- Atualização incremental: recalcula só os meses [{company_id, ano, mes}, ...]
+-- tocados pelos registros gravados na execução (via índice company_id/ano/mes).
+CREATE OR REPLACE FUNCTION refresh_service_notes_monthly(chaves JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+DECLARE
+  v_atualizados INTEGER;
+BEGIN
+  WITH meses AS (
+    SELECT DISTINCT company_id, ano, mes
+    FROM jsonb_to_recordset(chaves) AS c(company_id UUID, ano INTEGER, mes INTEGER)
+    WHERE company_id IS NOT NULL
+  ),
+  calculado AS (
+    SELECT k.company_id, k.ano, k.mes, a.*
+    FROM meses k
+    CROSS JOIN LATERAL (
+      SELECT
+        count(*)::INTEGER AS total_notas,
+        COALESCE(sum(n.valor_total), 0)::DECIMAL(15,2) AS valor_total,
+        count(DISTINCT canonical_cnpj(n.cnpj_prestador))::INTEGER AS prestadores_distintos,
+        max(n.data_emissao) AS ultima_emissao
+      FROM service_notes n
+      WHERE n.company_id = k.company_id AND n.ano = k.ano AND n.mes = k.mes
+    ) a
+  ),
+  removidos AS (
+    -- Mês que ficou sem notas (ex.: notas movidas pelo merge de duplicados)
+    DELETE FROM service_notes_monthly m
+    USING calculado c
+    WHERE c.total_notas = 0 AND m.company_id = c.company_id AND m.ano = c.ano AND m.mes = c.mes
+    RETURNING 1
+  )
+  INSERT INTO service_notes_monthly
+    (company_id, ano, mes, total_notas, valor_total, prestadores_distintos, ultima_emissao, updated_at)
+  SELECT company_id, ano, mes, total_notas, valor_total, prestadores_distintos, ultima_emissao, NOW()
+  FROM calculado
+  WHERE total_notas > 0
+  ON CONFLICT (company_id, ano, mes) DO UPDATE SET
+    total_notas = EXCLUDED.total_notas,
+    valor_total = EXCLUDED.valor_total,
+    prestadores_distintos = EXCLUDED.prestadores_distintos,
+    ultima_emissao = EXCLUDED.ultima_emissao,
+    updated_at = NOW();
+
+  GET DIAGNOSTICS v_atualizados = ROW_COUNT;
+  RETURN v_atualizados;
+END;
+$$;
+
+-- Verificação: diferenças entre a tabela mantida e o agregado recalculado do zero
+CREATE OR REPLACE FUNCTION verify_service_notes_monthly()
+RETURNS TABLE (
+  company_id UUID, ano INTEGER, mes INTEGER,
+  total_notas_mantido INTEGER, total_notas_calculado INTEGER,
+  valor_total_mantido DECIMAL(15,2), valor_total_calculado DECIMAL(15,2),
+  prestadores_mantido INTEGER, prestadores_calculado INTEGER,
+  ultima_emissao_mantida DATE, ultima_emissao_calculada DATE
+)
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public AS $$
+  SELECT
+    COALESCE(m.company_id, c.company_id), COALESCE(m.ano, c.ano), COALESCE(m.mes, c.mes),
+    m.total_notas, c.total_notas,
+    m.valor_total, c.valor_total,
+    m.prestadores_distintos, c.prestadores_distintos,
+    m.ultima_emissao, c.ultima_emissao
+  FROM service_notes_monthly m
+  FULL OUTER JOIN service_notes_monthly_calculado c
+    ON c.company_id = m.company_id AND c.ano = m.ano AND c.mes = m.mes
+  WHERE m.total_notas IS DISTINCT FROM c.total_notas
+     OR m.valor_total IS DISTINCT FROM c.valor_total
+     OR m.prestadores_distintos IS DISTINCT FROM c.prestadores_distintos
+     OR m.ultima_emissao IS DISTINCT FROM c.ultima_emissao
+  ORDER BY 1, 2, 3
+$$;
+
+-- Reconstrução completa (carga inicial ou correção após a verificação)
+CREATE OR REPLACE FUNCTION rebuild_service_notes_monthly()
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+DECLARE
+  v_total INTEGER;
+BEGIN
+  DELETE FROM service_notes_monthly;
+  INSERT INTO service_notes_monthly
+    (company_id, ano, mes, total_notas, valor_total, prestadores_distintos, ultima_emissao, updated_at)
+  SELECT company_id, ano, mes, total_notas, valor_total, prestadores_distintos, ultima_emissao, NOW()
+  FROM service_notes_monthly_calculado;
+
+  GET DIAGNOSTICS v_total = ROW_COUNT;
+  RETURN v_total;
+END;
+$$;
@@ -0,0 +1,39 @@
+-- Partições de origem das notas que mudaram de partição ou foram removidas
+-- (parquet_export.py). A exportação incremental acha as partições alteradas por
+-- updated_at, que só mostra a partição nova da nota: sem este registro a cópia
+-- antiga ficaria na partição anterior e as notas removidas nunca sairiam.
+CREATE TABLE IF NOT EXISTS service_notes_partition_changes (
+  id BIGSERIAL PRIMARY KEY,
+  cnpj_tomador VARCHAR(18),
+  ano INTEGER,
+  mes INTEGER,
+  changed_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+ALTER TABLE service_notes_partition_changes ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Enable read access for authenticated users" ON service_notes_partition_changes
+  FOR SELECT USING (auth.role() = 'authenticated');
+
+CREATE OR REPLACE FUNCTION record_service_note_partition_change()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+BEGIN
+  INSERT INTO service_notes_partition_changes (cnpj_tomador, ano, mes)
+  VALUES (OLD.cnpj_tomador, OLD.ano, OLD.mes);
+  RETURN NULL;
+END;
+$$;
+
+-- O WHEN é avaliado antes de chamar a função: updates que não mudam a partição não custam nada
+CREATE TRIGGER service_notes_partition_moved AFTER UPDATE OF cnpj_tomador, ano, mes ON service_notes
+  FOR EACH ROW
+  WHEN (OLD.cnpj_tomador IS DISTINCT FROM NEW.cnpj_tomador
+        OR OLD.ano IS DISTINCT FROM NEW.ano
+        OR OLD.mes IS DISTINCT FROM NEW.mes)
+  EXECUTE FUNCTION record_service_note_partition_change();
+
+CREATE TRIGGER service_notes_partition_removed AFTER DELETE ON service_notes
+  FOR EACH ROW EXECUTE FUNCTION record_service_note_partition_change();
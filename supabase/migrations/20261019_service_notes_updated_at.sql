@@ -0,0 +1,3 @@
+-- Exportação incremental para Parquet (parquet_export.py): varredura por chave
+-- (updated_at, id) a partir da última exportação, sem ordenar a tabela inteira.
+CREATE INDEX IF NOT EXISTS idx_service_notes_updated_at_id ON service_notes(updated_at, id);
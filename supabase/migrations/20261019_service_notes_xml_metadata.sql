@@ -0,0 +1,33 @@
+-- Metadados extraídos do XML das notas (valor, descrição e código do serviço)
+-- metadados_xml_em marca as notas cujo XML já foi lido, para a extração não repetir.
+
+ALTER TABLE service_notes
+ADD COLUMN IF NOT EXISTS metadados_xml_em TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_service_notes_xml_pendente
+  ON service_notes(id) WHERE metadados_xml_em IS NULL AND s3_path_xml IS NOT NULL;
+
+-- Aplica um lote [{id, valor_total, descricao_servico, codigo_servico}, ...] num único UPDATE.
+-- Os valores do XML prevalecem; campos que o XML não trouxe mantêm o valor atual.
+CREATE OR REPLACE FUNCTION update_service_notes_xml_metadata(itens JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+DECLARE
+  v_atualizadas INTEGER;
+BEGIN
+  UPDATE service_notes n SET
+    valor_total = COALESCE(i.valor_total, n.valor_total),
+    descricao_servico = COALESCE(i.descricao_servico, n.descricao_servico),
+    codigo_servico = COALESCE(i.codigo_servico, n.codigo_servico),
+    metadados_xml_em = NOW()
+  FROM jsonb_to_recordset(itens) AS i(
+    id UUID, valor_total DECIMAL(15,2), descricao_servico TEXT, codigo_servico VARCHAR(20)
+  )
+  WHERE n.id = i.id;
+
+  GET DIAGNOSTICS v_atualizadas = ROW_COUNT;
+  RETURN v_atualizadas;
+END;
+$$;
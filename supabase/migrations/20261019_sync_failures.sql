@@ -0,0 +1,99 @@
+-- Falhas de sincronização por nota (sync_failures.py)
+-- Cada nota que falha fica aqui com a classe do erro, o número de tentativas e
+-- o payload para reprocessá-la; o modo --retentar-falhas dos scripts refaz só
+-- essas notas, com espera exponencial entre as tentativas. Vale também para
+-- notas que nunca chegaram a ter linha em service_notes.
+CREATE TABLE IF NOT EXISTS sync_failures (
+  chave TEXT NOT NULL,                    -- chave do job (nota_id da PlugNotas, ou número + CNPJ)
+  origem VARCHAR(20) NOT NULL,            -- 'plugnotas' | 's3'
+  nota_id VARCHAR(100),                   -- service_notes.nota_id, quando conhecido
+  company_id UUID REFERENCES companies(id) ON DELETE CASCADE,
+  payload JSONB NOT NULL,                 -- argumentos para reprocessar a nota
+  classe_erro VARCHAR(30) NOT NULL,       -- transferencia | supabase | api | rede | dados | desconhecido
+  error_message TEXT,
+  tentativas INTEGER NOT NULL DEFAULT 1,
+  proxima_tentativa TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  created_at TIMESTAMPTZ DEFAULT NOW(),
+  updated_at TIMESTAMPTZ DEFAULT NOW(),
+  PRIMARY KEY (origem, chave)
+);
+
+CREATE INDEX IF NOT EXISTS idx_sync_failures_proxima ON sync_failures(origem, proxima_tentativa);
+
+ALTER TABLE sync_failures ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Enable read access for authenticated users" ON sync_failures
+  FOR SELECT USING (auth.role() = 'authenticated');
+
+-- Registra as falhas de um lote: [{chave, nota_id, company_id, payload, classe_erro, error_message}, ...]
+-- A cada falha da mesma nota, tentativas + 1 e a próxima tentativa espera
+-- p_base_segundos * 2^(tentativas - 1), até p_max_segundos. A nota que já tem
+-- linha em service_notes fica com sync_status = 'error'.
+CREATE OR REPLACE FUNCTION register_sync_failures(
+  p_origem TEXT,
+  itens JSONB,
+  p_base_segundos INTEGER DEFAULT 300,
+  p_max_segundos INTEGER DEFAULT 86400
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+DECLARE
+  v_registradas INTEGER;
+BEGIN
+  INSERT INTO sync_failures AS f (chave, origem, nota_id, company_id, payload, classe_erro, error_message,
+                                  tentativas, proxima_tentativa)
+  SELECT DISTINCT ON (i.chave) i.chave, p_origem, i.nota_id, i.company_id, i.payload, i.classe_erro,
+         i.error_message, 1, NOW() + make_interval(secs => LEAST(p_base_segundos, p_max_segundos))
+  FROM jsonb_to_recordset(itens) AS i(chave TEXT, nota_id VARCHAR(100), company_id UUID, payload JSONB,
+                                      classe_erro VARCHAR(30), error_message TEXT)
+  WHERE i.chave IS NOT NULL
+  ON CONFLICT (origem, chave) DO UPDATE SET
+    nota_id = COALESCE(EXCLUDED.nota_id, f.nota_id),
+    company_id = COALESCE(EXCLUDED.company_id, f.company_id),
+    payload = EXCLUDED.payload,
+    classe_erro = EXCLUDED.classe_erro,
+    error_message = EXCLUDED.error_message,
+    tentativas = f.tentativas + 1,
+    proxima_tentativa = NOW() + make_interval(
+      secs => LEAST(p_base_segundos * power(2, LEAST(f.tentativas, 30)), p_max_segundos)),
+    updated_at = NOW();
+
+  GET DIAGNOSTICS v_registradas = ROW_COUNT;
+
+  UPDATE service_notes n SET
+    sync_status = 'error',
+    error_message = left(i.classe_erro || ': ' || COALESCE(i.error_message, ''), 1000)
+  FROM jsonb_to_recordset(itens) AS i(nota_id VARCHAR(100), classe_erro VARCHAR(30), error_message TEXT)
+  WHERE i.nota_id IS NOT NULL AND n.nota_id = i.nota_id;
+
+  RETURN v_registradas;
+END;
+$$;
+
+-- Remove as falhas resolvidas (["chave", ...]) e limpa o erro das notas já regravadas
+CREATE OR REPLACE FUNCTION resolve_sync_failures(p_origem TEXT, chaves JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+DECLARE
+  v_resolvidas INTEGER;
+BEGIN
+  WITH removidas AS (
+    DELETE FROM sync_failures f
+    WHERE f.origem = p_origem
+      AND f.chave IN (SELECT jsonb_array_elements_text(chaves))
+    RETURNING f.nota_id
+  ), limpas AS (
+    UPDATE service_notes n SET error_message = NULL
+    FROM removidas r
+    WHERE r.nota_id IS NOT NULL AND n.nota_id = r.nota_id AND n.sync_status = 'synced'
+    RETURNING n.id
+  )
+  SELECT COUNT(*) INTO v_resolvidas FROM removidas;
+
+  RETURN v_resolvidas;
+END;
+$$;
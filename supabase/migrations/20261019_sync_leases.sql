@@ -0,0 +1,122 @@
+-- Leases de sincronização por empresa (sync_leases.py)
+-- Cada worker reivindica uma empresa por vez; o lease expira se o worker cair,
+-- e a empresa volta a ficar disponível para os demais.
+
+CREATE TABLE IF NOT EXISTS sync_leases (
+  company_id UUID PRIMARY KEY REFERENCES companies(id) ON DELETE CASCADE,
+  worker TEXT NOT NULL,
+  expira_em TIMESTAMPTZ NOT NULL,
+  adquirido_em TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Só o service role (scripts de sync) acessa
+ALTER TABLE sync_leases ENABLE ROW LEVEL SECURITY;
+
+-- Shard estável do CNPJ: md5 dos dígitos, igual a sync_leases.shard_do_cnpj
+CREATE OR REPLACE FUNCTION sync_shard(p_cnpj TEXT, p_total INTEGER)
+RETURNS INTEGER
+LANGUAGE sql
+IMMUTABLE AS $$
+  SELECT ((('x' || substr(md5(regexp_replace(p_cnpj, '\D', '', 'g')), 1, 8))::bit(32)::bigint) % p_total)::INTEGER
+$$;
+
+-- Próxima empresa ativa sem lease válido (e não sincronizada desde p_sincronizada_antes),
+-- já com o lease do worker. A trava da linha em companies com SKIP LOCKED faz
+-- workers concorrentes pegarem empresas diferentes.
+CREATE OR REPLACE FUNCTION claim_next_sync_company(
+  p_worker TEXT,
+  p_ttl_segundos INTEGER,
+  p_sincronizada_antes TIMESTAMPTZ DEFAULT NULL,
+  p_shard INTEGER DEFAULT NULL,
+  p_total_shards INTEGER DEFAULT NULL
+)
+RETURNS TABLE (id UUID, cnpj TEXT, sync_watermark DATE)
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+#variable_conflict use_column
+DECLARE
+  v_id UUID;
+BEGIN
+  SELECT c.id INTO v_id
+  FROM companies c
+  LEFT JOIN sync_leases l ON l.company_id = c.id
+  WHERE c.active
+    AND (l.company_id IS NULL OR l.expira_em < NOW())
+    AND (p_sincronizada_antes IS NULL OR c.last_sync IS NULL OR c.last_sync < p_sincronizada_antes)
+    AND (p_total_shards IS NULL OR sync_shard(c.cnpj, p_total_shards) = p_shard)
+  ORDER BY c.last_sync NULLS FIRST, c.id
+  LIMIT 1
+  FOR UPDATE OF c SKIP LOCKED;
+
+  IF v_id IS NULL THEN
+    RETURN;
+  END IF;
+
+  INSERT INTO sync_leases (company_id, worker, expira_em, adquirido_em)
+  VALUES (v_id, p_worker, NOW() + make_interval(secs => p_ttl_segundos), NOW())
+  ON CONFLICT (company_id) DO UPDATE SET
+    worker = EXCLUDED.worker,
+    expira_em = EXCLUDED.expira_em,
+    adquirido_em = EXCLUDED.adquirido_em
+  WHERE sync_leases.expira_em < NOW();
+
+  IF NOT FOUND THEN
+    RETURN;
+  END IF;
+
+  RETURN QUERY SELECT c.id, c.cnpj::TEXT, c.sync_watermark FROM companies c WHERE c.id = v_id;
+END;
+$$;
+
+-- Lease de uma empresa específica (daemon); renova se já é do mesmo worker
+CREATE OR REPLACE FUNCTION claim_sync_lease(p_company_id UUID, p_worker TEXT, p_ttl_segundos INTEGER)
+RETURNS BOOLEAN
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+BEGIN
+  -- Mesma trava de claim_next_sync_company, para as duas formas não se cruzarem
+  PERFORM 1 FROM companies WHERE id = p_company_id FOR UPDATE;
+
+  INSERT INTO sync_leases (company_id, worker, expira_em, adquirido_em)
+  VALUES (p_company_id, p_worker, NOW() + make_interval(secs => p_ttl_segundos), NOW())
+  ON CONFLICT (company_id) DO UPDATE SET
+    worker = EXCLUDED.worker,
+    expira_em = EXCLUDED.expira_em,
+    adquirido_em = EXCLUDED.adquirido_em
+  WHERE sync_leases.expira_em < NOW() OR sync_leases.worker = p_worker;
+
+  RETURN FOUND;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION renew_sync_lease(p_company_id UUID, p_worker TEXT, p_ttl_segundos INTEGER)
+RETURNS BOOLEAN
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+BEGIN
+  UPDATE sync_leases
+  SET expira_em = NOW() + make_interval(secs => p_ttl_segundos)
+  WHERE company_id = p_company_id AND worker = p_worker;
+  RETURN FOUND;
+END;
+$$;
+
+-- Libera o lease; com p_espera_segundos > 0 (falha) a empresa fica reservada até lá
+CREATE OR REPLACE FUNCTION release_sync_lease(p_company_id UUID, p_worker TEXT, p_espera_segundos INTEGER DEFAULT 0)
+RETURNS VOID
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+BEGIN
+  IF p_espera_segundos > 0 THEN
+    UPDATE sync_leases
+    SET expira_em = NOW() + make_interval(secs => p_espera_segundos)
+    WHERE company_id = p_company_id AND worker = p_worker;
+  ELSE
+    DELETE FROM sync_leases WHERE company_id = p_company_id AND worker = p_worker;
+  END IF;
+END;
+$$;
@@ -0,0 +1,20 @@
+-- Atualização em lote da razão social (scripts/extract_names.py)
+-- Recebe [{cnpj, razao_social}, ...] e grava tudo num único UPDATE.
+CREATE OR REPLACE FUNCTION update_companies_razao_social(itens JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public AS $$
+DECLARE
+  v_atualizadas INTEGER;
+BEGIN
+  UPDATE companies c SET
+    razao_social = i.razao_social
+  FROM jsonb_to_recordset(itens) AS i(cnpj TEXT, razao_social VARCHAR(255))
+  WHERE c.cnpj = i.cnpj
+    AND c.razao_social IS DISTINCT FROM i.razao_social;
+
+  GET DIAGNOSTICS v_atualizadas = ROW_COUNT;
+  RETURN v_atualizadas;
+END;
+$$;
@@ -0,0 +1,165 @@
+"""
+Execução com prazo (--deadline) da sincronização horária.
+
+A execução é quebrada em unidades (empresa, mês) e ordenada por prioridade:
+  1. o mês atual de todas as empresas antes do anterior (e assim por diante);
+  2. dentro do mesmo mês, as unidades que sobraram da execução anterior;
+  3. depois, as empresas com mais notas novas esperadas: horas desde o
+     last_sync vezes a taxa recente de notas (com um piso, para que uma empresa
+     parada há dias também suba na fila).
+
+Antes de cada unidade, a duração estimada (média móvel das execuções anteriores
+da mesma empresa) é comparada com o tempo restante; se não couber, a execução
+para e as unidades restantes ficam em .cache/sync_deadline.json para a próxima.
+"""
+import json
+import os
+import re
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+DEADLINE_MARGIN = float(os.getenv("SYNC_DEADLINE_MARGIN", "60"))              # s reservados para o fechamento
+DEADLINE_UNIT_ESTIMATE = float(os.getenv("SYNC_DEADLINE_UNIT_ESTIMATE", "30"))  # s por unidade sem histórico
+TAXA_MINIMA = float(os.getenv("SYNC_DEADLINE_MIN_RATE", "1"))                 # notas/dia
+SUAVIZACAO = 0.3
+DEADLINE_STATE_PATH = os.getenv(
+    "SYNC_DEADLINE_STATE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "sync_deadline.json"),
+)
+
+
+class Unidade(NamedTuple):
+    company_id: str
+    ano: int
+    mes: int
+    data_inicial: date
+    data_final: date
+
+    @property
+    def chave(self) -> str:
+        return f"{self.company_id}:{self.ano}-{self.mes:02d}"
+
+
+def parse_deadline(valor: str, agora: Optional[datetime] = None) -> datetime:
+    """
+    Prazo da execução: minutos a partir de agora ('50', '50m', '1h30m') ou um
+    horário local 'HH:MM' (o próximo, se já passou hoje).
+    """
+    agora = agora or datetime.now()
+    valor = str(valor).strip().lower()
+    horario = re.fullmatch(r"(\d{1,2}):(\d{2})", valor)
+    if horario:
+        prazo = agora.replace(hour=int(horario.group(1)), minute=int(horario.group(2)), second=0, microsecond=0)
+        return prazo if prazo > agora else prazo + timedelta(days=1)
+    duracao = re.fullmatch(r"(?:(\d+)h)?(?:(\d+)m?)?", valor)
+    if not duracao or not any(duracao.groups()):
+        raise ValueError(f"prazo inválido: {valor} (use minutos, ex.: 50, 1h30m, ou HH:MM)")
+    horas, minutos = (int(g or 0) for g in duracao.groups())
+    return agora + timedelta(hours=horas, minutes=minutos)
+
+
+def meses_atras(unidade: Unidade, hoje: date) -> int:
+    return (hoje.year - unidade.ano) * 12 + hoje.month - unidade.mes
+
+
+def horas_desde(last_sync, agora: datetime) -> Optional[float]:
+    if not last_sync:
+        return None
+    if isinstance(last_sync, str):
+        last_sync = datetime.fromisoformat(last_sync.replace("Z", "+00:00"))
+    if last_sync.tzinfo is None:
+        last_sync = last_sync.replace(tzinfo=timezone.utc)
+    return max(0.0, (agora - last_sync).total_seconds() / 3600)
+
+
+def notas_esperadas(emp: Dict, taxa_por_dia: float, agora: datetime) -> float:
+    """Notas novas esperadas desde o último sync; sem last_sync, a empresa vai à frente."""
+    horas = horas_desde(emp.get("last_sync"), agora)
+    if horas is None:
+        return float("inf")
+    return horas / 24 * max(taxa_por_dia, TAXA_MINIMA)
+
+
+def priorizar(
+    unidades: Iterable[Unidade],
+    empresas: Dict[str, Dict],
+    taxa: Callable[[Dict], float],
+    pendentes_anteriores: Iterable[str] = (),
+    agora: Optional[datetime] = None,
+) -> List[Unidade]:
+    """Ordena as unidades: mês mais recente, sobras da execução anterior, mais notas esperadas."""
+    agora = agora or datetime.now(timezone.utc)
+    hoje = agora.date()
+    sobras = set(pendentes_anteriores)
+    esperadas = {company_id: notas_esperadas(emp, taxa(emp), agora) for company_id, emp in empresas.items()}
+    return sorted(unidades, key=lambda u: (
+        meses_atras(u, hoje),
+        u.chave not in sobras,
+        -esperadas.get(u.company_id, 0.0),
+        u.company_id,
+    ))
+
+
+class EstadoPrazo:
+    """Unidades que não couberam no prazo e duração média das unidades por empresa."""
+
+    def __init__(self, path: str = DEADLINE_STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.pendentes: List[str] = []
+        self.duracoes: Dict[str, float] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    dados = json.load(f)
+                self.pendentes = dados.get("pendentes", [])
+                self.duracoes = dados.get("duracoes", {})
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Estado do prazo ignorado ({path}): {e}")
+
+    def estimativa(self, company_id: str) -> float:
+        with self._lock:
+            if company_id in self.duracoes:
+                return self.duracoes[company_id]
+            if self.duracoes:
+                return sorted(self.duracoes.values())[len(self.duracoes) // 2]
+        return DEADLINE_UNIT_ESTIMATE
+
+    def registrar_duracao(self, company_id: str, segundos: float):
+        with self._lock:
+            anterior = self.duracoes.get(company_id)
+            self.duracoes[company_id] = segundos if anterior is None else \
+                anterior + SUAVIZACAO * (segundos - anterior)
+
+    def salvar(self, pendentes: Iterable[Unidade]):
+        with self._lock:
+            self.pendentes = [u.chave for u in pendentes]
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"pendentes": self.pendentes, "duracoes": self.duracoes}, f)
+            os.replace(tmp, self.path)
+
+
+class Prazo:
+    """Relógio da execução (monotônico): quanto falta e se uma unidade ainda cabe."""
+
+    def __init__(self, limite: datetime, margem: float = DEADLINE_MARGIN):
+        self.limite = limite
+        self.margem = margem
+        # Convertido para o relógio monotônico (imune a ajustes de hora do sistema)
+        agora = datetime.now(limite.tzinfo)
+        self.fim = time.monotonic() + (limite - agora).total_seconds()
+
+    def restante(self) -> float:
+        return self.fim - time.monotonic()
+
+    def cabe(self, estimativa: float) -> bool:
+        return self.restante() - self.margem >= estimativa
+
+    @property
+    def parar_em(self) -> float:
+        """Instante (time.monotonic) em que os workers param de retirar jobs."""
+        return self.fim - self.margem / 2
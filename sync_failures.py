@@ -0,0 +1,244 @@
+"""
+Falhas de sincronização por nota (tabela sync_failures) e o modo de retentativa.
+
+Antes, uma nota que falhava só era impressa e contada; a única forma de tentar
+de novo era outra passada completa no bucket ou na API. Agora cada falha fica
+gravada com a classe do erro, o número de tentativas e o payload para refazer a
+nota, e o modo --retentar-falhas dos scripts processa só essas notas:
+
+- a cada nova falha da mesma nota, a próxima tentativa espera o dobro
+  (SYNC_RETRY_BASE_SECONDS, 2x, 4x..., até SYNC_RETRY_MAX_SECONDS);
+- depois de SYNC_RETRY_MAX_ATTEMPTS tentativas a nota não é mais retentada
+  (fica na tabela para análise);
+- quando a nota é gravada com sucesso, em qualquer modo, a falha é removida.
+
+    python scripts/sync_to_supabase.py --retentar-falhas
+    python sync_notas_s3_supabase.py --retentar-falhas
+    python sync_failures.py                      # resumo das falhas por origem e classe
+"""
+import argparse
+import os
+import sys
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Set
+
+SYNC_RETRY_MAX_ATTEMPTS = int(os.getenv("SYNC_RETRY_MAX_ATTEMPTS", "6"))
+SYNC_RETRY_BASE_SECONDS = int(os.getenv("SYNC_RETRY_BASE_SECONDS", "300"))     # 5 min após a 1ª falha
+SYNC_RETRY_MAX_SECONDS = int(os.getenv("SYNC_RETRY_MAX_SECONDS", "86400"))     # no máximo 1 dia
+FAILURES_BATCH_SIZE = int(os.getenv("SYNC_FAILURES_BATCH_SIZE", "200"))
+PAGE_SIZE = int(os.getenv("SYNC_FAILURES_PAGE_SIZE", "1000"))
+ORIGENS = ("plugnotas", "s3")
+
+
+class FalhaNota(Exception):
+    """Falha no processamento de uma nota, com a classe do erro (ver classe_do_erro)."""
+
+    def __init__(self, classe: str, mensagem: str):
+        super().__init__(mensagem)
+        self.classe = classe
+
+
+def classe_do_erro(erro, padrao: str = "desconhecido") -> str:
+    """
+    Classe do erro para agrupar as falhas: transferencia (PDF/XML para o S3),
+    supabase (gravação), api (resposta da PlugNotas), rede, dados (nota malformada).
+    """
+    if isinstance(erro, FalhaNota):
+        return erro.classe
+    nome = type(erro).__name__
+    modulo = type(erro).__module__ or ""
+    if nome in ("ErroPostgrest", "APIError") or modulo.startswith("postgrest"):
+        return "supabase"
+    if modulo.startswith(("requests", "urllib3", "httpx")) or isinstance(erro, (ConnectionError, TimeoutError)):
+        return "rede"
+    if modulo.startswith(("botocore", "boto3")):
+        return "transferencia"
+    if isinstance(erro, (ValueError, KeyError, TypeError)):
+        return "dados"
+    return padrao
+
+
+class RegistroFalhas:
+    """
+    Falhas e sucessos das notas de uma origem, gravados em lote em sync_failures.
+    As chaves que já têm falha gravada são carregadas na primeira consulta, para
+    que o sucesso de uma nota sem falha não gere nenhuma gravação.
+    Compartilhado pelas threads da sincronização.
+    """
+
+    def __init__(self, supabase, origem: str, tamanho_lote: int = FAILURES_BATCH_SIZE):
+        self.supabase = supabase
+        self.origem = origem
+        self.tamanho_lote = tamanho_lote
+        self._conhecidas: Optional[Set[str]] = None
+        self._falhas: Dict[str, Dict] = {}
+        self._resolvidas: Set[str] = set()
+        self._lock = threading.Lock()
+        self._contadores = {"falhas_registradas": 0, "falhas_resolvidas": 0}
+
+    def _carregar(self) -> Set[str]:
+        chaves, ultima = set(), None
+        while True:
+            query = self.supabase.table("sync_failures").select("chave").eq("origem", self.origem)
+            if ultima:
+                query = query.gt("chave", ultima)
+            pagina = query.order("chave").limit(PAGE_SIZE).execute().data or []
+            chaves.update(linha["chave"] for linha in pagina)
+            if len(pagina) < PAGE_SIZE:
+                return chaves
+            ultima = pagina[-1]["chave"]
+
+    def _garantir_carregado(self):
+        if self._conhecidas is None:
+            chaves = self._carregar()
+            with self._lock:
+                if self._conhecidas is None:
+                    self._conhecidas = chaves
+
+    def falhou(self, chave: str, payload: Dict, erro, classe: Optional[str] = None,
+               nota_id: Optional[str] = None, company_id: Optional[str] = None):
+        """Registra a falha da nota (gravada no próximo lote)."""
+        item = {
+            "chave": chave,
+            "nota_id": nota_id,
+            "company_id": company_id,
+            "payload": payload,
+            "classe_erro": classe or classe_do_erro(erro),
+            "error_message": str(erro)[:1000],
+        }
+        with self._lock:
+            self._resolvidas.discard(chave)
+            self._falhas[chave] = item
+            cheio = len(self._falhas) >= self.tamanho_lote
+        if cheio:
+            self._descarregar_no_meio()
+
+    def resolveu(self, chave: str):
+        """A nota foi gravada: remove a falha, se houver uma gravada."""
+        self._garantir_carregado()
+        with self._lock:
+            self._falhas.pop(chave, None)
+            if chave not in self._conhecidas:
+                return
+            self._resolvidas.add(chave)
+            cheio = len(self._resolvidas) >= self.tamanho_lote
+        if cheio:
+            self._descarregar_no_meio()
+
+    def _descarregar_no_meio(self):
+        # Lote cheio durante a execução: uma falha aqui não derruba a nota, o lote fica para o fim
+        try:
+            self.descarregar()
+        except Exception as e:
+            print(f"  ⚠️ [Falhas] Lote não gravado, nova tentativa no fim da execução: {e}")
+
+    def descarregar(self) -> Dict[str, int]:
+        """Grava as falhas e remoções acumuladas (uma chamada de cada). Em erro, mantém o lote para depois."""
+        self._garantir_carregado()
+        with self._lock:
+            falhas, self._falhas = list(self._falhas.values()), {}
+            resolvidas, self._resolvidas = sorted(self._resolvidas), set()
+        resultado = {"registradas": 0, "resolvidas": 0}
+        try:
+            if falhas:
+                resultado["registradas"] = self.supabase.rpc("register_sync_failures", {
+                    "p_origem": self.origem,
+                    "itens": falhas,
+                    "p_base_segundos": SYNC_RETRY_BASE_SECONDS,
+                    "p_max_segundos": SYNC_RETRY_MAX_SECONDS,
+                }).execute().data or 0
+            if resolvidas:
+                resultado["resolvidas"] = self.supabase.rpc("resolve_sync_failures", {
+                    "p_origem": self.origem, "chaves": resolvidas,
+                }).execute().data or 0
+        except Exception:
+            with self._lock:
+                for item in falhas:
+                    self._falhas.setdefault(item["chave"], item)
+                self._resolvidas.update(c for c in resolvidas if c not in self._falhas)
+            raise
+        with self._lock:
+            self._conhecidas.update(item["chave"] for item in falhas)
+            self._conhecidas.difference_update(resolvidas)
+            self._contadores["falhas_registradas"] += len(falhas)
+            self._contadores["falhas_resolvidas"] += len(resolvidas)
+        return resultado
+
+    def extrair_contadores(self) -> Dict[str, int]:
+        with self._lock:
+            contadores = dict(self._contadores)
+            for chave in self._contadores:
+                self._contadores[chave] = 0
+        return contadores
+
+
+def falhas_a_retentar(supabase, origem: str, max_tentativas: int = SYNC_RETRY_MAX_ATTEMPTS,
+                      agora: Optional[datetime] = None) -> Iterator[List[Dict]]:
+    """
+    Páginas das falhas da origem com a próxima tentativa já vencida e abaixo do
+    limite de tentativas, paginadas por chave (as retentadas nesta execução,
+    que voltam a falhar, não reaparecem: a próxima tentativa delas fica no futuro).
+    """
+    agora = (agora or datetime.now(timezone.utc)).isoformat()
+    ultima = None
+    while True:
+        query = supabase.table("sync_failures")\
+            .select("chave, nota_id, company_id, payload, classe_erro, tentativas")\
+            .eq("origem", origem).lt("tentativas", max_tentativas).lte("proxima_tentativa", agora)
+        if ultima:
+            query = query.gt("chave", ultima)
+        pagina = query.order("chave").limit(PAGE_SIZE).execute().data or []
+        if pagina:
+            yield pagina
+        if len(pagina) < PAGE_SIZE:
+            return
+        ultima = pagina[-1]["chave"]
+
+
+def resumo(supabase, max_tentativas: int = SYNC_RETRY_MAX_ATTEMPTS) -> Dict[tuple, Dict[str, int]]:
+    """Contagem por (origem, classe): pendentes (a retentar) e esgotadas (no limite de tentativas)."""
+    contagem: Dict[tuple, Dict[str, int]] = {}
+    for origem in ORIGENS:
+        ultima = None
+        while True:
+            query = supabase.table("sync_failures").select("chave, classe_erro, tentativas").eq("origem", origem)
+            if ultima:
+                query = query.gt("chave", ultima)
+            pagina = query.order("chave").limit(PAGE_SIZE).execute().data or []
+            for linha in pagina:
+                grupo = contagem.setdefault((origem, linha["classe_erro"]), {"pendentes": 0, "esgotadas": 0})
+                grupo["esgotadas" if linha["tentativas"] >= max_tentativas else "pendentes"] += 1
+            if len(pagina) < PAGE_SIZE:
+                break
+            ultima = pagina[-1]["chave"]
+    return contagem
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resumo das falhas de sincronização (sync_failures).")
+    parser.add_argument("--max-tentativas", type=int, default=SYNC_RETRY_MAX_ATTEMPTS,
+                        help="Tentativas a partir das quais a nota não é mais retentada")
+    args = parser.parse_args()
+
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    if current_dir in sys.path:
+        sys.path.remove(current_dir)
+    from supabase import create_client
+    from dotenv import load_dotenv
+    sys.path.insert(0, current_dir)
+
+    load_dotenv(os.path.join(current_dir, "scripts", ".env"))
+    supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE_KEY"))
+
+    contagem = resumo(supabase, args.max_tentativas)
+    if not contagem:
+        print("✅ Nenhuma falha registrada.")
+        return
+    print(f"{'origem':<12}{'classe':<16}{'a retentar':>12}{'esgotadas':>12}")
+    for (origem, classe), grupo in sorted(contagem.items()):
+        print(f"{origem:<12}{classe:<16}{grupo['pendentes']:>12}{grupo['esgotadas']:>12}")
+
+
+if __name__ == "__main__":
+    main()
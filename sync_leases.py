@@ -0,0 +1,135 @@
+"""
+Divisão da sincronização de empresas entre vários workers.
+
+- Shards (--shard i/N): cada worker fica com as empresas cujo hash estável do
+  CNPJ (md5 dos dígitos, igual à função sync_shard no banco) cai no shard i.
+- Leases (tabela sync_leases): o worker reivindica uma empresa por vez no banco
+  (SKIP LOCKED); o lease expira em SYNC_LEASE_TTL segundos e é renovado em
+  segundo plano enquanto a sincronização roda. Se o worker cair, o lease vence
+  e a empresa volta a ficar disponível para os outros.
+- Quem sincroniza chama `lease.verificar()` entre as páginas: se a renovação
+  falhou (outro worker assumiu a empresa), LeasePerdido interrompe a empresa
+  antes que os dois gravem e avancem o watermark ao mesmo tempo.
+"""
+import hashlib
+import os
+import socket
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+SYNC_LEASE_TTL = int(os.getenv("SYNC_LEASE_TTL", "900"))                   # 15 min
+SYNC_LEASE_RETRY_DELAY = int(os.getenv("SYNC_LEASE_RETRY_DELAY", "900"))   # espera após falha
+
+Shard = Tuple[int, int]
+
+
+def id_worker() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def parse_shard(valor: str) -> Shard:
+    """'i/N' com 0 <= i < N."""
+    indice, _, total = str(valor).partition("/")
+    try:
+        indice, total = int(indice), int(total)
+    except ValueError:
+        raise ValueError(f"shard inválido: {valor} (use i/N, ex.: 0/4)")
+    if total < 1 or not 0 <= indice < total:
+        raise ValueError(f"shard inválido: {valor} (i deve estar entre 0 e N-1)")
+    return indice, total
+
+
+def shard_do_cnpj(cnpj: str, total: int) -> int:
+    """Shard estável entre máquinas e execuções (hash() do Python muda a cada processo)."""
+    digitos = "".join(c for c in str(cnpj or "") if c.isdigit())
+    return int(hashlib.md5(digitos.encode("ascii")).hexdigest()[:8], 16) % total
+
+
+def filtrar_shard(empresas: Iterable[Dict], shard: Optional[Shard]) -> List[Dict]:
+    if not shard:
+        return list(empresas)
+    indice, total = shard
+    return [emp for emp in empresas if shard_do_cnpj(emp["cnpj"], total) == indice]
+
+
+class LeasePerdido(Exception):
+    """O lease venceu e outro worker assumiu a empresa: a sincronização dela deve parar."""
+
+
+def reivindicar_proxima(supabase, worker: str, sincronizada_antes: str, shard: Optional[Shard] = None,
+                        ttl: int = SYNC_LEASE_TTL) -> Optional[Dict]:
+    """
+    Próxima empresa ativa sem lease válido e não sincronizada desde `sincronizada_antes`
+    (ISO), já com o lease deste worker. None quando não sobrou nenhuma.
+    """
+    params = {"p_worker": worker, "p_ttl_segundos": ttl, "p_sincronizada_antes": sincronizada_antes,
+              "p_shard": shard[0] if shard else None, "p_total_shards": shard[1] if shard else None}
+    response = supabase.rpc("claim_next_sync_company", params).execute()
+    return response.data[0] if response.data else None
+
+
+def reivindicar(supabase, company_id: str, worker: str, ttl: int = SYNC_LEASE_TTL) -> bool:
+    """Lease de uma empresa específica (False se outro worker está com ela)."""
+    response = supabase.rpc("claim_sync_lease",
+                            {"p_company_id": company_id, "p_worker": worker, "p_ttl_segundos": ttl}).execute()
+    return bool(response.data)
+
+
+class Lease(threading.Thread):
+    """
+    Lease em uso: renova a cada ttl/3 até `liberar`. Se a renovação falhar (o lease
+    venceu e outro worker assumiu), `perdido` fica True e o evento `perda` é sinalizado.
+    """
+
+    def __init__(self, supabase, company_id: str, worker: str, ttl: int = SYNC_LEASE_TTL):
+        super().__init__(daemon=True)
+        self.supabase = supabase
+        self.company_id = company_id
+        self.worker = worker
+        self.ttl = ttl
+        self.perda = threading.Event()
+        self._parar = threading.Event()
+
+    @property
+    def perdido(self) -> bool:
+        return self.perda.is_set()
+
+    def verificar(self):
+        """Levanta LeasePerdido se outro worker assumiu a empresa."""
+        if self.perdido:
+            raise LeasePerdido(f"lease da empresa {self.company_id} perdido para outro worker")
+
+    def run(self):
+        while not self._parar.wait(self.ttl / 3):
+            try:
+                renovado = self.supabase.rpc("renew_sync_lease", {
+                    "p_company_id": self.company_id, "p_worker": self.worker, "p_ttl_segundos": self.ttl,
+                }).execute().data
+            except Exception as e:
+                # Erro de rede: tenta de novo no próximo ciclo (o TTL cobre algumas falhas)
+                print(f"  [Lease] Erro ao renovar {self.company_id}: {e}")
+                continue
+            if not renovado:
+                self.perda.set()
+                print(f"  [Lease] ⚠️ Lease da empresa {self.company_id} perdido para outro worker.")
+                return
+
+    def liberar(self, ok: bool = True):
+        """Encerra a renovação. Após falha, a empresa fica reservada por SYNC_LEASE_RETRY_DELAY."""
+        self._parar.set()
+        try:
+            self.supabase.rpc("release_sync_lease", {
+                "p_company_id": self.company_id, "p_worker": self.worker,
+                "p_espera_segundos": 0 if ok else SYNC_LEASE_RETRY_DELAY,
+            }).execute()
+        except Exception as e:
+            # O lease vence sozinho em até ttl segundos
+            print(f"  [Lease] Erro ao liberar {self.company_id}: {e}")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, tipo, valor, tb):
+        self.liberar(ok=tipo is None)
+        return False
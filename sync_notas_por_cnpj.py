@@ -4,11 +4,12 @@ Busca notas onde o CNPJ informado é o TOMADOR (ator=2).
 """
 import requests
 from datetime import datetime, timezone
-from typing import List, Dict, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
 import os
 import sys
 import argparse
 import re
+from concurrent.futures import Future
 
 # Configuração de path para importações
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -20,6 +21,15 @@ from dotenv import load_dotenv
 
 sys.path.insert(0, current_dir)
 
+from cnpj_canon import canonical_cnpj, identidade_nota, limpar_cnpj
+from bulk_copy_postgres import bulk_upsert_service_notes, imprimir_resultado
+from monthly_summary import MesesAlterados, atualizar_resumo_mensal
+from postgrest_async import BuscaEGravaPorChave, EscritorEmSegundoPlano, em_ordem, encadear, executar_agora
+from window_planner import LIMIAR_PAGINAS, PAGE_QUEUE_SIZE, WINDOW_WORKERS, DensidadeCache, buscar_adaptativo
+from sync_state import (
+    SYNC_LOOKBACK_DAYS, ProgressoWatermark, calcular_inicio, ler_watermark, parse_backfill, salvar_watermark
+)
+
 # Carregar env
 env_path = os.path.join(current_dir, 'scripts', '.env')
 load_dotenv(env_path)
@@ -34,28 +44,42 @@ if not PLUGNOTAS_API_KEY:
     print(f"   Tentou carregar de: {env_path}")
     sys.exit(1)
 
+# Notas por carga no modo --bulk (limita a memória do backfill)
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "5000"))
+
 # ================= CLIENTES =================
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-def format_cnpj(cnpj: str) -> str:
-    """Formata CNPJ: 00000000000191 -> 00.000.000/0001-91"""
-    if not cnpj or len(cnpj) != 14: return cnpj
-    return f"{cnpj[:2]}.{cnpj[2:5]}.{cnpj[5:8]}/{cnpj[8:12]}-{cnpj[12:]}"
+# Meses (empresa/ano/mês) gravados nesta execução, para o resumo mensal
+meses_alterados = MesesAlterados()
+
+# Escritor assíncrono do PostgREST (--escrita-async); None = gravação síncrona pelo supabase-py
+escritor: Optional[EscritorEmSegundoPlano] = None
+# A busca da nota existente espera a gravação anterior da mesma nota (número + prestador)
+busca_e_grava = BuscaEGravaPorChave()
 
 def get_company_id_by_cnpj(cnpj: str) -> Optional[str]:
     try:
-        # Tenta formatado e não formatado
-        response = supabase.table('companies').select('id').or_(f"cnpj.eq.{cnpj},cnpj.eq.{format_cnpj(cnpj)}").execute()
+        # companies.cnpj é canônico (somente dígitos)
+        response = supabase.table('companies').select('id').eq('cnpj', limpar_cnpj(cnpj)).execute()
         if response.data and len(response.data) > 0:
             return response.data[0]['id']
         return None
     except Exception:
         return None
 
-from datetime import datetime, timedelta
-
-def fetch_notes_from_api(cnpj_tomador: str, data_inicial: str = "2024-01-01", data_final: str = "2026-12-31") -> List[Dict]:
-    """Busca notas na API PlugNotas (Tomador) em intervalos de 30 dias."""
+def iter_note_pages(cnpj_tomador: str, data_inicial: str = "2024-01-01", data_final: str = "2026-12-31",
+                    periodos_com_falha: Optional[List[str]] = None, adaptativo: bool = True,
+                    tamanho_fila: int = PAGE_QUEUE_SIZE) -> Iterator[Tuple[Tuple, List[Dict]]]:
+    """
+    Produtor das páginas da API PlugNotas (Tomador): gera (janela, notas_da_pagina).
+    Com `adaptativo`, as janelas são planejadas pela densidade histórica do CNPJ e
+    divididas/buscadas em paralelo quando muito cheias (ver window_planner);
+    sem ele, usa intervalos fixos de 30 dias. O conjunto de notas é o mesmo nos dois modos.
+    As páginas chegam por uma fila de `tamanho_fila` páginas: se o consumidor atrasar,
+    a busca espera (backpressure).
+    Se `periodos_com_falha` for informado, recebe a data inicial de cada intervalo que falhou.
+    """
     print(f"📡 Consultando API PlugNotas para CNPJ: {cnpj_tomador}...")
     print(f"   🔑 Usando API Key: {PLUGNOTAS_API_KEY[:4]}...{PLUGNOTAS_API_KEY[-4:]}")
     
@@ -64,124 +88,158 @@ def fetch_notes_from_api(cnpj_tomador: str, data_inicial: str = "2024-01-01", da
         "X-API-KEY": PLUGNOTAS_API_KEY,
         "Content-Type": "application/json"
     }
+    tamanho_pagina = 50
 
-    # Converter para datetime
-    start_date = datetime.strptime(data_inicial, "%Y-%m-%d")
-    end_date = datetime.strptime(data_final, "%Y-%m-%d")
-    
-    all_notes = []
-    current_start = start_date
-
-    while current_start <= end_date:
-        # Definir intervalo de 30 dias (limite da API é 31)
-        current_end = current_start + timedelta(days=30)
-        if current_end > end_date:
-            current_end = end_date
-            
-        periodo_ini = current_start.strftime("%Y-%m-%d")
-        periodo_fim = current_end.strftime("%Y-%m-%d")
-        
-        print(f"   � Buscando período: {periodo_ini} a {periodo_fim}...")
-
+    def buscar_pagina(inicio, fim, pagina):
+        pagina = pagina or 1
         params = {
             "cpfCnpj": cnpj_tomador,
-            "dataInicial": periodo_ini,
-            "dataFinal": periodo_fim,
+            "dataInicial": inicio.strftime("%Y-%m-%d"),
+            "dataFinal": fim.strftime("%Y-%m-%d"),
             "ator": 2, 
-            "pagina": 1,
-            "tamanhoPagina": 50
+            "pagina": pagina,
+            "tamanhoPagina": tamanho_pagina
         }
+        response = requests.get(url, headers=headers, params=params)
+        response.raise_for_status()
+        data = response.json()
         
-        while True:
-            try:
-                response = requests.get(url, headers=headers, params=params)
-                response.raise_for_status()
-                data = response.json()
-                
-                page_notes = []
-                if isinstance(data, list):
-                    page_notes = data
-                elif 'notas' in data:
-                    page_notes = data['notas']
-                
-                if not page_notes:
-                    break
-                    
-                all_notes.extend(page_notes)
-                print(f"      ✅ Página {params['pagina']}: {len(page_notes)} notas encontradas.")
-                
-                if len(page_notes) < params['tamanhoPagina']:
-                    break
-                    
-                params['pagina'] += 1
-                
-            except requests.exceptions.RequestException as e:
-                print(f"      ❌ Erro API: {e}")
-                if hasattr(e, 'response') and e.response is not None:
-                    print(f"      Detalhe (Status {e.response.status_code}): {e.response.text}")
-                break
+        page_notes = []
+        if isinstance(data, list):
+            page_notes = data
+        elif 'notas' in data:
+            page_notes = data['notas']
         
-        # Avançar para o próximo período
-        current_start = current_end + timedelta(days=1)
-            
+        if page_notes:
+            print(f"      ✅ {inicio} a {fim} | Página {pagina}: {len(page_notes)} notas encontradas.")
+        
+        # Página incompleta = última página
+        proxima = pagina + 1 if len(page_notes) == tamanho_pagina else None
+        return page_notes, proxima
+
+    def ao_falhar(janela, e):
+        print(f"      ❌ Erro API ({janela[0]} a {janela[1]}): {e}")
+        if getattr(e, 'response', None) is not None:
+            print(f"      Detalhe (Status {e.response.status_code}): {e.response.text}")
+        if periodos_com_falha is not None:
+            periodos_com_falha.append(janela[0].strftime("%Y-%m-%d"))
+
+    start_date = datetime.strptime(data_inicial, "%Y-%m-%d").date()
+    end_date = datetime.strptime(data_final, "%Y-%m-%d").date()
+    
+    cache = DensidadeCache() if adaptativo else None
+    yield from buscar_adaptativo(
+        start_date, end_date, buscar_pagina, tamanho_pagina,
+        cnpj=cnpj_tomador,
+        cache=cache,
+        limiar_paginas=LIMIAR_PAGINAS if adaptativo else None,
+        max_workers=WINDOW_WORKERS if adaptativo else 1,
+        ao_falhar=ao_falhar,
+        tamanho_fila=tamanho_fila,
+    )
+    if cache:
+        cache.salvar()
+
+def fetch_notes_from_api(cnpj_tomador: str, data_inicial: str = "2024-01-01", data_final: str = "2026-12-31",
+                         periodos_com_falha: Optional[List[str]] = None, adaptativo: bool = True) -> List[Dict]:
+    """Busca todas as notas do período em memória (ver iter_note_pages para o modo streaming)."""
+    paginas = iter_note_pages(cnpj_tomador, data_inicial, data_final, periodos_com_falha, adaptativo)
+    
+    # Ordem cronológica das janelas, igual à busca sequencial
+    all_notes = []
+    for _, notas_pagina in sorted(paginas, key=lambda r: r[0]):
+        all_notes.extend(notas_pagina)
     return all_notes
 
+def parse_api_emissao(api_note: Dict) -> datetime:
+    """Converte o campo 'emissao' da API para datetime."""
+    data_emissao_raw = api_note.get('emissao', '')
+    # Formatos possíveis: YYYY-MM-DDTHH:MM:SS, YYYY-MM-DD, DD/MM/YYYY
+    if 'T' in data_emissao_raw:
+        return datetime.fromisoformat(data_emissao_raw.replace('Z', '+00:00'))
+    elif '/' in data_emissao_raw:
+        # Formato DD/MM/YYYY
+        return datetime.strptime(data_emissao_raw, '%d/%m/%Y')
+    # Assume YYYY-MM-DD
+    return datetime.strptime(data_emissao_raw, '%Y-%m-%d')
+
+def build_api_note_record(api_note: Dict, target_cnpj: str, company_id: Optional[str] = None) -> Dict:
+    """Mapeia nota da API para o registro de service_notes."""
+    # Extração de campos básicos
+    # Estrutura esperada: { id, numero, emissao, prestador: { cpfCnpj }, tomador: { cpfCnpj }, ... }
+    
+    nota_id_plug = api_note.get('id')
+    numero = str(api_note.get('numero', ''))
+    data_date = parse_api_emissao(api_note)
+        
+    # Prestador / Tomador
+    prestador = api_note.get('prestador', {})
+    if isinstance(prestador, str):
+        print(f"⚠️ Aviso: Prestador é string na nota {api_note.get('id')}: {prestador}")
+        cnpj_prestador_raw = '' # Ou tentar extrair se for CNPJ
+    else:
+        cnpj_prestador_raw = prestador.get('cpfCnpj', '')
+    
+    tomador = api_note.get('tomador', {})
+    if isinstance(tomador, str):
+        print(f"⚠️ Aviso: Tomador é string na nota {api_note.get('id')}: {tomador}")
+        cnpj_tomador_raw = target_cnpj
+    else:
+        cnpj_tomador_raw = tomador.get('cpfCnpj', target_cnpj)
+    
+    # IDs e URLs
+    # Se a API retornar URLs, usamos. Senão, deixamos None ou construímos se soubessemos o padrão.
+    # Geralmente a API retorna 'pdf' ou 'linkPdf'?
+    download_url_pdf = api_note.get('pdf') or api_note.get('urlPdf')
+    download_url_xml = api_note.get('xml') or api_note.get('urlXml')
+    
+    # Se não tem ID oficial mas estamos criando, gerar um fallback ou usar o numero
+    final_nota_id = nota_id_plug or f"{numero}_{cnpj_prestador_raw}"
+
+    return {
+        'nota_id': final_nota_id,
+        'numero_nfse': numero,
+        'company_id': company_id,
+        'cnpj_tomador': canonical_cnpj(cnpj_tomador_raw),
+        'cnpj_prestador': canonical_cnpj(cnpj_prestador_raw),
+        'data_emissao': data_date.strftime('%Y-%m-%d'),
+        'ano': data_date.year,
+        'mes': data_date.month,
+        'dia': data_date.day,
+        'sync_status': 'synced',
+        'status': 'active',
+        's3_bucket': 'plugnotas-api', # Marcador de origem
+        # URLs da API podem expirar, mas salvamos se tiver
+        'download_url_pdf': download_url_pdf,
+        'download_url_xml': download_url_xml
+    }
+
 def sync_api_note_to_supabase(api_note: Dict, target_cnpj: str) -> bool:
     """Mapeia nota da API para Supabase."""
+    return enviar_api_note_ao_supabase(api_note, target_cnpj).result()
+
+def enviar_api_note_ao_supabase(api_note: Dict, target_cnpj: str) -> Future:
+    """
+    Mesmo que sync_api_note_to_supabase, mas retorna um Future[bool]. Com o escritor
+    assíncrono a gravação fica em voo e a chamada volta logo; sem ele, grava na hora.
+    A busca da nota existente só roda depois da gravação anterior da mesma nota terminar.
+    """
+    vez = None
     try:
-        # Extração de campos básicos
-        # Estrutura esperada: { id, numero, emissao, prestador: { cpfCnpj }, tomador: { cpfCnpj }, ... }
+        record = build_api_note_record(api_note, target_cnpj)
         
         nota_id_plug = api_note.get('id')
-        numero = str(api_note.get('numero', ''))
-        
-        # Datas
-        data_emissao_raw = api_note.get('emissao', '')
-        # Formatos possíveis: YYYY-MM-DDTHH:MM:SS, YYYY-MM-DD, DD/MM/YYYY
-        if 'T' in data_emissao_raw:
-            data_date = datetime.fromisoformat(data_emissao_raw.replace('Z', '+00:00'))
-        elif '/' in data_emissao_raw:
-             # Formato DD/MM/YYYY
-             data_date = datetime.strptime(data_emissao_raw, '%d/%m/%Y')
-        else:
-            # Assume YYYY-MM-DD
-            data_date = datetime.strptime(data_emissao_raw, '%Y-%m-%d')
-            
-        data_emissao = data_date.strftime('%Y-%m-%d')
-        ano = data_date.year
-        mes = data_date.month
-        dia = data_date.day
-        
-        # Prestador / Tomador
-        prestador = api_note.get('prestador', {})
-        if isinstance(prestador, str):
-            print(f"⚠️ Aviso: Prestador é string na nota {api_note.get('id')}: {prestador}")
-            cnpj_prestador_raw = '' # Ou tentar extrair se for CNPJ
-        else:
-            cnpj_prestador_raw = prestador.get('cpfCnpj', '')
-        
-        tomador = api_note.get('tomador', {})
-        if isinstance(tomador, str):
-            print(f"⚠️ Aviso: Tomador é string na nota {api_note.get('id')}: {tomador}")
-            cnpj_tomador_raw = target_cnpj
-        else:
-            cnpj_tomador_raw = tomador.get('cpfCnpj', target_cnpj)
-        
-        # Formatar
-        cnpj_prestador_fmt = format_cnpj(cnpj_prestador_raw)
-        cnpj_tomador_fmt = format_cnpj(cnpj_tomador_raw)
+        numero = record['numero_nfse']
+        cnpj_prestador_fmt = record['cnpj_prestador']
+        # Número + prestador: a mesma nota com ou sem o ID do PlugNotas cai na mesma vez
+        chave_busca = f"{numero}_{cnpj_prestador_fmt}"
+        vez = busca_e_grava.aguardar(chave_busca)
         
         # Buscar Company
-        company_id = get_company_id_by_cnpj(cnpj_tomador_raw)
-        
-        # IDs e URLs
-        # Se a API retornar URLs, usamos. Senão, deixamos None ou construímos se soubessemos o padrão.
-        # Geralmente a API retorna 'pdf' ou 'linkPdf'?
-        download_url_pdf = api_note.get('pdf') or api_note.get('urlPdf')
-        download_url_xml = api_note.get('xml') or api_note.get('urlXml')
+        record['company_id'] = get_company_id_by_cnpj(record['cnpj_tomador'])
         
         # Verificar existência (por ID plugnotas OU Numero+Prestador)
-        query = supabase.table('service_notes').select('id, nota_id')
+        query = supabase.table('service_notes').select('id, nota_id, company_id, ano, mes')
         
         # Prioridade 1: Buscar pelo ID oficial do PlugNotas
         existing_by_id = None
@@ -191,54 +249,102 @@ def sync_api_note_to_supabase(api_note: Dict, target_cnpj: str) -> bool:
         record_id = None
         is_update = False
         
+        existente = None
         if existing_by_id and existing_by_id.data:
-            record_id = existing_by_id.data[0]['id']
-            is_update = True
+            existente = existing_by_id.data[0]
         else:
             # Prioridade 2: Buscar por chave semântica (Numero + Prestador)
             existing_by_content = supabase.table('service_notes')\
-                .select('id')\
+                .select('id, company_id, ano, mes')\
                 .eq('numero_nfse', numero)\
-                .or_(f"cnpj_prestador.eq.{cnpj_prestador_fmt},cnpj_prestador.eq.{cnpj_prestador_raw}")\
+                .eq('cnpj_prestador', cnpj_prestador_fmt)\
                 .execute()
                 
             if existing_by_content.data:
-                record_id = existing_by_content.data[0]['id']
-                is_update = True
+                existente = existing_by_content.data[0]
         
-        # Se não tem ID oficial mas estamos criando, gerar um fallback ou usar o numero
-        final_nota_id = nota_id_plug or f"{numero}_{cnpj_prestador_raw}"
-
-        record = {
-            'nota_id': final_nota_id,
-            'numero_nfse': numero,
-            'company_id': company_id,
-            'cnpj_tomador': cnpj_tomador_fmt,
-            'cnpj_prestador': cnpj_prestador_fmt,
-            'data_emissao': data_emissao,
-            'ano': ano,
-            'mes': mes,
-            'dia': dia,
-            'sync_status': 'synced',
-            'status': 'active',
-            's3_bucket': 'plugnotas-api', # Marcador de origem
-            # URLs da API podem expirar, mas salvamos se tiver
-            'download_url_pdf': download_url_pdf,
-            'download_url_xml': download_url_xml
-        }
+        if existente:
+            record_id = existente['id']
+            is_update = True
+            # O mês antigo também muda no resumo se a nota trocou de mês/empresa
+            meses_alterados.registrar(existente)
         
+        # Gravações da mesma nota saem na ordem de envio
+        chave = nota_id_plug or f"{numero}_{cnpj_prestador_fmt}"
         if is_update:
-            supabase.table('service_notes').update(record).eq('id', record_id).execute()
-            print(f"  ✅ Atualizada: {numero} (Prestador: {cnpj_prestador_fmt})")
+            if escritor:
+                futuro = escritor.update('service_notes', record, {'id': record_id}, chave=chave)
+            else:
+                futuro = executar_agora(lambda: supabase.table('service_notes')
+                                        .update(record).eq('id', record_id).execute())
         else:
-            supabase.table('service_notes').insert(record).execute()
-            print(f"  ✅ Inserida: {numero} (Prestador: {cnpj_prestador_fmt})")
-            
-        return True
+            if escritor:
+                futuro = escritor.insert('service_notes', record, chave=chave)
+            else:
+                futuro = executar_agora(lambda: supabase.table('service_notes').insert(record).execute())
         
     except Exception as e:
+        if vez:
+            busca_e_grava.liberar(chave_busca, vez)
         print(f"  ❌ Erro ao processar nota {api_note.get('id')}: {e}")
-        return False
+        return executar_agora(lambda: False)
+    busca_e_grava.liberar(chave_busca, vez, futuro)
+
+    def concluir(erro) -> bool:
+        if erro:
+            print(f"  ❌ Erro ao processar nota {api_note.get('id')}: {erro}")
+            return False
+        if is_update:
+            print(f"  ✅ Atualizada: {numero} (Prestador: {cnpj_prestador_fmt})")
+        else:
+            print(f"  ✅ Inserida: {numero} (Prestador: {cnpj_prestador_fmt})")
+        meses_alterados.registrar(record)
+        return True
+
+    return encadear(futuro, concluir)
+
+def _registrar_progresso(progresso: ProgressoWatermark, nota: Dict, ok: bool):
+    try:
+        data_emissao = parse_api_emissao(nota)
+    except (ValueError, TypeError):
+        return
+    if ok:
+        progresso.sucesso(data_emissao)
+    else:
+        progresso.falha(data_emissao)
+
+def sync_notes_bulk(notas: List[Dict], target_cnpj: str, company_id: Optional[str] = None,
+                    imprimir: bool = True) -> Dict:
+    """
+    Backfill do tenant via COPY direto no Postgres (uma carga por chamada).
+    resultado['notas_com_erro'] traz as posições em `notas` que não foram gravadas.
+    """
+    if company_id is None:
+        company_id = get_company_id_by_cnpj(target_cnpj)
+    records = []
+    origens = []
+    erros_mapeamento = []
+    for linha, nota in enumerate(notas):
+        try:
+            records.append(build_api_note_record(nota, target_cnpj, company_id))
+            origens.append(linha)
+        except Exception as e:
+            erros_mapeamento.append({"linha": linha, "nota_id": nota.get('id'), "motivos": [f"mapeamento: {e}"]})
+
+    resultado = bulk_upsert_service_notes(records, preferir_id_da_origem=True)
+    meses_alterados.registrar_varios(records)
+    # Os erros da validação trazem o nota_id do registro (fallback se a nota não tem id)
+    # e o lote é deduplicado: a rejeição vale para todas as notas com a mesma identidade
+    ids_com_erro = {e['nota_id'] for e in resultado['erros']}
+    rejeitadas = {identidade_nota(r) for r in records if r.get('nota_id') in ids_com_erro}
+    resultado['notas_com_erro'] = {e['linha'] for e in erros_mapeamento} | {
+        linha for linha, record in zip(origens, records) if identidade_nota(record) in rejeitadas
+    }
+    resultado['recebidas'] = len(notas)
+    resultado['erros'] = erros_mapeamento + resultado['erros']
+    if imprimir:
+        imprimir_resultado(resultado)
+    return resultado
 
 def registrar_log(inicio: datetime, sucesso: int, total: int, erros: int, cnpj_filtro: str):
     try:
@@ -260,6 +366,18 @@ def registrar_log(inicio: datetime, sucesso: int, total: int, erros: int, cnpj_f
 def main():
     parser = argparse.ArgumentParser(description="Sincronizar notas via API PlugNotas.")
     parser.add_argument("cnpj", nargs="?", help="CNPJ do Tomador (somente números)")
+    parser.add_argument("--bulk", action="store_true",
+                        help="Carga em massa via COPY direto no Postgres (requer SUPABASE_DB_URL)")
+    parser.add_argument("--backfill", nargs=2, metavar=("FROM", "TO"),
+                        help="Busca o histórico completo entre FROM e TO (YYYY-MM-DD), ignorando o watermark")
+    parser.add_argument("--janelas-fixas", action="store_true",
+                        help="Usa janelas fixas de 30 dias em vez do planejamento adaptativo")
+    parser.add_argument("--fila", type=int, default=PAGE_QUEUE_SIZE,
+                        help="Páginas mantidas em memória entre a busca e a gravação")
+    parser.add_argument("--lookback", type=int, default=SYNC_LOOKBACK_DAYS,
+                        help="Dias antes do watermark reconsultados para pegar notas atrasadas")
+    parser.add_argument("--escrita-async", action="store_true",
+                        help="Grava pelo escritor assíncrono do PostgREST (várias gravações em voo, requer httpx)")
     args = parser.parse_args()
 
     target_cnpj = args.cnpj
@@ -277,25 +395,99 @@ def main():
     print(f"🚀 SYNC VIA API PLUGNOTAS | TOMADOR: {target_cnpj}")
     print("=" * 80)
     
-    # 1. Buscar Notas
-    notas = fetch_notes_from_api(target_cnpj)
-    print(f"✅ Total de notas retornadas pela API: {len(notas)}")
+    # 1. Definir janela (watermark incremental ou backfill explícito)
+    company_id = get_company_id_by_cnpj(target_cnpj)
+    watermark = ler_watermark(supabase, company_id) if company_id else None
+    
+    if args.backfill:
+        data_inicial, data_final = parse_backfill(args.backfill)
+        print(f"📚 Backfill: {data_inicial} a {data_final}")
+    else:
+        data_inicial = calcular_inicio(watermark, datetime(2024, 1, 1).date(), args.lookback)
+        data_final = datetime.now().date()
+        print(f"⏱️  Watermark: {watermark or 'nenhum'} | Buscando de {data_inicial} a {data_final}")
+    
+    # 2. Buscar e sincronizar em streaming: as páginas chegam por uma fila limitada
+    #    e a busca espera quando a gravação atrasa (memória não cresce com o histórico)
+    periodos_com_falha = []
+    paginas = iter_note_pages(target_cnpj, data_inicial.isoformat(), data_final.isoformat(), periodos_com_falha,
+                              adaptativo=not args.janelas_fixas, tamanho_fila=args.fila)
     
-    # 2. Sincronizar
-    print("\n💾 Salvando no Supabase...")
+    total = 0
     sucesso = 0
     erros = 0
+    progresso = ProgressoWatermark()
     
-    for nota in notas:
-        if sync_api_note_to_supabase(nota, target_cnpj):
-            sucesso += 1
-        else:
-            erros += 1
+    if args.bulk:
+        print("\n📦 Carregando notas via COPY no Postgres (em lotes)...")
+        resultado = {"recebidas": 0, "inseridas": 0, "atualizadas": 0, "erros": []}
+        lote = []
+        
+        def enviar_lote():
+            parcial = sync_notes_bulk(lote, target_cnpj, company_id, imprimir=False)
+            for linha, nota in enumerate(lote):
+                _registrar_progresso(progresso, nota, linha not in parcial['notas_com_erro'])
+            for chave in ("recebidas", "inseridas", "atualizadas"):
+                resultado[chave] += parcial[chave]
+            resultado["erros"].extend(parcial["erros"])
+            lote.clear()
+        
+        for _, notas_pagina in paginas:
+            total += len(notas_pagina)
+            lote.extend(notas_pagina)
+            if len(lote) >= BULK_CHUNK_SIZE:
+                enviar_lote()
+        if lote:
+            enviar_lote()
+        
+        imprimir_resultado(resultado)
+        sucesso = resultado['inseridas'] + resultado['atualizadas']
+        erros = len(resultado['erros'])
+    else:
+        print("\n💾 Salvando no Supabase...")
+        global escritor
+        if args.escrita_async:
+            escritor = EscritorEmSegundoPlano(SUPABASE_URL, SUPABASE_KEY)
+
+        def notas_das_paginas():
+            nonlocal total
+            for _, notas_pagina in paginas:
+                total += len(notas_pagina)
+                yield from notas_pagina
+
+        try:
+            # Com o escritor assíncrono, as próximas notas seguem enquanto as gravações estão em voo
+            limite = escritor.limite_pendentes if escritor else 1
+            for nota, ok in em_ordem(notas_das_paginas(), lambda n: enviar_api_note_ao_supabase(n, target_cnpj),
+                                     limite):
+                _registrar_progresso(progresso, nota, ok)
+                if ok:
+                    sucesso += 1
+                else:
+                    erros += 1
+        finally:
+            if escritor:
+                escritor.fechar()
+                escritor = None
+    
+    print(f"✅ Total de notas retornadas pela API: {total}")
+    for periodo_ini in periodos_com_falha:
+        progresso.falha(periodo_ini)
+    
+    # 4. Avançar watermark da empresa
+    if company_id:
+        try:
+            salvar_watermark(supabase, company_id, progresso.novo_watermark(), watermark)
+        except Exception as e:
+            print(f"⚠️ Erro ao salvar watermark: {e}")
+            
+    # 5. Atualizar o resumo mensal dos meses gravados
+    atualizar_resumo_mensal(supabase, meses_alterados)
             
     print("=" * 80)
     print(f"✅ FIM. Sucesso: {sucesso} | Erros: {erros}")
     
-    registrar_log(inicio_sync, sucesso, len(notas), erros, target_cnpj)
+    registrar_log(inicio_sync, sucesso, total, erros, target_cnpj)
 
 if __name__ == "__main__":
     main()
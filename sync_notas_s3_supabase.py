@@ -4,9 +4,11 @@ Busca todas as notas no bucket S3 e registra no banco de dados.
 """
 import boto3
 from datetime import datetime, timezone
-from typing import List, Dict, Optional
+from typing import Dict, Iterator, List, Optional
 import os
 import sys
+import argparse
+from concurrent.futures import Future
 
 # Corrigir conflito de nomes: se houver um diretório local chamado 'supabase', 
 # o Python tentará importar dele em vez da biblioteca instalada.
@@ -20,7 +22,11 @@ from supabase import create_client, Client
 # Restaurar o path para outras importações locais se necessário
 sys.path.insert(0, current_dir)
 
-import re
+from cnpj_canon import canonical_cnpj, limpar_cnpj
+from monthly_summary import MesesAlterados, atualizar_resumo_mensal
+from notas_s3 import PADRAO_S3_KEY, ChaveNota, NotaS3, group_files_by_nota
+from postgrest_async import BuscaEGravaPorChave, EscritorEmSegundoPlano, em_ordem, encadear, executar_agora
+from sync_failures import SYNC_RETRY_MAX_ATTEMPTS, RegistroFalhas, classe_do_erro, falhas_a_retentar
 
 from botocore.config import Config
 
@@ -53,6 +59,17 @@ s3_client = boto3.client(
 # Cliente Supabase
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+# Meses (empresa/ano/mês) gravados nesta execução, para o resumo mensal
+meses_alterados = MesesAlterados()
+
+# Escritor assíncrono do PostgREST (--escrita-async); None = gravação síncrona pelo supabase-py
+escritor: Optional[EscritorEmSegundoPlano] = None
+# A busca da nota existente espera a gravação anterior da mesma nota (número + prestador)
+busca_e_grava = BuscaEGravaPorChave()
+
+# Falhas por nota em sync_failures (main); None = só imprime, como na ingestão por eventos
+falhas: Optional[RegistroFalhas] = None
+
 
 def parse_s3_key(s3_key: str) -> Optional[Dict]:
     """
@@ -61,8 +78,7 @@ def parse_s3_key(s3_key: str) -> Optional[Dict]:
     
     Exemplo: notas/25249058000102/2026/02/NFSe_10-02-2026_12345_12345678000199.pdf
     """
-    pattern = r'notas/(\d{14})/(\d{4})/(\d{2})/NFSe_(\d{2})-(\d{2})-(\d{4})_(\d+)_(\d{14})\.(pdf|xml)'
-    match = re.match(pattern, s3_key)
+    match = PADRAO_S3_KEY.match(s3_key)
     
     if not match:
         print(f"  ⚠️  Formato inválido: {s3_key}")
@@ -88,11 +104,11 @@ def parse_s3_key(s3_key: str) -> Optional[Dict]:
     }
 
 
-def list_all_s3_files(prefix: str = "notas/") -> List[str]:
-    """Lista todos os arquivos no bucket S3."""
+def iter_s3_files(prefix: str = "notas/") -> Iterator[str]:
+    """Percorre os PDFs e XMLs do bucket S3 sem guardar a listagem inteira em memória."""
     print(f"🔍 Listando arquivos no bucket S3: {BUCKET_NAME}/{prefix}")
     
-    all_files = []
+    total = 0
     paginator = s3_client.get_paginator('list_objects_v2')
     
     for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefix):
@@ -101,10 +117,15 @@ def list_all_s3_files(prefix: str = "notas/") -> List[str]:
                 key = obj['Key']
                 # Filtrar apenas PDFs e XMLs
                 if key.endswith('.pdf') or key.endswith('.xml'):
-                    all_files.append(key)
+                    total += 1
+                    yield key
     
-    print(f"✅ Total de arquivos encontrados: {len(all_files)}")
-    return all_files
+    print(f"✅ Total de arquivos encontrados: {total}")
+
+
+def list_all_s3_files(prefix: str = "notas/") -> List[str]:
+    """Lista todos os arquivos no bucket S3."""
+    return list(iter_s3_files(prefix))
 
 
 def generate_s3_presigned_url(s3_key: str, expiration: int = 3600) -> str:
@@ -122,9 +143,9 @@ def generate_s3_presigned_url(s3_key: str, expiration: int = 3600) -> str:
 
 
 def get_company_id_by_cnpj(cnpj: str) -> Optional[str]:
-    """Busca o ID da empresa no Supabase pelo CNPJ."""
+    """Busca o ID da empresa no Supabase pelo CNPJ (companies.cnpj é canônico: só dígitos)."""
     try:
-        response = supabase.table('companies').select('id').eq('cnpj', cnpj).execute()
+        response = supabase.table('companies').select('id').eq('cnpj', limpar_cnpj(cnpj)).execute()
         if response.data and len(response.data) > 0:
             return response.data[0]['id']
         return None
@@ -133,72 +154,93 @@ def get_company_id_by_cnpj(cnpj: str) -> Optional[str]:
         return None
 
 
-def group_files_by_nota(files: List[str]) -> Dict[str, Dict]:
-    """
-    Agrupa arquivos PDF e XML da mesma nota.
-    Retorna dict com chave única e dados consolidados.
-    """
-    notas = {}
-    
-    for file_path in files:
-        info = parse_s3_key(file_path)
-        if not info:
-            continue
-        
-        # Chave única: cnpj_tomador + numero + data_emissao
-        nota_key = f"{info['cnpj_tomador']}_{info['numero_nfse']}_{info['data_emissao']}"
-        
-        if nota_key not in notas:
-            notas[nota_key] = {
-                'cnpj_tomador': info['cnpj_tomador'],
-                'cnpj_prestador': info['cnpj_prestador'],
-                'numero_nfse': info['numero_nfse'],
-                'data_emissao': info['data_emissao'],
-                'ano': info['ano'],
-                'mes': info['mes'],
-                'dia': info['dia'],
-                's3_path_pdf': None,
-                's3_path_xml': None,
-            }
-        
-        # Adicionar o caminho do arquivo
-        if info['tipo'] == 'pdf':
-            notas[nota_key]['s3_path_pdf'] = file_path
-        elif info['tipo'] == 'xml':
-            notas[nota_key]['s3_path_xml'] = file_path
+def build_note_record(nota_data: Dict, nota_id: str, company_id: Optional[str]) -> Dict:
+    """Monta o registro de service_notes a partir da nota agrupada do S3."""
+    # Gerar URLs de download (válidas por 24 horas)
+    download_url_pdf = generate_s3_presigned_url(nota_data['s3_path_pdf'], 86400) if nota_data['s3_path_pdf'] else None
+    download_url_xml = generate_s3_presigned_url(nota_data['s3_path_xml'], 86400) if nota_data['s3_path_xml'] else None
     
-    return notas
+    return {
+        'nota_id': nota_id,
+        'numero_nfse': str(nota_data['numero_nfse']),
+        'company_id': company_id,
+        'cnpj_tomador': canonical_cnpj(nota_data['cnpj_tomador']),
+        'cnpj_prestador': canonical_cnpj(nota_data['cnpj_prestador']),
+        'data_emissao': nota_data['data_emissao'],
+        'ano': nota_data['ano'],
+        'mes': nota_data['mes'],
+        'dia': nota_data['dia'],
+        's3_path_pdf': nota_data['s3_path_pdf'],
+        's3_path_xml': nota_data['s3_path_xml'],
+        's3_bucket': BUCKET_NAME,
+        'download_url_pdf': download_url_pdf,
+        'download_url_xml': download_url_xml,
+        'sync_status': 'synced',
+        'status': 'active'
+    }
+
 
+def load_company_ids() -> Dict[str, str]:
+    """Carrega o mapa CNPJ (só dígitos) -> company_id em uma única consulta."""
+    response = supabase.table('companies').select('id, cnpj').execute()
+    return {limpar_cnpj(company['cnpj']): company['id'] for company in response.data or []}
 
 
-def format_cnpj(cnpj: str) -> str:
-    """Formata CNPJ para o padrão XX.XXX.XXX/XXXX-XX"""
-    if not cnpj or len(cnpj) != 14:
-        return cnpj
-    return f"{cnpj[:2]}.{cnpj[2:5]}.{cnpj[5:8]}/{cnpj[8:12]}-{cnpj[12:]}"
+def sync_notas_bulk(notas: Dict[ChaveNota, NotaS3]) -> Dict:
+    """Reconstrói service_notes a partir do bucket via COPY direto no Postgres."""
+    from bulk_copy_postgres import bulk_upsert_service_notes, imprimir_resultado
+
+    company_ids = load_company_ids()
+    records = [
+        build_note_record(
+            nota.como_dict(),
+            f"{nota.numero_nfse}_{nota.cnpj_prestador}",
+            company_ids.get(nota.cnpj_tomador),
+        )
+        for nota in notas.values()
+    ]
+    
+    resultado = bulk_upsert_service_notes(records, preferir_id_da_origem=False)
+    meses_alterados.registrar_varios(records)
+    imprimir_resultado(resultado)
+    return resultado
+
 
 def sync_nota_to_supabase(nota_data: Dict) -> bool:
     """Insere ou atualiza uma nota no Supabase."""
+    return enviar_nota_ao_supabase(nota_data).result()
+
+
+def chave_falha(nota_data: Dict) -> str:
+    """Chave da nota em sync_failures: número + CNPJ do prestador (canônico)."""
+    return f"{nota_data.get('numero_nfse')}_{canonical_cnpj(nota_data.get('cnpj_prestador'))}"
+
+
+def enviar_nota_ao_supabase(nota_data: Dict) -> Future:
+    """
+    Mesmo que sync_nota_to_supabase, mas retorna um Future[bool]. Com o escritor
+    assíncrono a gravação fica em voo e a chamada volta logo; sem ele, grava na hora.
+    Com `falhas` ativo, a falha da nota vai para sync_failures e o sucesso a remove.
+    A busca da nota existente só roda depois da gravação anterior da mesma nota
+    terminar: duas cópias em voo não viram dois inserts.
+    """
+    nota_id = company_id = vez = None
     try:
-        # Formatar CNPJs para garantir consistência com o script TS
-        cnpj_tomador_raw = nota_data['cnpj_tomador']
+        # CNPJ canônico (formatado), o mesmo gravado pelo script TS
         cnpj_prestador_raw = nota_data['cnpj_prestador']
-        
-        cnpj_tomador_fmt = format_cnpj(cnpj_tomador_raw)
-        cnpj_prestador_fmt = format_cnpj(cnpj_prestador_raw)
+        cnpj_prestador_fmt = canonical_cnpj(cnpj_prestador_raw)
+        # Gravações da mesma nota (número + prestador) saem na ordem de envio
+        chave = f"{nota_data['numero_nfse']}_{cnpj_prestador_fmt}"
+        vez = busca_e_grava.aguardar(chave)
         
         # Buscar company_id
-        company_id = get_company_id_by_cnpj(cnpj_tomador_fmt) or get_company_id_by_cnpj(cnpj_tomador_raw)
-        
-        # Gerar URLs de download (válidas por 24 horas)
-        download_url_pdf = generate_s3_presigned_url(nota_data['s3_path_pdf'], 86400) if nota_data['s3_path_pdf'] else None
-        download_url_xml = generate_s3_presigned_url(nota_data['s3_path_xml'], 86400) if nota_data['s3_path_xml'] else None
+        company_id = get_company_id_by_cnpj(nota_data['cnpj_tomador'])
         
         # Tentar encontrar a nota existente pelo Número + CNPJs (evitar duplicidade com IDs diferentes)
         existing = supabase.table('service_notes')\
-            .select('id, nota_id')\
+            .select('id, nota_id, company_id, ano, mes')\
             .eq('numero_nfse', str(nota_data['numero_nfse']))\
-            .or_(f"cnpj_prestador.eq.{cnpj_prestador_fmt},cnpj_prestador.eq.{cnpj_prestador_raw}")\
+            .eq('cnpj_prestador', cnpj_prestador_fmt)\
             .execute()
             
         # Determinar nota_id
@@ -207,6 +249,8 @@ def sync_nota_to_supabase(nota_data: Dict) -> bool:
             nota_id = existing.data[0]['nota_id']
             record_id = existing.data[0]['id']
             is_update = True
+            # O mês antigo também muda no resumo se a nota trocou de mês/empresa
+            meses_alterados.registrar(existing.data[0])
         else:
             # Não existe, gerar ID padronizado (fallback)
             nota_id = f"{nota_data['numero_nfse']}_{cnpj_prestador_raw}"
@@ -214,47 +258,54 @@ def sync_nota_to_supabase(nota_data: Dict) -> bool:
             is_update = False
         
         # Dados para inserir/atualizar
-        record = {
-            'nota_id': nota_id,
-            'numero_nfse': str(nota_data['numero_nfse']),
-            'company_id': company_id,
-            'cnpj_tomador': cnpj_tomador_fmt,
-            'cnpj_prestador': cnpj_prestador_fmt,
-            'data_emissao': nota_data['data_emissao'],
-            'ano': nota_data['ano'],
-            'mes': nota_data['mes'],
-            'dia': nota_data['dia'],
-            's3_path_pdf': nota_data['s3_path_pdf'],
-            's3_path_xml': nota_data['s3_path_xml'],
-            's3_bucket': BUCKET_NAME,
-            'download_url_pdf': download_url_pdf,
-            'download_url_xml': download_url_xml,
-            'sync_status': 'synced',
-            'status': 'active'
-        }
+        record = build_note_record(nota_data, nota_id, company_id)
         
         if is_update:
             # Atualizar registro existente
-            result = supabase.table('service_notes')\
-                .update(record)\
-                .eq('id', record_id)\
-                .execute()
-            print(f"  ✅ Atualizada: NFS-e {nota_data['numero_nfse']} - {nota_data['data_emissao']} (ID: {nota_id})")
+            if escritor:
+                futuro = escritor.update('service_notes', record, {'id': record_id}, chave=chave)
+            else:
+                futuro = executar_agora(lambda: supabase.table('service_notes')
+                                        .update(record).eq('id', record_id).execute())
         else:
             # Inserir novo registro
-            result = supabase.table('service_notes').insert(record).execute()
-            print(f"  ✅ Inserida: NFS-e {nota_data['numero_nfse']} - {nota_data['data_emissao']} (Novo ID)")
-        
-        return True
+            if escritor:
+                futuro = escritor.insert('service_notes', record, chave=chave)
+            else:
+                futuro = executar_agora(lambda: supabase.table('service_notes').insert(record).execute())
         
     except Exception as e:
+        if vez:
+            busca_e_grava.liberar(chave, vez)
         print(f"  ❌ Erro ao sincronizar nota {nota_data.get('numero_nfse')}: {e}")
-        return False
+        if falhas:
+            falhas.falhou(chave_falha(nota_data), nota_data, e, classe_do_erro(e, "supabase"),
+                          nota_id=nota_id, company_id=company_id)
+        return executar_agora(lambda: False)
+    busca_e_grava.liberar(chave, vez, futuro)
+
+    def concluir(erro) -> bool:
+        if erro:
+            print(f"  ❌ Erro ao sincronizar nota {nota_data.get('numero_nfse')}: {erro}")
+            if falhas:
+                falhas.falhou(chave_falha(nota_data), nota_data, erro, classe_do_erro(erro, "supabase"),
+                              nota_id=nota_id, company_id=company_id)
+            return False
+        if is_update:
+            print(f"  ✅ Atualizada: NFS-e {nota_data['numero_nfse']} - {nota_data['data_emissao']} (ID: {nota_id})")
+        else:
+            print(f"  ✅ Inserida: NFS-e {nota_data['numero_nfse']} - {nota_data['data_emissao']} (Novo ID)")
+        meses_alterados.registrar(record)
+        if falhas:
+            falhas.resolveu(chave_falha(nota_data))
+        return True
+
+    return encadear(futuro, concluir)
 
 
 
 
-def registrar_log(inicio: datetime, sucesso: int, total: int, erros: int):
+def registrar_log(inicio: datetime, sucesso: int, total: int, erros: int, extras: Optional[Dict] = None):
     """Registra a execução na tabela sync_logs para refletir no frontend."""
     try:
         agora = datetime.now(timezone.utc)
@@ -266,7 +317,7 @@ def registrar_log(inicio: datetime, sucesso: int, total: int, erros: int):
             'notes_found': total,
             'notes_synced': sucesso,
             'error_message': f"Erros: {erros}" if erros > 0 else None,
-            'metadata': {'source': 'python_s3_script'}
+            'metadata': {'source': 'python_s3_script', **(extras or {})}
         }
         
         supabase.table('sync_logs').insert(log_data).execute()
@@ -278,36 +329,86 @@ def registrar_log(inicio: datetime, sucesso: int, total: int, erros: int):
 
 def main():
     """Função principal."""
+    parser = argparse.ArgumentParser(description="Sincronizar notas do S3 para o Supabase.")
+    parser.add_argument("--bulk", action="store_true",
+                        help="Carga em massa via COPY direto no Postgres (requer SUPABASE_DB_URL)")
+    parser.add_argument("--prefix", default="notas/", help="Prefixo do bucket a sincronizar")
+    parser.add_argument("--escrita-async", action="store_true",
+                        help="Grava pelo escritor assíncrono do PostgREST (várias gravações em voo, requer httpx)")
+    parser.add_argument("--retentar-falhas", action="store_true",
+                        help="Regrava só as notas que falharam (sync_failures) e cuja espera já venceu, sem listar o bucket")
+    parser.add_argument("--max-tentativas", type=int, default=SYNC_RETRY_MAX_ATTEMPTS,
+                        help="Com --retentar-falhas, ignora as notas que já falharam este número de vezes")
+    args = parser.parse_args()
+    if args.retentar_falhas and args.bulk:
+        parser.error("--retentar-falhas não combina com --bulk")
+
     inicio_sync = datetime.now(timezone.utc)
     
     print("=" * 80)
     print("🚀 SINCRONIZAÇÃO DE NOTAS FISCAIS: S3 → SUPABASE")
     print("=" * 80)
     
-    # 1. Listar todos os arquivos no S3
-    all_files = list_all_s3_files()
+    global escritor, falhas
+    if not args.bulk:
+        falhas = RegistroFalhas(supabase, "s3")
     
-    if not all_files:
-        print("⚠️  Nenhum arquivo encontrado no S3.")
-        return
-    
-    # 2. Agrupar arquivos por nota (PDF + XML)
-    print("\n📦 Agrupando arquivos por nota...")
-    notas = group_files_by_nota(all_files)
-    print(f"✅ Total de notas identificadas: {len(notas)}")
+    if args.retentar_falhas:
+        # 1 e 2. Só as notas que falharam, com os dados guardados na falha
+        print("\n🔁 Buscando notas com falha para retentar...")
+        notas = [falha["payload"] for pagina in falhas_a_retentar(supabase, "s3", args.max_tentativas)
+                 for falha in pagina]
+        if not notas:
+            print("✅ Nenhuma nota com falha a retentar.")
+            return
+        print(f"✅ Notas a retentar: {len(notas)}")
+    else:
+        # 1 e 2. Listar os arquivos no S3 e agrupar por nota (PDF + XML) em streaming,
+        #       sem guardar a listagem inteira em memória
+        print("\n📦 Agrupando arquivos por nota...")
+        notas = group_files_by_nota(iter_s3_files(args.prefix))
+        
+        if not notas:
+            print("⚠️  Nenhuma nota encontrada no S3.")
+            return
+        
+        print(f"✅ Total de notas identificadas: {len(notas)}")
     
     # 3. Sincronizar cada nota para o Supabase
-    print("\n💾 Sincronizando notas para o Supabase...")
     success_count = 0
     error_count = 0
     
-    for nota_key, nota_data in notas.items():
-        if sync_nota_to_supabase(nota_data):
-            success_count += 1
-        else:
-            error_count += 1
+    if args.bulk:
+        print("\n📦 Carregando notas via COPY no Postgres...")
+        resultado = sync_notas_bulk(notas)
+        success_count = resultado['inseridas'] + resultado['atualizadas']
+        error_count = len(resultado['erros'])
+    else:
+        print("\n💾 Sincronizando notas para o Supabase...")
+        if args.escrita_async:
+            escritor = EscritorEmSegundoPlano(SUPABASE_URL, SUPABASE_KEY)
+        try:
+            # Com o escritor assíncrono, as próximas notas seguem enquanto as gravações estão em voo
+            limite = escritor.limite_pendentes if escritor else 1
+            dados = notas if args.retentar_falhas else (nota.como_dict() for nota in notas.values())
+            for _, ok in em_ordem(dados, enviar_nota_ao_supabase, limite):
+                if ok:
+                    success_count += 1
+                else:
+                    error_count += 1
+        finally:
+            if escritor:
+                escritor.fechar()
+                escritor = None
+        try:
+            falhas.descarregar()
+        except Exception as e:
+            print(f"⚠️ Erro ao gravar as falhas das notas: {e}")
+    
+    # 4. Atualizar o resumo mensal dos meses gravados
+    atualizar_resumo_mensal(supabase, meses_alterados)
     
-    # 4. Resumo final
+    # 5. Resumo final
     print("\n" + "=" * 80)
     print("✅ SINCRONIZAÇÃO CONCLUÍDA")
     print("=" * 80)
@@ -316,8 +417,11 @@ def main():
     print(f"📊 Total processado: {len(notas)}")
     print("=" * 80)
     
-    # 5. Registrar log de sincronização
-    registrar_log(inicio_sync, success_count, len(notas), error_count)
+    # 6. Registrar log de sincronização
+    extras = falhas.extrair_contadores() if falhas else {}
+    if args.retentar_falhas:
+        extras['modo'] = 'retentar_falhas'
+    registrar_log(inicio_sync, success_count, len(notas), error_count, extras)
 
 
 if __name__ == "__main__":
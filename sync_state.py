@@ -0,0 +1,91 @@
+"""
+Watermark incremental por empresa para os fetchers da PlugNotas.
+
+O watermark é a última data_emissao sincronizada com sucesso, gravada em
+companies.sync_watermark (ao lado de last_sync). As execuções seguintes só
+consultam a partir dele, voltando SYNC_LOOKBACK_DAYS para pegar notas
+registradas com atraso.
+"""
+import os
+import threading
+from datetime import date, datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+
+SYNC_LOOKBACK_DAYS = int(os.getenv("SYNC_LOOKBACK_DAYS", "7"))
+
+
+def parse_data(valor) -> Optional[date]:
+    """Converte 'YYYY-MM-DD' (ou date/datetime) para date."""
+    if not valor:
+        return None
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    return datetime.strptime(str(valor)[:10], "%Y-%m-%d").date()
+
+
+def parse_backfill(valores: List[str]) -> Tuple[date, date]:
+    """Valida o par `--backfill FROM TO` (YYYY-MM-DD)."""
+    inicio, fim = parse_data(valores[0]), parse_data(valores[1])
+    if inicio > fim:
+        raise ValueError(f"Período de backfill inválido: {inicio} > {fim}")
+    return inicio, fim
+
+
+def calcular_inicio(watermark: Optional[date], inicio_padrao: date, lookback_dias: int = SYNC_LOOKBACK_DAYS) -> date:
+    """Início da janela incremental: watermark menos o lookback, ou o padrão na primeira execução."""
+    if not watermark:
+        return inicio_padrao
+    return watermark - timedelta(days=lookback_dias)
+
+
+def ler_watermark(supabase, company_id: str) -> Optional[date]:
+    try:
+        response = supabase.table("companies").select("sync_watermark").eq("id", company_id).execute()
+        if response.data:
+            return parse_data(response.data[0].get("sync_watermark"))
+    except Exception as e:
+        print(f"⚠️ Erro ao ler watermark da empresa {company_id}: {e}")
+    return None
+
+
+def salvar_watermark(supabase, company_id: str, novo: Optional[date], atual: Optional[date] = None):
+    """Grava last_sync e avança o watermark (nunca retrocede)."""
+    dados = {"last_sync": datetime.now(timezone.utc).isoformat()}
+    if novo and (not atual or novo > atual):
+        dados["sync_watermark"] = novo.isoformat()
+    supabase.table("companies").update(dados).eq("id", company_id).execute()
+
+
+class ProgressoWatermark:
+    """
+    Acumula as datas de emissão sincronizadas (e as que falharam) numa execução.
+
+    O novo watermark é a maior data sincronizada, mas nunca passa da véspera da
+    falha mais antiga, para que a próxima execução ainda alcance a nota que falhou.
+    """
+
+    def __init__(self):
+        self.maior_sucesso: Optional[date] = None
+        self.menor_falha: Optional[date] = None
+        self._lock = threading.Lock()
+
+    def sucesso(self, data_emissao):
+        data_emissao = parse_data(data_emissao)
+        with self._lock:
+            if data_emissao and (not self.maior_sucesso or data_emissao > self.maior_sucesso):
+                self.maior_sucesso = data_emissao
+
+    def falha(self, data_emissao):
+        data_emissao = parse_data(data_emissao)
+        with self._lock:
+            if data_emissao and (not self.menor_falha or data_emissao < self.menor_falha):
+                self.menor_falha = data_emissao
+
+    def novo_watermark(self) -> Optional[date]:
+        if not self.maior_sucesso:
+            return None
+        if self.menor_falha:
+            return min(self.maior_sucesso, self.menor_falha - timedelta(days=1))
+        return self.maior_sucesso
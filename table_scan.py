@@ -0,0 +1,188 @@
+"""
+Varredura de tabelas inteiras do Supabase (service_notes, companies) por keyset em `id`.
+
+Um select sem paginação é cortado em silêncio pelo limite de linhas do PostgREST,
+e paginar com offset fica mais lento a cada página. Aqui cada página é
+`id > último id da anterior ORDER BY id LIMIT n`, com as colunas e filtros
+escolhidos pelo chamador:
+
+- a próxima página é buscada numa thread enquanto o chamador processa a atual;
+- a varredura só termina numa página vazia (uma página menor que a pedida pode
+  ser só o limite do servidor);
+- com `cursor`, o último id já processado fica em .cache/table_scan/<cursor>.json
+  e a próxima varredura com o mesmo cursor continua dali (o arquivo é apagado
+  quando a tabela chega ao fim).
+
+    varredura = VarreduraTabela(supabase, "service_notes", "id, s3_path_pdf",
+                                filtros=[("eq", "status", "active")], cursor="urls")
+    for pagina in varredura.paginas():
+        ...
+"""
+import json
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+SCAN_PAGE_SIZE = int(os.getenv("TABLE_SCAN_PAGE_SIZE", "1000"))
+SCAN_PREFETCH = int(os.getenv("TABLE_SCAN_PREFETCH", "2"))       # páginas buscadas à frente
+SCAN_CURSOR_DIR = os.getenv(
+    "TABLE_SCAN_CURSOR_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "table_scan"),
+)
+
+# (método do query builder, *argumentos), ex.: ("eq", "status", "active") ou ("or_", "a.is.null,b.is.null")
+Filtro = Tuple[Any, ...]
+
+
+def enviar_ate_parar(fila: "queue.Queue", item, parar: threading.Event) -> bool:
+    """
+    put numa fila limitada que desiste quando `parar` é sinalizado (o consumidor
+    abandonou a fila), em vez de travar a thread produtora para sempre.
+    Retorna False se desistiu.
+    """
+    while not parar.is_set():
+        try:
+            fila.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def antecipar(paginas: Iterable[List], limite: int = SCAN_PREFETCH) -> Iterator[List]:
+    """
+    Busca as próximas páginas numa thread (até `limite` à frente) enquanto o
+    chamador consome a atual. Erros da busca sobem no consumo, na ordem.
+    Se o chamador parar antes do fim, a thread encerra e fecha `paginas`.
+    """
+    if limite <= 0:
+        yield from paginas
+        return
+    fila: "queue.Queue" = queue.Queue(maxsize=limite)
+    fim = object()
+    parar = threading.Event()
+
+    def buscar():
+        try:
+            for pagina in paginas:
+                if not enviar_ate_parar(fila, pagina, parar):
+                    return
+            enviar_ate_parar(fila, fim, parar)
+        except BaseException as e:
+            enviar_ate_parar(fila, e, parar)
+        finally:
+            # Fechado nesta thread: é ela que itera o gerador
+            fechar = getattr(paginas, "close", None)
+            if fechar:
+                fechar()
+
+    threading.Thread(target=buscar, daemon=True).start()
+    try:
+        while True:
+            pagina = fila.get()
+            if pagina is fim:
+                return
+            if isinstance(pagina, BaseException):
+                raise pagina
+            yield pagina
+    finally:
+        parar.set()
+
+
+def _nomes(colunas: str) -> List[str]:
+    """Nomes das colunas de um select do PostgREST ('alias:coluna' conta como coluna)."""
+    return [c.strip().split(":")[-1].strip() for c in colunas.split(",")]
+
+
+class VarreduraTabela:
+    """Varredura de uma tabela (ou view com `id`) em páginas por keyset, com cursor opcional."""
+
+    def __init__(
+        self,
+        supabase,
+        tabela: str,
+        colunas: str = "*",
+        filtros: Sequence[Filtro] = (),
+        tamanho_pagina: int = SCAN_PAGE_SIZE,
+        prefetch: int = SCAN_PREFETCH,
+        cursor: Optional[str] = None,
+        apos_id: Optional[str] = None,
+    ):
+        self.supabase = supabase
+        self.tabela = tabela
+        self.colunas = colunas if colunas.strip() == "*" or "id" in _nomes(colunas) else f"id, {colunas}"
+        self.filtros = list(filtros)
+        self.tamanho_pagina = tamanho_pagina
+        self.prefetch = prefetch
+        self.cursor_path = os.path.join(SCAN_CURSOR_DIR, f"{cursor}.json") if cursor else None
+        self.apos_id = apos_id if apos_id is not None else self._ler_cursor()
+        self.linhas = 0
+
+    # ---------- Cursor ----------
+
+    def _ler_cursor(self) -> Optional[str]:
+        if not self.cursor_path or not os.path.exists(self.cursor_path):
+            return None
+        try:
+            with open(self.cursor_path, encoding="utf-8") as f:
+                dados = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Cursor ignorado ({self.cursor_path}): {e}")
+            return None
+        return dados.get("apos_id") if dados.get("tabela") == self.tabela else None
+
+    def _salvar_cursor(self, apos_id: str):
+        if not self.cursor_path:
+            return
+        os.makedirs(os.path.dirname(self.cursor_path), exist_ok=True)
+        tmp = self.cursor_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"tabela": self.tabela, "apos_id": apos_id, "linhas": self.linhas,
+                       "atualizado_em": datetime.now(timezone.utc).isoformat()}, f)
+        os.replace(tmp, self.cursor_path)
+
+    def reiniciar(self):
+        """Descarta o cursor salvo: a próxima varredura começa do primeiro id."""
+        self.apos_id = None
+        if self.cursor_path and os.path.exists(self.cursor_path):
+            os.remove(self.cursor_path)
+
+    # ---------- Varredura ----------
+
+    def _buscar(self) -> Iterator[List[Dict]]:
+        ultimo = self.apos_id
+        while True:
+            query = self.supabase.table(self.tabela).select(self.colunas)
+            for metodo, *argumentos in self.filtros:
+                query = getattr(query, metodo)(*argumentos)
+            if ultimo is not None:
+                query = query.gt("id", ultimo)
+            pagina = query.order("id").limit(self.tamanho_pagina).execute().data or []
+            if not pagina:
+                return
+            yield pagina
+            ultimo = pagina[-1]["id"]
+
+    def paginas(self) -> Iterator[List[Dict]]:
+        """
+        Páginas em ordem de id. Uma página conta como processada quando o chamador
+        pede a seguinte: só então o cursor avança para o seu último id. Se o
+        chamador parar antes, a busca antecipada é encerrada.
+        """
+        antecipadas = antecipar(self._buscar(), self.prefetch)
+        try:
+            for pagina in antecipadas:
+                yield pagina
+                self.linhas += len(pagina)
+                self.apos_id = pagina[-1]["id"]
+                self._salvar_cursor(self.apos_id)
+        finally:
+            antecipadas.close()
+        # Fim da tabela: a próxima varredura com este cursor começa do início
+        self.reiniciar()
+
+    def __iter__(self) -> Iterator[Dict]:
+        for pagina in self.paginas():
+            yield from pagina
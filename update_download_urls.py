@@ -3,6 +3,7 @@ Script auxiliar para atualizar URLs de download das notas fiscais.
 As URLs do S3 são pré-assinadas e expiram após 24 horas.
 Este script pode ser executado periodicamente (ex: via cron job) para manter as URLs atualizadas.
 """
+import argparse
 import boto3
 import os
 import sys
@@ -21,6 +22,8 @@ sys.path.insert(0, current_dir)
 from datetime import datetime, timedelta
 from botocore.config import Config
 
+from table_scan import VarreduraTabela
+
 from dotenv import load_dotenv
 
 # Carregar variáveis de ambiente
@@ -65,51 +68,44 @@ def generate_presigned_url(s3_key: str, expiration: int = 86400) -> str:
         return ""
 
 
-def update_download_urls():
-    """Atualiza as URLs de download para todas as notas ativas."""
+def update_download_urls(retomar: bool = False):
+    """
+    Atualiza as URLs de download de todas as notas ativas, página a página
+    (varredura por id, ver table_scan), com um UPDATE em lote por página.
+    Com `retomar`, continua de onde a execução anterior parou.
+    """
     print("🔄 Atualizando URLs de download...")
     
+    varredura = VarreduraTabela(supabase, 'service_notes', 'id, s3_path_pdf, s3_path_xml',
+                                filtros=[('eq', 'status', 'active')], cursor='update_download_urls')
+    if not retomar:
+        varredura.reiniciar()
+    elif varredura.apos_id:
+        print(f"↪️  Retomando após a nota ID: {varredura.apos_id}")
+    
+    success_count = 0
+    error_count = 0
+    
     try:
-        # Buscar todas as notas ativas
-        response = supabase.table('service_notes')\
-            .select('id, s3_path_pdf, s3_path_xml')\
-            .eq('status', 'active')\
-            .execute()
-        
-        notas = response.data
-        print(f"📊 Total de notas para atualizar: {len(notas)}")
-        
-        success_count = 0
-        error_count = 0
-        
-        for nota in notas:
-            try:
-                updates = {}
-                
-                # Gerar nova URL para PDF
-                if nota.get('s3_path_pdf'):
-                    url_pdf = generate_presigned_url(nota['s3_path_pdf'])
-                    if url_pdf:
-                        updates['download_url_pdf'] = url_pdf
-                
-                # Gerar nova URL para XML
-                if nota.get('s3_path_xml'):
-                    url_xml = generate_presigned_url(nota['s3_path_xml'])
-                    if url_xml:
-                        updates['download_url_xml'] = url_xml
-                
-                # Atualizar no banco
-                if updates:
-                    supabase.table('service_notes')\
-                        .update(updates)\
-                        .eq('id', nota['id'])\
-                        .execute()
-                    success_count += 1
-                    print(f"  ✅ Atualizada nota ID: {nota['id']}")
-                
-            except Exception as e:
-                error_count += 1
-                print(f"  ❌ Erro ao atualizar nota ID {nota.get('id')}: {e}")
+        for pagina in varredura.paginas():
+            itens = []
+            for nota in pagina:
+                item = {'id': nota['id']}
+                for tipo in ('pdf', 'xml'):
+                    # Gerar nova URL para o PDF e para o XML
+                    if nota.get(f's3_path_{tipo}'):
+                        url = generate_presigned_url(nota[f's3_path_{tipo}'])
+                        if url:
+                            item[f'download_url_{tipo}'] = url
+                        else:
+                            error_count += 1
+                if len(item) > 1:
+                    itens.append(item)
+            
+            # Atualizar a página no banco numa única chamada
+            if itens:
+                success_count += supabase.rpc('update_service_note_download_urls', {'itens': itens}).execute().data or 0
+            print(f"  ✅ {varredura.linhas + len(pagina)} notas lidas | {success_count} atualizadas")
         
         print("\n" + "=" * 60)
         print("✅ ATUALIZAÇÃO CONCLUÍDA")
@@ -119,15 +115,22 @@ def update_download_urls():
         print("=" * 60)
         
     except Exception as e:
-        print(f"❌ Erro ao buscar notas: {e}")
+        # O cursor fica na última página gravada
+        print(f"❌ Erro ao atualizar notas: {e}")
+        print("   Rode novamente com --retomar para continuar de onde parou.")
 
 
 def main():
     """Função principal."""
+    parser = argparse.ArgumentParser(description="Renova as URLs pré-assinadas de download das notas.")
+    parser.add_argument("--retomar", action="store_true",
+                        help="Continua a partir da última página atualizada pela execução anterior")
+    args = parser.parse_args()
+
     print("=" * 60)
     print("🔗 ATUALIZAÇÃO DE URLs DE DOWNLOAD")
     print("=" * 60)
-    update_download_urls()
+    update_download_urls(args.retomar)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+"""
+Planejamento adaptativo das janelas de consulta por período na PlugNotas.
+
+Em vez de janelas fixas (30 dias / mês calendário), o planner:
+- começa com janelas grandes (até o limite de 31 dias da API), juntando trechos
+  que o histórico diz estarem vazios;
+- divide uma janela ao meio quando ela passa de `limiar_paginas` páginas, para
+  que as metades sejam buscadas em paralelo;
+- guarda a densidade (notas por dia) de cada CNPJ entre execuções (quem chama
+  grava o cache com `salvar()` ao fim de cada empresa, não a cada janela).
+
+As janelas sempre particionam o intervalo pedido (sem sobreposição nem buracos),
+então o conjunto de notas retornado é o mesmo da busca por janelas fixas.
+"""
+import json
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from table_scan import enviar_ate_parar
+
+# Limite da API: no máximo 31 dias por consulta
+DIAS_MAX_JANELA = 31
+LIMIAR_PAGINAS = int(os.getenv("WINDOW_SPLIT_PAGES", "4"))
+WINDOW_WORKERS = int(os.getenv("WINDOW_WORKERS", "4"))
+PAGE_QUEUE_SIZE = int(os.getenv("PAGE_QUEUE_SIZE", "8"))
+DENSITY_PATH = os.getenv(
+    "WINDOW_DENSITY_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "window_density.json"),
+)
+
+Janela = Tuple[date, date]
+# buscar_pagina(inicio, fim, cursor) -> (notas, proximo_cursor); cursor None = fim da paginação
+BuscarPagina = Callable[[date, date, Optional[object]], Tuple[List[Dict], Optional[object]]]
+
+
+class DensidadeCache:
+    """Notas por dia observadas em cada CNPJ, persistidas em JSON entre execuções."""
+
+    def __init__(self, path: str = DENSITY_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._dados: Dict[str, Dict[str, float]] = {}
+        self._alterado = False
+        if os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self._dados = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Cache de densidade ignorado ({path}): {e}")
+
+    def densidade(self, cnpj: str) -> Dict[date, float]:
+        with self._lock:
+            return {date.fromisoformat(d): v for d, v in self._dados.get(cnpj, {}).items()}
+
+    def registrar(self, cnpj: str, janela: Janela, total_notas: int):
+        """Distribui o total observado igualmente pelos dias da janela."""
+        dias = (janela[1] - janela[0]).days + 1
+        por_dia = total_notas / dias
+        with self._lock:
+            cnpj_dados = self._dados.setdefault(cnpj, {})
+            for i in range(dias):
+                cnpj_dados[(janela[0] + timedelta(days=i)).isoformat()] = por_dia
+            self._alterado = True
+
+    def salvar(self):
+        """Grava o cache (arquivo temporário + os.replace), se algo mudou desde a última gravação."""
+        with self._lock:
+            if not self._alterado:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._dados, f)
+            os.replace(tmp, self.path)
+            self._alterado = False
+
+
+def planejar_janelas(
+    inicio: date,
+    fim: date,
+    densidade: Optional[Dict[date, float]] = None,
+    notas_por_janela: Optional[float] = None,
+    dias_max: int = DIAS_MAX_JANELA,
+) -> List[Janela]:
+    """
+    Particiona [inicio, fim] em janelas contíguas.
+
+    Cada janela cresce dia a dia até `dias_max` ou até a densidade histórica
+    estimar mais que `notas_por_janela` notas. Dias sem histórico contam como
+    vazios (começa grosso; a divisão acontece na busca, se preciso).
+    """
+    densidade = densidade or {}
+    janelas = []
+    atual = inicio
+    while atual <= fim:
+        janela_fim = atual
+        estimado = densidade.get(atual, 0.0)
+        while janela_fim < fim and (janela_fim - atual).days + 1 < dias_max:
+            proximo = densidade.get(janela_fim + timedelta(days=1), 0.0)
+            if notas_por_janela is not None and estimado + proximo > notas_por_janela:
+                break
+            estimado += proximo
+            janela_fim += timedelta(days=1)
+        janelas.append((atual, janela_fim))
+        atual = janela_fim + timedelta(days=1)
+    return janelas
+
+
+def _dividir(janela: Janela) -> List[Janela]:
+    meio = janela[0] + timedelta(days=((janela[1] - janela[0]).days + 1) // 2 - 1)
+    return [(janela[0], meio), (meio + timedelta(days=1), janela[1])]
+
+
+def buscar_adaptativo(
+    inicio: date,
+    fim: date,
+    buscar_pagina: BuscarPagina,
+    tamanho_pagina: int,
+    cnpj: Optional[str] = None,
+    cache: Optional[DensidadeCache] = None,
+    limiar_paginas: Optional[int] = LIMIAR_PAGINAS,
+    max_workers: int = WINDOW_WORKERS,
+    ao_falhar: Optional[Callable[[Janela, Exception], None]] = None,
+    tamanho_fila: int = PAGE_QUEUE_SIZE,
+) -> Iterator[Tuple[Janela, List[Dict]]]:
+    """
+    Busca todas as notas de [inicio, fim], gerando (janela, notas_da_pagina) por página.
+
+    Uma janela com mais de `limiar_paginas` páginas é descartada e dividida ao
+    meio; as metades entram no pool. Por isso as páginas de uma janela só são
+    entregues quando ela termina dentro do limiar; janelas de um único dia (que
+    não podem ser divididas) entregam cada página assim que chega.
+
+    As páginas passam por uma fila limitada (`tamanho_fila`): se quem consome
+    atrasar, os workers param de buscar. O pico de memória fica limitado pela
+    fila e pelos buffers dos workers, não pelo histórico do tenant.
+    Se `buscar_pagina` levantar exceção, a janela entrega o que já obteve e
+    `ao_falhar(janela, erro)` é chamado (na thread de quem consome).
+    Com `limiar_paginas=None` e sem cache, reproduz a busca por janelas fixas.
+    A densidade observada fica em memória no `cache`; gravá-la é com quem chama.
+    """
+    densidade = cache.densidade(cnpj) if cache and cnpj else {}
+    limite_notas = limiar_paginas * tamanho_pagina if limiar_paginas else None
+    janelas = planejar_janelas(inicio, fim, densidade, limite_notas)
+
+    saida: queue.Queue = queue.Queue(maxsize=max(1, tamanho_fila))
+    parar = threading.Event()
+
+    def enviar(item) -> bool:
+        return enviar_ate_parar(saida, item, parar)
+
+    def paginar_janela(janela: Janela) -> bool:
+        """Pagina a janela; retorna False se ela foi dividida (ou a busca interrompida)."""
+        divisivel = bool(limiar_paginas) and janela[0] < janela[1]
+        buffer, cursor, paginas, total = [], None, 0, 0
+        while not parar.is_set():
+            try:
+                pagina, cursor = buscar_pagina(janela[0], janela[1], cursor)
+            except Exception as e:
+                for p in buffer:
+                    enviar(("pagina", janela, p))
+                enviar(("falha", janela, e))
+                return True
+            paginas += 1
+            total += len(pagina)
+            if pagina:
+                if divisivel:
+                    buffer.append(pagina)
+                elif not enviar(("pagina", janela, pagina)):
+                    return False
+            if cursor is None or not pagina:
+                for p in buffer:
+                    enviar(("pagina", janela, p))
+                if cache and cnpj:
+                    cache.registrar(cnpj, janela, total)
+                return True
+            if divisivel and paginas >= limiar_paginas:
+                if cache and cnpj:
+                    cache.registrar(cnpj, janela, total + tamanho_pagina)
+                enviar(("dividir", janela, _dividir(janela)))
+                return False
+        return False
+
+    def buscar_janela(janela: Janela):
+        try:
+            if not paginar_janela(janela):
+                return
+        except Exception as e:
+            enviar(("falha", janela, e))
+        enviar(("fim", janela, None))
+
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for janela in janelas:
+            pool.submit(buscar_janela, janela)
+        pendentes = len(janelas)
+        while pendentes:
+            tipo, janela, valor = saida.get()
+            if tipo == "pagina":
+                yield janela, valor
+            elif tipo == "falha":
+                if ao_falhar:
+                    ao_falhar(janela, valor)
+            elif tipo == "dividir":
+                print(f"      ✂️  Janela {janela[0]} a {janela[1]} dividida em {valor[0][1]} / {valor[1][0]}")
+                for metade in valor:
+                    pool.submit(buscar_janela, metade)
+                pendentes += 1
+            elif tipo == "fim":
+                pendentes -= 1
+    finally:
+        parar.set()
+        pool.shutdown(wait=True)
@@ -0,0 +1,332 @@
+"""
+Fila de trabalho local e durável (SQLite) entre a busca e a gravação.
+
+As notas descobertas na API entram na fila com uma chave de idempotência
+(nota_id). Workers retiram os jobs para transferir os arquivos e gravar no
+Supabase. Se a execução cair (crash, Ctrl-C), os jobs pendentes continuam no
+arquivo e a próxima execução processa só o que faltou: notas já concluídas
+nesta rodada são ignoradas ao serem redescobertas.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional
+
+WORK_QUEUE_PATH = os.getenv(
+    "WORK_QUEUE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "work_queue.sqlite3"),
+)
+WORK_QUEUE_WORKERS = int(os.getenv("WORK_QUEUE_WORKERS", "4"))
+WORK_QUEUE_MAX_PENDING = int(os.getenv("WORK_QUEUE_MAX_PENDING", "1000"))   # jobs aguardando um Future
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    chave TEXT PRIMARY KEY,
+    grupo TEXT,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    tentativas INTEGER NOT NULL DEFAULT 0,
+    erro TEXT,
+    criado_em TEXT NOT NULL,
+    atualizado_em TEXT NOT NULL
+);
+-- reservar: próximo pendente por ordem de chegada, sem ordenar todos os pendentes
+-- (o índice (status, grupo, criado_em) também atende contagem e substitui o antigo)
+DROP INDEX IF EXISTS idx_jobs_status_grupo;
+CREATE INDEX IF NOT EXISTS idx_jobs_status_grupo_criado ON jobs(status, grupo, criado_em);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_criado ON jobs(status, criado_em);
+"""
+
+
+def _agora() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FilaTrabalho:
+    """Fila de jobs em SQLite (status: pending -> running -> done | failed)."""
+
+    def __init__(self, path: str = WORK_QUEUE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def recuperar_interrompidos(self) -> int:
+        """Devolve para a fila os jobs que estavam em andamento quando a execução anterior caiu."""
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE jobs SET status = 'pending', atualizado_em = ? WHERE status = 'running'", (_agora(),)
+            )
+            return cur.rowcount
+
+    def enfileirar(self, chave: str, payload: Dict, grupo: Optional[str] = None) -> bool:
+        """
+        Enfileira o job se a chave ainda não existe. Jobs que falharam voltam a
+        ficar pendentes; concluídos e em andamento são ignorados.
+        Retorna True se o job ficou pendente por esta chamada.
+        """
+        agora = _agora()
+        with self._lock:
+            cur = self._conn.execute(
+                """
+                INSERT INTO jobs (chave, grupo, payload, status, criado_em, atualizado_em)
+                VALUES (?, ?, ?, 'pending', ?, ?)
+                ON CONFLICT(chave) DO UPDATE SET
+                    status = 'pending', payload = excluded.payload, grupo = excluded.grupo,
+                    erro = NULL, atualizado_em = excluded.atualizado_em
+                WHERE jobs.status = 'failed'
+                """,
+                (chave, grupo, json.dumps(payload, default=str), agora, agora),
+            )
+            return cur.rowcount > 0
+
+    def reservar(self, grupo: Optional[str] = None) -> Optional[Dict]:
+        """Retira o próximo job pendente (do grupo, se informado) e o marca como em andamento."""
+        with self._lock:
+            filtro, params = ("AND grupo = ?", (grupo,)) if grupo is not None else ("", ())
+            row = self._conn.execute(
+                f"SELECT chave, grupo, payload, tentativas FROM jobs WHERE status = 'pending' {filtro} "
+                "ORDER BY criado_em LIMIT 1",
+                params,
+            ).fetchone()
+            if not row:
+                return None
+            self._conn.execute(
+                "UPDATE jobs SET status = 'running', tentativas = tentativas + 1, atualizado_em = ? WHERE chave = ?",
+                (_agora(), row[0]),
+            )
+            return {"chave": row[0], "grupo": row[1], "payload": json.loads(row[2]), "tentativas": row[3] + 1}
+
+    def concluir(self, chave: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'done', erro = NULL, atualizado_em = ? WHERE chave = ?", (_agora(), chave)
+            )
+
+    def falhar(self, chave: str, erro: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'failed', erro = ?, atualizado_em = ? WHERE chave = ?",
+                (erro[:1000], _agora(), chave),
+            )
+
+    def status(self, chave: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM jobs WHERE chave = ?", (chave,)).fetchone()
+        return row[0] if row else None
+
+    def contagem(self, grupo: Optional[str] = None) -> Dict[str, int]:
+        filtro, params = ("WHERE grupo = ?", (grupo,)) if grupo is not None else ("", ())
+        with self._lock:
+            rows = self._conn.execute(f"SELECT status, COUNT(*) FROM jobs {filtro} GROUP BY status", params).fetchall()
+        contagem = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+        contagem.update(dict(rows))
+        return contagem
+
+    def descartar_pendentes(self, grupo: str) -> int:
+        """Remove os jobs pendentes do grupo (ex.: a empresa passou para outro worker)."""
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM jobs WHERE status = 'pending' AND grupo = ?", (grupo,)
+            ).rowcount
+
+    def limpar_concluidos(self) -> int:
+        """Remove os jobs concluídos ao fim de uma execução completa (a próxima rodada começa do zero)."""
+        with self._lock:
+            return self._conn.execute("DELETE FROM jobs WHERE status = 'done'").rowcount
+
+    def fechar(self):
+        with self._lock:
+            self._conn.close()
+
+
+class MonitorFila(threading.Thread):
+    """Imprime profundidade da fila e vazão (jobs/s) periodicamente durante a execução."""
+
+    def __init__(self, fila: FilaTrabalho, intervalo: float = 10.0):
+        super().__init__(daemon=True)
+        self.fila = fila
+        self.intervalo = intervalo
+        self._parar = threading.Event()
+
+    def run(self):
+        anterior = self.fila.contagem()
+        t_anterior = time.monotonic()
+        while not self._parar.wait(self.intervalo):
+            atual = self.fila.contagem()
+            agora = time.monotonic()
+            processados = (atual["done"] + atual["failed"]) - (anterior["done"] + anterior["failed"])
+            vazao = processados / (agora - t_anterior) if agora > t_anterior else 0.0
+            print(f"  [Fila] pendentes: {atual['pending']} | em andamento: {atual['running']} | "
+                  f"concluídos: {atual['done']} | falhas: {atual['failed']} | {vazao:.1f} jobs/s")
+            anterior, t_anterior = atual, agora
+
+    def parar(self):
+        self._parar.set()
+
+
+def executar_jobs(
+    fila: FilaTrabalho,
+    handler: Callable[[Dict], bool],
+    grupo: Optional[str] = None,
+    workers: int = WORK_QUEUE_WORKERS,
+    ao_concluir: Optional[Callable[[Dict, bool], None]] = None,
+    max_pendentes: int = WORK_QUEUE_MAX_PENDING,
+    prazo: Optional[float] = None,
+    producao: Optional[threading.Event] = None,
+    cancelar: Optional[threading.Event] = None,
+) -> Dict[str, int]:
+    """
+    Processa os jobs pendentes (do grupo) com `workers` threads até esvaziar a fila.
+    `handler(payload)` retorna True/False; exceções contam como falha.
+    O handler também pode retornar um Future[bool] (ex.: gravação em voo no escritor
+    assíncrono): o worker segue para o próximo job e o resultado é registrado quando
+    o Future termina, com no máximo `max_pendentes` jobs aguardando.
+    `ao_concluir(payload, ok)` é chamado após cada job.
+    Com `prazo` (instante em time.monotonic), os workers param de retirar jobs ao
+    atingi-lo; os que sobrarem continuam pendentes para a próxima execução.
+    Com `producao`, a fila vazia não encerra os workers: eles esperam novos jobs
+    até o evento ser sinalizado (o produtor terminou de enfileirar).
+    Com `cancelar` sinalizado, os workers param de retirar jobs (como no prazo).
+    """
+    resultado = {"ok": 0, "falhas": 0}
+    lock = threading.Lock()
+    pendentes = threading.Semaphore(max(1, max_pendentes))
+
+    def finalizar(job, ok, erro):
+        if ok:
+            fila.concluir(job["chave"])
+        else:
+            fila.falhar(job["chave"], erro)
+        if ao_concluir:
+            ao_concluir(job["payload"], ok)
+        with lock:
+            resultado["ok" if ok else "falhas"] += 1
+
+    def ao_terminar(job, futuro: Future):
+        try:
+            ok = bool(futuro.result())
+            erro = None if ok else "handler retornou falha"
+        except Exception as e:
+            ok, erro = False, f"{type(e).__name__}: {e}"
+        try:
+            finalizar(job, ok, erro)
+        finally:
+            pendentes.release()
+
+    def worker():
+        while (prazo is None or time.monotonic() < prazo) and not (cancelar and cancelar.is_set()):
+            job = fila.reservar(grupo)
+            if job is None:
+                if producao is None:
+                    return
+                if not producao.is_set():
+                    producao.wait(0.1)
+                    continue
+                # Produção encerrada: mais uma olhada pega o que entrou antes do sinal
+                job = fila.reservar(grupo)
+                if job is None:
+                    return
+            try:
+                retorno = handler(job["payload"])
+            except Exception as e:
+                finalizar(job, False, f"{type(e).__name__}: {e}")
+                continue
+            if isinstance(retorno, Future):
+                pendentes.acquire()
+                retorno.add_done_callback(lambda f, job=job: ao_terminar(job, f))
+                continue
+            ok = bool(retorno)
+            finalizar(job, ok, None if ok else "handler retornou falha")
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, workers))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Espera os jobs que ainda aguardam o Future
+    for _ in range(max(1, max_pendentes)):
+        pendentes.acquire()
+    return resultado
+
+
+class ConsumoConcorrente:
+    """
+    executar_jobs numa thread enquanto o produtor ainda enfileira: os workers
+    começam no primeiro job e esperam por novos até `encerrar()`. O produtor
+    enfileira por `enfileirar()` e chama `aguardar_vaga()` em seguida; ela segura
+    a produção enquanto o grupo tiver mais de `max_adiantados` jobs por terminar.
+    A conta é feita em memória (enfileirados menos concluídos), sem consultar a
+    fila: os workers avisam a cada job concluído.
+    """
+
+    def __init__(
+        self,
+        fila: FilaTrabalho,
+        handler: Callable[[Dict], bool],
+        grupo: Optional[str] = None,
+        workers: int = WORK_QUEUE_WORKERS,
+        ao_concluir: Optional[Callable[[Dict, bool], None]] = None,
+        prazo: Optional[float] = None,
+        max_adiantados: int = 100,
+        cancelar: Optional[threading.Event] = None,
+    ):
+        self.fila = fila
+        self.grupo = grupo
+        self.max_adiantados = max(1, max_adiantados)
+        self.producao = threading.Event()
+        self.resultado: Dict[str, int] = {"ok": 0, "falhas": 0}
+        self._erro: Optional[BaseException] = None
+        self._vaga = threading.Condition()
+        # Jobs do grupo que já estavam pendentes (execução anterior) também ocupam vaga
+        self._adiantados = fila.contagem(grupo)["pending"]
+
+        def concluido(payload, ok):
+            try:
+                if ao_concluir:
+                    ao_concluir(payload, ok)
+            finally:
+                with self._vaga:
+                    self._adiantados -= 1
+                    self._vaga.notify_all()
+
+        def rodar():
+            try:
+                self.resultado = executar_jobs(fila, handler, grupo=grupo, workers=workers, ao_concluir=concluido,
+                                               prazo=prazo, producao=self.producao, cancelar=cancelar)
+            except BaseException as e:
+                self._erro = e
+            finally:
+                with self._vaga:
+                    self._vaga.notify_all()
+
+        self._thread = threading.Thread(target=rodar, daemon=True)
+        self._thread.start()
+
+    def enfileirar(self, chave: str, payload: Dict) -> bool:
+        """FilaTrabalho.enfileirar no grupo do consumo, contando o job para aguardar_vaga."""
+        if not self.fila.enfileirar(chave, payload, grupo=self.grupo):
+            return False
+        with self._vaga:
+            self._adiantados += 1
+        return True
+
+    def aguardar_vaga(self):
+        # Com os workers parados (prazo atingido), não há o que esperar
+        with self._vaga:
+            self._vaga.wait_for(lambda: not self._thread.is_alive() or self._adiantados <= self.max_adiantados)
+
+    def encerrar(self) -> Dict[str, int]:
+        """Sinaliza o fim da produção e espera os workers esvaziarem a fila (ou o prazo)."""
+        self.producao.set()
+        self._thread.join()
+        if self._erro:
+            raise self._erro
+        return self.resultado
@@ -0,0 +1,199 @@
+"""
+Extração de valor_total, descricao_servico e codigo_servico do XML das notas.
+
+O XML que já está no S3 tem esses campos, então não é preciso consultar o
+detalhe da nota na PlugNotas. Os XMLs são lidos em streaming do S3 (inclusive
+os gravados com gzip, ver s3_xml_gzip) e parseados com iterparse num pool de
+processos; a leitura para assim que os três campos aparecem.
+
+Layouts suportados (tags comparadas sem namespace):
+- ABRASF: ValorServicos, Discriminacao, ItemListaServico / CodigoTributacaoMunicipio
+- Nacional (NFS-e padrão nacional): vServ, xDescServ, cTribNac / cTribMun
+
+Uso (preenche as notas com XML ainda não lido, em lotes):
+    python xml_metadata.py
+    python xml_metadata.py --limite 5000 --processos 8
+"""
+import argparse
+import gzip
+import os
+import sys
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from typing import Dict, IO, List, Optional
+
+from monthly_summary import MesesAlterados, atualizar_resumo_mensal
+
+XML_PROCESSES = int(os.getenv("XML_METADATA_PROCESSES", str(os.cpu_count() or 4)))
+XML_BATCH_SIZE = int(os.getenv("XML_METADATA_BATCH_SIZE", "500"))
+
+# Campo de service_notes -> tags candidatas, em ordem de prioridade
+TAGS_CAMPOS = {
+    "valor_total": ("ValorServicos", "vServ"),
+    "descricao_servico": ("Discriminacao", "xDescServ"),
+    "codigo_servico": ("ItemListaServico", "cTribNac", "CodigoTributacaoMunicipio", "cTribMun"),
+}
+_CAMPO_POR_TAG = {tag: (campo, prioridade) for campo, tags in TAGS_CAMPOS.items() for prioridade, tag in enumerate(tags)}
+_TAMANHO_CODIGO = 20  # service_notes.codigo_servico VARCHAR(20)
+
+
+def _nome_local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _converter(campo: str, texto: str):
+    texto = texto.strip()
+    if not texto:
+        return None
+    if campo == "valor_total":
+        try:
+            return float(Decimal(texto.replace(",", ".")))
+        except InvalidOperation:
+            return None
+    if campo == "codigo_servico":
+        return texto[:_TAMANHO_CODIGO]
+    return texto
+
+
+def extrair_campos(fonte: IO[bytes]) -> Dict:
+    """
+    Parse incremental de um XML de NFS-e (arquivo ou stream).
+    Retorna só os campos encontrados; para assim que os três aparecem.
+    """
+    encontrados: Dict[str, tuple] = {}
+    for _, elem in ET.iterparse(fonte, events=("end",)):
+        mapeado = _CAMPO_POR_TAG.get(_nome_local(elem.tag))
+        if mapeado:
+            campo, prioridade = mapeado
+            valor = _converter(campo, elem.text or "")
+            if valor is not None and (campo not in encontrados or prioridade < encontrados[campo][1]):
+                encontrados[campo] = (valor, prioridade)
+                if len(encontrados) == len(TAGS_CAMPOS):
+                    break
+        elem.clear()
+    return {campo: valor for campo, (valor, _) in encontrados.items()}
+
+
+def extrair_de_objeto(s3_client, bucket: str, key: str) -> Dict:
+    """Lê o XML do S3 em streaming (descomprimindo se estiver com gzip) e extrai os campos."""
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    body = response["Body"]
+    try:
+        fonte = gzip.GzipFile(fileobj=body) if response.get("ContentEncoding") == "gzip" else body
+        return extrair_campos(fonte)
+    finally:
+        body.close()
+
+
+# ---------- Pool de processos ----------
+
+_s3_worker = None
+_bucket_worker = None
+
+
+def _iniciar_worker(config_s3: Dict, bucket: str):
+    """Cada processo cria o próprio cliente S3 (clientes boto3 não atravessam processos)."""
+    global _s3_worker, _bucket_worker
+    import boto3
+    from botocore.config import Config
+
+    _s3_worker = boto3.client("s3", config=Config(signature_version="s3v4"), **config_s3)
+    _bucket_worker = bucket
+
+
+def _extrair_nota(nota: Dict) -> Dict:
+    try:
+        campos = extrair_de_objeto(_s3_worker, _bucket_worker, nota["s3_path_xml"])
+        return {"id": nota["id"], **campos}
+    except Exception as e:
+        return {"id": nota["id"], "erro": f"{type(e).__name__}: {e}"}
+
+
+def aplicar_lote(supabase, itens: List[Dict]) -> int:
+    """Grava um lote de metadados com uma única chamada (função SQL da migration)."""
+    if not itens:
+        return 0
+    response = supabase.rpc("update_service_notes_xml_metadata", {"itens": itens}).execute()
+    return response.data or 0
+
+
+def notas_pendentes(supabase, limite: Optional[int] = None, tamanho_pagina: int = 1000):
+    """Notas com XML no S3 que ainda não passaram pela extração (paginação por id)."""
+    ultimo_id, entregues = None, 0
+    while limite is None or entregues < limite:
+        query = supabase.table("service_notes").select("id, s3_path_xml, company_id, ano, mes")\
+            .is_("metadados_xml_em", "null").not_.is_("s3_path_xml", "null")
+        if ultimo_id:
+            query = query.gt("id", ultimo_id)
+        pagina = query.order("id").limit(tamanho_pagina).execute().data or []
+        if not pagina:
+            return
+        for nota in pagina:
+            yield nota
+            entregues += 1
+            if limite is not None and entregues >= limite:
+                return
+        ultimo_id = pagina[-1]["id"]
+
+
+def extrair_pendentes(supabase, config_s3: Dict, bucket: str, processos: int = XML_PROCESSES,
+                      tamanho_lote: int = XML_BATCH_SIZE, limite: Optional[int] = None) -> Dict[str, int]:
+    resultado = {"lidas": 0, "atualizadas": 0, "erros": 0}
+    pendentes = notas_pendentes(supabase, limite)
+    meses = MesesAlterados()
+    with ProcessPoolExecutor(max_workers=max(1, processos), initializer=_iniciar_worker,
+                             initargs=(config_s3, bucket)) as pool:
+        # Um lote por vez no pool: memória constante mesmo com milhões de notas
+        while True:
+            notas = list(islice(pendentes, tamanho_lote))
+            if not notas:
+                break
+            lote = []
+            for item in pool.map(_extrair_nota, notas, chunksize=16):
+                resultado["lidas"] += 1
+                if "erro" in item:
+                    # Sem marcar metadados_xml_em: a próxima execução tenta de novo
+                    print(f"  ❌ {item['id']}: {item['erro']}")
+                    resultado["erros"] += 1
+                else:
+                    lote.append(item)
+            resultado["atualizadas"] += aplicar_lote(supabase, lote)
+            # valor_total mudou: recalcula os meses dessas notas no resumo mensal
+            meses.registrar_varios(notas)
+            atualizar_resumo_mensal(supabase, meses)
+            print(f"  📄 {resultado['lidas']} XMLs lidos | {resultado['atualizadas']} notas atualizadas")
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preenche valor/descrição/código do serviço a partir do XML no S3.")
+    parser.add_argument("--processos", type=int, default=XML_PROCESSES, help="Processos de parsing")
+    parser.add_argument("--lote", type=int, default=XML_BATCH_SIZE, help="Notas gravadas por chamada")
+    parser.add_argument("--limite", type=int, help="Máximo de notas nesta execução")
+    args = parser.parse_args()
+
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    if current_dir in sys.path:
+        sys.path.remove(current_dir)
+    from supabase import create_client
+    from dotenv import load_dotenv
+    sys.path.insert(0, current_dir)
+
+    load_dotenv(os.path.join(current_dir, "scripts", ".env"))
+    supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE_KEY"))
+    config_s3 = {
+        "aws_access_key_id": os.getenv("AWS_ACCESS_KEY"),
+        "aws_secret_access_key": os.getenv("AWS_SECRET_KEY"),
+        "region_name": os.getenv("AWS_REGION", "sa-east-1"),
+    }
+
+    print("🧾 Extraindo metadados dos XMLs no S3...")
+    resultado = extrair_pendentes(supabase, config_s3, os.getenv("AWS_BUCKET", "plug-notas"),
+                                  args.processos, args.lote, args.limite)
+    print(f"\n✅ XMLs lidos: {resultado['lidas']} | Notas atualizadas: {resultado['atualizadas']} | Erros: {resultado['erros']}")
+
+
+if __name__ == "__main__":
+    main()